@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   environment.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Environment of the engine server under benchmark.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# The server reads its cache locations from the environment on import, they
+# always point to a temporary directory so that the cache in use is untouched.
+CACHE_DIR = tempfile.mkdtemp(prefix="portal-benchmark-")
+atexit.register(shutil.rmtree, CACHE_DIR, ignore_errors=True)
+os.environ.setdefault("USE_CACHE", "0")
+os.environ["CACHE_DIR"] = os.path.join(CACHE_DIR, "store.portalCache")
+os.environ["USE_CACHE_DIR"] = os.path.join(CACHE_DIR, "cache.var")
+os.environ["MODEL_DIR"] = CACHE_DIR
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def best_of(function, repeat: int) -> float:
+    """Time a function, keeping the fastest of repeat runs.
+
+    :param function: The function to be timed, called without arguments.
+    :param repeat: The number of runs.
+    :return: The duration of the fastest run in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   nms.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Micro-benchmark of the non max suppression.
+
+Times the bbox non max suppression on random boxes of 10 classes, and the
+mask non max suppression on random rectangular masks.
+
+    python benchmarks/nms.py [--boxes 100 1000 10000] [--masks 200] [--mask-size 1024]
+"""
+
+import argparse
+from functools import partial
+
+import numpy as np
+from environment import best_of
+from server.utils.prediction_utilities import (
+    _non_max_suppress_bbox,
+    _non_max_suppress_mask,
+)
+
+CLASSES = 10
+IOU = 0.8
+CONFIDENCE = 0.001
+
+
+def random_detections(rng: np.random.Generator, count: int) -> tuple:
+    """Generate random boxes, in relative (y1, x1, y2, x2) coordinates.
+
+    :param rng: The random generator.
+    :param count: The number of detections.
+    :return: Tuple of the boxes, scores and classes.
+    """
+    corners = rng.random((count, 2))
+    boxes = np.c_[corners, corners + rng.random((count, 2)) * 0.3]
+    scores = rng.random(count)
+    classes = rng.integers(0, CLASSES, count)
+    return (
+        boxes.astype(np.float32),
+        scores.astype(np.float32),
+        classes.astype(np.float32),
+    )
+
+
+def box_masks(boxes: np.ndarray, size: int) -> np.ndarray:
+    """Draw the boxes as square masks of size x size pixels."""
+    masks = np.zeros((len(boxes), size, size), dtype=np.uint8)
+    for mask, box in zip(masks, np.clip(boxes, 0, 1) * (size - 1)):
+        y_1, x_1, y_2, x_2 = box.astype(int)
+        mask[y_1 : y_2 + 1, x_1 : x_2 + 1] = 1
+    return masks
+
+
+def main():
+    """Print the duration of the non max suppressions."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--boxes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--masks", type=int, default=200)
+    parser.add_argument("--mask-size", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{'detections':>10} {'bbox nms':>12}")
+    for count in args.boxes:
+        boxes, scores, classes = random_detections(rng, count)
+        duration = best_of(
+            partial(
+                _non_max_suppress_bbox, boxes, scores, classes, None, IOU, CONFIDENCE
+            ),
+            args.repeat,
+        )
+        print(f"{count:>10} {duration * 1000:>9.1f} ms")
+
+    if args.masks > 0:
+        boxes, scores, classes = random_detections(rng, args.masks)
+        masks = box_masks(boxes, args.mask_size)
+        duration = best_of(
+            partial(
+                _non_max_suppress_mask,
+                boxes,
+                scores,
+                classes,
+                masks,
+                None,
+                IOU,
+                CONFIDENCE,
+            ),
+            max(1, args.repeat // 2),
+        )
+        print(f"\n{'masks':>10} {'mask nms':>12}")
+        print(
+            f"{args.masks:>10} {duration * 1000:>9.1f} ms"
+            f" ({args.mask_size}x{args.mask_size} masks)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   store_journal.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Benchmark of the persistence of predictions in the cache.
+
+Adds predictions to the global store with the cache enabled, every one of
+them written to disk right away, and prints the cost per insert over each
+tenth of the run, which stays flat as long as an insert does not rewrite
+the predictions added before it.
+
+    python benchmarks/store_journal.py [--predictions 10000]
+"""
+
+import argparse
+import os
+import time
+
+# the environment is set up before the server is imported
+os.environ["USE_CACHE"] = "1"
+# pylint: disable=C0413, W0611
+import environment  # noqa: E402, F401
+from server import global_store  # noqa: E402
+
+# a typical bbox prediction of 10 detections
+PREDICTION = [
+    {
+        "annID": index,
+        "boundType": "rectangle",
+        "bound": [[0.1, 0.2], [0.1, 0.4], [0.3, 0.4], [0.3, 0.2]],
+        "confidence": 0.9,
+        "tag": {"id": 1, "name": "cat"},
+    }
+    for index in range(10)
+]
+
+
+def main():
+    """Print the cost per insert of the predictions."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--predictions", type=int, default=10000)
+    args = parser.parse_args()
+    step = max(1, args.predictions // 10)
+
+    print(f"{'predictions':>11} {'per insert':>12}")
+    start = time.perf_counter()
+    last = start
+    for index in range(args.predictions):
+        global_store.add_predictions(
+            ("benchmark", f"content-{index}", "iou0.8"), PREDICTION
+        )
+        if (index + 1) % step == 0:
+            now = time.perf_counter()
+            print(f"{index + 1:>11} {(now - last) / step * 1000:>9.3f} ms")
+            last = now
+    cache_bytes = os.path.getsize(os.environ["CACHE_DIR"])
+    print(
+        f"total {time.perf_counter() - start:.1f} s,"
+        f" cache file {cache_bytes / 1e6:.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
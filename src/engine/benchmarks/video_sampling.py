@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   video_sampling.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Benchmark of the sampling of video frames.
+
+Compares sample_video_frames with seeking to every sampled frame, the way
+videos were sampled before, on a synthetic video or on the given one.
+
+    python benchmarks/video_sampling.py [--video PATH] [--intervals 1 5 30 300]
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+from environment import CACHE_DIR, best_of
+from server.services.predictions import sample_video_frames
+
+
+def write_synthetic_video(path: str, frames: int, width: int, height: int) -> None:
+    """Write a moving noise pattern stamped with the frame index.
+
+    :param path: The path of the video.
+    :param frames: The number of frames.
+    :param width: The width of the frames.
+    :param height: The height of the frames.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height))
+    pattern = np.random.default_rng(0).integers(0, 255, (height, width, 3), np.uint8)
+    for index in range(frames):
+        frame = np.roll(pattern, index * 3, axis=1)
+        cv2.putText(frame, str(index), (50, 100), 0, 3, (255, 255, 255), 5)
+        writer.write(frame)
+    writer.release()
+
+
+def seek_every_frame(cap: cv2.VideoCapture, frame_interval: int):
+    """Sample a video by seeking to every sampled frame."""
+    count = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            return
+        yield count, frame
+        count += frame_interval
+        cap.set(cv2.CAP_PROP_POS_FRAMES, count)
+
+
+def sampled_frames_per_second(video: str, sampler, frame_interval: int, repeat: int):
+    """Time a sampling strategy on a video.
+
+    :param video: The path of the video.
+    :param sampler: The sampling strategy, see sample_video_frames.
+    :param frame_interval: The sampling interval of the video.
+    :param repeat: The number of runs, the fastest one is kept.
+    :return: Tuple of the number of sampled frames and the sampled frames
+        per second.
+    """
+    samples = []
+
+    def run():
+        cap = cv2.VideoCapture(video)
+        samples.append(sum(1 for _ in sampler(cap, frame_interval)))
+        cap.release()
+
+    duration = best_of(run, repeat)
+    return samples[-1], samples[-1] / duration
+
+
+def main():
+    """Print the sampled frames per second of both strategies."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--video", help="video to be sampled")
+    parser.add_argument("--frames", type=int, default=900)
+    parser.add_argument("--size", type=int, nargs=2, default=(1280, 720))
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 5, 30, 300])
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    video = args.video
+    if video is None:
+        video = os.path.join(CACHE_DIR, "synthetic.mp4")
+        write_synthetic_video(video, args.frames, *args.size)
+
+    print(f"{'interval':>8} {'samples':>8} {'seek every frame':>18} {'sampler':>12}")
+    for frame_interval in args.intervals:
+        samples, seek_rate = sampled_frames_per_second(
+            video, seek_every_frame, frame_interval, args.repeat
+        )
+        _, sampler_rate = sampled_frames_per_second(
+            video, sample_video_frames, frame_interval, args.repeat
+        )
+        print(
+            f"{frame_interval:>8} {samples:>8} {seek_rate:>14.1f} f/s"
+            f" {sampler_rate:>8.1f} f/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,21 +15,67 @@
 """
 import os
 import threading
-import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Union
 
-from flask import Flask
+from flask import Flask, Response
 from flask_socketio import SocketIO
 
 # pylint: disable=E0401, E0611
+from server.services.errors import Errors, PortalError
 from server.services.global_store import GlobalStore
 
 # Environment constants
 
 os.environ["WERKZEUG_RUN_MAIN"] = "true"
-MODEL_LOAD_LIMIT = 1
+# Maximum number of loaded models, and of their estimated bytes in MB (0 sets
+# no limit). The least recently used idle models are unloaded to fit.
+MODEL_LOAD_LIMIT = max(1, int(os.environ.get("PORTAL_MODEL_LOAD_LIMIT", "2")))
+MODEL_POOL_BYTES = (
+    int(os.environ.get("PORTAL_MODEL_POOL_MB", "0")) * 1024 * 1024 or None
+)
+# Number of threads loading models in the background.
+MODEL_LOAD_WORKERS = max(1, int(os.environ.get("PORTAL_MODEL_LOAD_WORKERS", "2")))
+# Models run a few inferences on a dummy input once loaded, so that the first
+# prediction does not pay the first inference cost, unless set to 0.
+MODEL_WARMUP = os.environ.get("PORTAL_MODEL_WARMUP", "1") == "1"
 EPSILON_MULTIPLIER = 0.001
 IDLE_MINUTES = 60 * 5
 CACHE_OPTION = os.environ["USE_CACHE"] == "1"
+# Video predictions run decoding, preprocessing, inference and postprocessing
+# as separate threaded stages unless PORTAL_PIPELINE is set to 0.
+PIPELINE_MODE = os.environ.get("PORTAL_PIPELINE", "1") == "1"
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+# Maximum number of images per model call for video and folder predictions.
+PREDICTION_BATCH_SIZE = int(os.environ.get("PORTAL_BATCH_SIZE", "4"))
+# Default maximum number of detections kept ahead of non max suppression,
+# the highest scoring ones being kept. 0 keeps every detection.
+PRE_NMS_TOP_K = int(os.environ.get("PORTAL_PRE_NMS_TOP_K", "0")) or None
+# Memory budget of the prediction cache in MB, the least recently used
+# predictions over it are spilled to disk. 0 keeps every prediction in memory.
+PREDICTION_CACHE_BYTES = (
+    int(os.environ.get("PORTAL_PREDICTION_CACHE_MB", "512")) * 1024 * 1024 or None
+)
+# Memory budget of the raw model outputs in MB, from which the predictions of
+# other iou and confidence thresholds are derived. 0 sets no limit.
+RAW_DETECTION_CACHE_BYTES = (
+    int(os.environ.get("PORTAL_RAW_DETECTION_CACHE_MB", "256")) * 1024 * 1024 or None
+)
+# Predictions are cached by content hash, of the whole file if
+# PORTAL_FULL_CONTENT_HASH is set to 1, else of its first and last 64 KB.
+FULL_CONTENT_HASH = os.environ.get("PORTAL_FULL_CONTENT_HASH", "0") == "1"
+# Number of threads extracting the contours of instance masks.
+CONTOUR_WORKERS = int(
+    os.environ.get("PORTAL_CONTOUR_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+# Seconds an atomic function waits for the running atomic functions sharing
+# one of its resources before failing with ATOMICERROR.
+ATOMIC_TIMEOUT = float(os.environ.get("PORTAL_ATOMIC_TIMEOUT", "30"))
+# Seconds the response of an atomic function is served to identical requests
+# arriving after it completes.
+COALESCE_SECONDS = float(os.environ.get("PORTAL_COALESCE_SECONDS", "2"))
 try:
     DEBUG_MODE = (
         int(os.environ["PORTAL_LOGGING"]) if "PORTAL_LOGGING" in os.environ else None
@@ -86,13 +132,34 @@ class ServerThread(threading.Thread):
 # pylint: disable=invalid-name
 app = Flask(__name__)
 server = ServerThread(app)
-global_store = GlobalStore(MODEL_LOAD_LIMIT, IDLE_MINUTES, caching_system=CACHE_OPTION)
-
-
-def wait_for_process() -> None:
-    """Wait for the previous atomic function to be completed."""
-    while global_store.get_atomic():
-        time.sleep(0.1)
+global_store = GlobalStore(
+    MODEL_LOAD_LIMIT,
+    MODEL_POOL_BYTES,
+    IDLE_MINUTES,
+    caching_system=CACHE_OPTION,
+    prediction_cache_bytes=PREDICTION_CACHE_BYTES,
+    raw_detection_cache_bytes=RAW_DETECTION_CACHE_BYTES,
+    full_content_hash=FULL_CONTENT_HASH,
+    atomic_timeout=ATOMIC_TIMEOUT,
+    coalesce_seconds=COALESCE_SECONDS,
+)
+
+
+def wait_for_process(process: Future) -> Union[Response, tuple]:
+    """Wait for a running atomic function to be completed.
+
+    Throws PortalError Errors.ATOMICERROR if it is not completed within
+    ATOMIC_TIMEOUT seconds.
+
+    :param process: The future of the atomic function, see set_status.
+    :return: The response of the atomic function.
+    """
+    try:
+        return process.result(timeout=ATOMIC_TIMEOUT)
+    except FutureTimeoutError as e:
+        raise PortalError(
+            Errors.ATOMICERROR, "The identical atomic process is still running."
+        ) from e
 
 
 # pylint: disable=wrong-import-position
@@ -13,8 +13,17 @@
 @License :   Apache License 2.0
 @Desc    :   Module containing the BaseModel Implementation
 """
+import os
+import time
+
+import numpy as np
+from server.models.model_utils import prefilter_detections
 from server.services.errors import Errors, PortalError
 
+# Height and width of the dummy input of warmup() for models without a known
+# input size.
+WARMUP_INPUT_SIZE = 640
+
 
 class BaseModel:
     """Base model class that should be inherited by all other models."""
@@ -38,16 +47,22 @@ class BaseModel:
         self._width_ = width
         self._label_map_ = {}
         self._model_ = None
+        self._warmup_ = None
+        self._timings_ = None
         self.kwargs = kwargs
 
     def get_info(self):
-        """Returns the name, type, directory and description of the model."""
+        """Returns the name, type, directory and description of the model,
+        the latencies measured by warmup() and the stage timings of the last
+        prediction in milliseconds, if any."""
         return {
             "directory": self._directory_,
             "description": self._description_,
             "name": self._name_,
             "type": self._type_,
             "kwargs": self.kwargs,
+            "warmup": self._warmup_,
+            "timings": self._timings_,
         }
 
     def get_model(self):
@@ -122,6 +137,60 @@ class BaseModel:
             "Please also implement this in your custom model class."
         )
 
+    def warmup(self, runs=3):
+        """Run the first inferences on a dummy input once the model is loaded.
+
+        The first inference of most backends is several times slower than
+        the following ones (graph tracing, kernel selection, memory
+        allocation). Running it on a blank image of the model input size, or
+        of WARMUP_INPUT_SIZE if it is not known, moves this cost from the
+        first prediction to the load. The cold (first) and warm (fastest of
+        the others) latencies are recorded in get_info(). Child classes
+        without a local first inference cost should overwrite it to do
+        nothing.
+
+        :param runs: The number of inferences, at least 2.
+        """
+        dummy = np.zeros(
+            (self._height_ or WARMUP_INPUT_SIZE, self._width_ or WARMUP_INPUT_SIZE, 3),
+            dtype=np.uint8,
+        )
+        latencies = []
+        for _ in range(max(2, runs)):
+            start = time.perf_counter()
+            self.predict_batch([dummy])
+            latencies.append((time.perf_counter() - start) * 1000)
+        self._warmup_ = {
+            "coldMs": round(latencies[0], 2),
+            "warmMs": round(min(latencies[1:]), 2),
+        }
+
+    def unload(self):
+        """Release the loaded model, to be loaded again with load().
+
+        Child classes holding other loaded resources than self._model_
+        should overwrite it to release them too.
+        """
+        self._model_ = None
+
+    def estimate_size(self):
+        """Returns the estimated memory used by the loaded model in bytes.
+
+        This implementation returns the size of the files in
+        self._directory_, 0 if it is not a directory. Child classes can
+        overwrite it with a better estimate.
+        """
+        if not os.path.isdir(self._directory_):
+            return 0
+        size = 0
+        for root, _, files in os.walk(self._directory_):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    continue
+        return size
+
     @classmethod
     def predict(self, image_array):
         """Function that should be overwritten by the child classes.
@@ -146,3 +215,23 @@ class BaseModel:
             "Using the BaseModel implementation of predict."
             "Please also implement this in your custom model class."
         )
+
+    def predict_batch(self, image_arrays, top_k=None, score_threshold=None):
+        """Perform inference on a list of image arrays.
+
+        Returns a list containing one detections dictionary per image array,
+        in the format described in predict(). This implementation simply
+        loops over predict(). Child classes whose backend accepts batched
+        inputs should overwrite it to run the whole batch in a single call.
+
+        Only the top_k highest scoring detections with a score of at least
+        score_threshold are returned (see prefilter_detections). Child
+        classes materializing full image masks should apply this selection
+        before doing so.
+        """
+        return [
+            prefilter_detections(
+                self.predict(image_array=image_array), top_k, score_threshold
+            )
+            for image_array in image_arrays
+        ]
@@ -13,20 +13,28 @@
 @License :   Apache License 2.0
 @Desc    :   Module containing the AutoDetect Model class.
 """
+import logging
 import os
+import re
 import sys
+import threading
+import time
 
+import cv2
 import numpy as np
-import tensorflow as tf
-from PIL import Image
 from server.models.abstract.BaseModel import BaseModel
 from server.models.model_utils import (
     MODEL_FORMATS,
+    OnnxIOBinding,
+    create_onnx_session,
+    get_binary_image_masks,
     get_polygons,
     infer_input_details,
     infer_model_type_and_path,
     onnx_predict,
-    reframe_box_masks_to_image_masks,
+    parse_onnx_options,
+    prefilter_detections,
+    select_detections,
     tf_predict,
     tflite_predict,
     torch_predict,
@@ -35,6 +43,26 @@ from server.models.model_utils import (
 from server.services.errors import Errors, PortalError
 from server.services.hashing import get_hash
 
+logger = logging.getLogger(__name__)
+
+# Errors of the backends rejecting the batch dimension of their input, such
+# as "Got invalid dimensions for input ... Got: 4 Expected: 1".
+_BATCH_ERROR = re.compile(r"dimension|shape|rank|size", re.IGNORECASE)
+_MEMORY_ERROR = re.compile(r"memory|OOM|resource.?exhausted", re.IGNORECASE)
+
+
+def _is_batch_error(error):
+    """Check if an error of a batched backend call is due to the batch size.
+
+    Out of memory errors are not, the model may accept smaller batches.
+    """
+    message = f"{type(error).__name__}: {error}"
+    return (
+        not isinstance(error, MemoryError)
+        and _BATCH_ERROR.search(message) is not None
+        and _MEMORY_ERROR.search(message) is None
+    )
+
 
 class AutoDetectModel(BaseModel):
     """Implementation of the AutoDetect Model.
@@ -47,6 +75,14 @@ class AutoDetectModel(BaseModel):
         4. TFLite
         5. Ultralytics YOLOv8
 
+    ONNX models are run with the session options given in the model kwargs,
+    see ONNX_SESSION_OPTIONS in model_utils/onnx_runtime.py.
+
+    Images are resized into a buffer reused across predictions and cast
+    straight into a float32 input tensor owned by the model, grown to the
+    largest batch seen, so that preprocessing allocates nothing once the
+    model is warm. Images already at the model input size are not resized.
+
     The following are the model output formats for the different model types:
 
         Bounding box models output format has shape [N x 7] defined by:
@@ -134,6 +170,10 @@ class AutoDetectModel(BaseModel):
             os.path.join(self._directory_, "predict.py")
         )
         self._model_format_ = next((x for x in MODEL_FORMATS if x in info_line), None)
+        try:
+            parse_onnx_options(self.kwargs)
+        except ValueError as e:
+            raise PortalError(Errors.INVALIDAPI, str(e)) from e
         self._load_label_map_()
         self._key_ = get_hash(self._directory_)
         return self._key_, self
@@ -141,14 +181,21 @@ class AutoDetectModel(BaseModel):
     def load(self):
         """Overloaded from Parent Class."""
         sys.path.append(self._directory_)
+        self._batch_supported_ = True
+        self._input_lock_ = threading.Lock()
         if self._model_type_ == "pytorch":
             import torch
 
             self._model_ = torch.load(self._model_path_)
         elif self._model_type_ == "onnx":
-            import onnxruntime as ort
-
-            self._model_ = ort.InferenceSession(self._model_path_)
+            options = parse_onnx_options(self.kwargs)
+            self._model_ = create_onnx_session(self._model_path_, options)
+            # the IO binding exposes the run method of the session
+            self._onnx_runner_ = (
+                OnnxIOBinding(self._model_) if options["io_binding"] else self._model_
+            )
+            # dynamic batch dimensions are named (str) or unknown (None)
+            self._batch_supported_ = self._model_.get_inputs()[0].shape[0] != 1
             if self._model_format_ == "instance":
                 self._input_name = self._model_.get_inputs()[0].name
                 model_outputs = self._model_.get_outputs()
@@ -157,9 +204,15 @@ class AutoDetectModel(BaseModel):
                 self._input_name = self._model_.get_inputs()[0].name
                 self._output_name = self._model_.get_outputs()[0].name
         elif self._model_type_ == "tflite":
+            import tensorflow as tf
+
+            # the signature runner only accepts the exported input shape
+            self._batch_supported_ = False
             interpreter = tf.lite.Interpreter(self._model_path_)
             self._model_ = interpreter.get_signature_runner()
         elif self._model_type_ == "tensorflow":
+            import tensorflow as tf
+
             loaded = tf.saved_model.load(self._model_path_)
             self._model_ = loaded.signatures["serving_default"]
             self._output_name = list(self._model_.structured_outputs.keys())[0]
@@ -168,42 +221,153 @@ class AutoDetectModel(BaseModel):
 
             self._model_ = YOLO(self._model_path_)
 
+    def unload(self):
+        """Overloaded from Parent Class."""
+        self._model_ = None
+        self._onnx_runner_ = None
+        self._input_tensor_ = None
+        self._resize_buffer_ = None
+
+    def _input_batch_(self, batch_size):
+        """Get the first batch_size inputs of the persistent input tensor.
+
+        :param batch_size: The number of inputs.
+        :return: A float32 view of shape [batch_size, height, width, 3].
+        """
+        tensor = getattr(self, "_input_tensor_", None)
+        if tensor is None or len(tensor) < batch_size:
+            tensor = np.empty(
+                (batch_size, self._height_, self._width_, 3), dtype=np.float32
+            )
+            self._input_tensor_ = tensor
+        return tensor[:batch_size]
+
+    def _preprocess_(self, image_array, model_input):
+        """Resize an RGB image array into a float32 model input.
+
+        :param image_array: The RGB image array, of any size.
+        :param model_input: The float32 array of shape [height, width, 3]
+            written with the model input.
+        """
+        height, width = image_array.shape[:2]
+        if (height, width) != (self._height_, self._width_):
+            buffer = getattr(self, "_resize_buffer_", None)
+            if buffer is None:
+                buffer = np.empty((self._height_, self._width_, 3), dtype=np.uint8)
+                self._resize_buffer_ = buffer
+            # area averaging when shrinking, as the antialiasing of PIL
+            interpolation = (
+                cv2.INTER_AREA
+                if height >= self._height_ and width >= self._width_
+                else cv2.INTER_CUBIC
+            )
+            image_array = cv2.resize(
+                image_array,
+                (self._width_, self._height_),
+                dst=buffer,
+                interpolation=interpolation,
+            )
+        np.copyto(model_input, image_array, casting="unsafe")
+
+    def _run_backend_(self, batch):
+        """Run the loaded backend on a batch of preprocessed inputs.
+
+        :param batch: Model inputs stacked into an array of shape
+            [batch_size, height, width, channels].
+        :return: List with the raw detections output of every input.
+        """
+        if self._model_type_ == "onnx":
+            return onnx_predict(
+                self._onnx_runner_,
+                self._model_format_,
+                self._input_name,
+                self._output_name,
+                batch,
+            )
+        if self._model_type_ == "tflite":
+            return tflite_predict(self._model_, self._model_format_, batch)
+        if self._model_type_ == "pytorch":
+            return torch_predict(self._model_, batch)
+        return tf_predict(self._model_, self._model_format_, self._output_name, batch)
+
     def predict(self, image_array):
         """Overloaded from Parent Class."""
+        return self.predict_batch([image_array])[0]
+
+    def predict_batch(self, image_arrays, top_k=None, score_threshold=None):
+        """Overloaded from Parent Class.
+
+        The whole batch is run in a single backend call, except for TFLite
+        models and models exported with a fixed batch size of 1, for which
+        the batch is run one input at a time.
+        """
+        if not image_arrays:
+            return []
         try:
             if self._model_type_ == "yolov8":
-                return yolov8_predict(
-                    self._model_, image_array, (self._height_, self._width_)
-                )
-            image_array = np.expand_dims(
-                np.array(
-                    Image.fromarray(image_array).resize((self._width_, self._height_))
-                ).astype(np.float32),
-                0,
-            )
-            if self._model_type_ == "onnx":
-                detections_output = onnx_predict(
-                    self._model_,
-                    self._model_format_,
-                    self._input_name,
-                    self._output_name,
-                    image_array,
-                )
-            elif self._model_type_ == "tflite":
-                detections_output = tflite_predict(
-                    self._model_, self._model_format_, image_array
+                start = time.perf_counter()
+                detections_outputs = yolov8_predict(
+                    self._model_, image_arrays, (self._height_, self._width_)
                 )
-            elif self._model_type_ == "pytorch":
-                detections_output = torch_predict(self._model_, image_array)
-            elif self._model_type_ == "tensorflow":
-                detections_output = tf_predict(
-                    self._model_, self._model_format_, self._output_name, image_array
-                )
-            return self.postprocess(detections_output)
+                inferred = time.perf_counter()
+                detections = [
+                    prefilter_detections(detections, top_k, score_threshold)
+                    for detections in detections_outputs
+                ]
+                self._record_timings_(start, start, inferred)
+                return detections
+            # the input tensor is reused by every prediction of the model
+            with self._input_lock_:
+                start = time.perf_counter()
+                inputs = self._input_batch_(len(image_arrays))
+                for image_array, model_input in zip(image_arrays, inputs):
+                    self._preprocess_(image_array, model_input)
+                preprocessed = time.perf_counter()
+                if len(inputs) > 1 and self._batch_supported_:
+                    try:
+                        detections_outputs = self._run_backend_(inputs)
+                    except Exception as e:  # pylint: disable=broad-except
+                        if not _is_batch_error(e):
+                            raise
+                        # the model does not accept batches, never try again.
+                        logger.warning(
+                            "Batched inference disabled for model %s: %s",
+                            self._name_,
+                            e,
+                        )
+                        self._batch_supported_ = False
+                if len(inputs) == 1 or not self._batch_supported_:
+                    detections_outputs = [
+                        self._run_backend_(inputs[index : index + 1])[0]
+                        for index in range(len(inputs))
+                    ]
+                inferred = time.perf_counter()
+            detections = [
+                self.postprocess(detections_output, top_k, score_threshold)
+                for detections_output in detections_outputs
+            ]
+            self._record_timings_(start, preprocessed, inferred)
+            return detections
         except Exception as e:
             raise PortalError(Errors.FAILEDPREDICTION, str(e)) from e
 
-    def postprocess(self, detections_output):
+    def _record_timings_(self, start, preprocessed, inferred):
+        """Record the stage timings of the last prediction, in milliseconds."""
+        end = time.perf_counter()
+        self._timings_ = {
+            "preprocessMs": round((preprocessed - start) * 1000, 2),
+            "inferenceMs": round((inferred - preprocessed) * 1000, 2),
+            "postprocessMs": round((end - inferred) * 1000, 2),
+        }
+
+    def postprocess(self, detections_output, top_k=None, score_threshold=None):
+        """Convert the raw output of the backend into a detections dictionary.
+
+        :param detections_output: The raw detections output of one input.
+        :param top_k: See select_detections.
+        :param score_threshold: See select_detections.
+        :return: The detections dictionary described in BaseModel.predict.
+        """
         detections = {}
         if self._model_format_ == "bounding box":
             # Filter detections
@@ -212,6 +376,7 @@ class AutoDetectModel(BaseModel):
             scores = output[:, 4]
             classes = output[:, 5]
             output = output[classes != 0]
+            output = output[select_detections(output[:, 4], top_k, score_threshold)]
 
             # Postprocess detections
             bboxes = output[:, :4]
@@ -220,25 +385,20 @@ class AutoDetectModel(BaseModel):
             detections["detection_masks"] = None
 
         elif self._model_format_ == "semantic":
-            mask_list, bbox_list, class_list, scores_list = get_polygons(
-                detections_output
-            )
-            bboxes = np.array(bbox_list)
-            classes = np.array(class_list)
-            masks = np.array(mask_list)
-            scores = np.array(scores_list)
-            detections["detection_masks"] = masks
+            masks, bboxes, classes, scores = get_polygons(detections_output)
+            keep = select_detections(scores, top_k, score_threshold)
+            bboxes, classes, scores = bboxes[keep], classes[keep], scores[keep]
+            detections["detection_masks"] = masks[keep]
 
         elif self._model_format_ == "instance":
             bboxes, masks, scores, classes = detections_output
-            scores = scores[0]
-            classes = classes[0].astype(np.int16)
-            bboxes = bboxes[0]
-            masks = masks[0]
-            image_masks = reframe_box_masks_to_image_masks(
-                tf.convert_to_tensor(masks), bboxes, self._height_, self._width_
+            # only reframe the masks of the detections that are kept
+            keep = select_detections(scores, top_k, score_threshold)
+            bboxes, masks, scores = bboxes[keep], masks[keep], scores[keep]
+            classes = classes[keep].astype(np.int16)
+            image_masks = get_binary_image_masks(
+                masks, bboxes, self._height_, self._width_
             )
-            image_masks = tf.cast(image_masks > 0.5, tf.uint8).numpy()
 
             detections["detection_masks"] = image_masks
 
@@ -14,16 +14,64 @@
 @Desc    :   Module containing the Darknet Model class.
 """
 import os
+import time
 
 import cv2
 import numpy as np
 from server.models.abstract.BaseModel import BaseModel
+from server.models.model_utils import prefilter_detections
 from server.services.errors import Errors, PortalError
 from server.services.hashing import get_hash
 
+# Backends and targets of cv2.dnn accepted in the "backend" and "target"
+# model kwargs. The ones missing from the OpenCV build are never available.
+DARKNET_BACKENDS = {
+    "opencv": "DNN_BACKEND_OPENCV",
+    "inference_engine": "DNN_BACKEND_INFERENCE_ENGINE",
+    "cuda": "DNN_BACKEND_CUDA",
+}
+DARKNET_TARGETS = {
+    "cpu": "DNN_TARGET_CPU",
+    "cpu_fp16": "DNN_TARGET_CPU_FP16",
+    "opencl": "DNN_TARGET_OPENCL",
+    "opencl_fp16": "DNN_TARGET_OPENCL_FP16",
+    "myriad": "DNN_TARGET_MYRIAD",
+    "cuda": "DNN_TARGET_CUDA",
+    "cuda_fp16": "DNN_TARGET_CUDA_FP16",
+}
+# Inferences timed for every backend and target by the "auto" backend,
+# after a first untimed one.
+AUTO_BACKEND_RUNS = 3
+
+
+def _available_backends() -> list:
+    """List the (backend, target) names available in the OpenCV build."""
+    available = []
+    for backend, backend_attr in DARKNET_BACKENDS.items():
+        if not hasattr(cv2.dnn, backend_attr):
+            continue
+        targets = cv2.dnn.getAvailableTargets(getattr(cv2.dnn, backend_attr))
+        for target, target_attr in DARKNET_TARGETS.items():
+            if getattr(cv2.dnn, target_attr, None) in targets:
+                available.append((backend, target))
+    return available
+
 
 class DarknetModel(BaseModel):
-    """Implementation of the Darknet Model."""
+    """Implementation of the Darknet Model.
+
+    The cv2.dnn backend and target are set with the "backend" and "target"
+    model kwargs, see DARKNET_BACKENDS and DARKNET_TARGETS, else the OpenCV
+    defaults are used. The "auto" backend times every available backend
+    and target at load and keeps the fastest. The backend in use is shown
+    in get_info().
+    """
+
+    def get_info(self):
+        """Overloaded from Parent Class."""
+        info = super().get_info()
+        info["backend"] = getattr(self, "_backend_", None)
+        return info
 
     def _load_label_map_(self):
         """Overloaded from Parent Class."""
@@ -90,6 +138,22 @@ class DarknetModel(BaseModel):
                         line.replace("=", "").replace("width", "").strip()
                     )
                     widthcheck = True
+        backend = self.kwargs.get("backend")
+        if (
+            backend is not None
+            and backend != "auto"
+            and backend not in DARKNET_BACKENDS
+        ):
+            raise PortalError(
+                Errors.INVALIDAPI,
+                f"backend should be one of auto, {', '.join(DARKNET_BACKENDS)}.",
+            )
+        target = self.kwargs.get("target")
+        if target is not None and target not in DARKNET_TARGETS:
+            raise PortalError(
+                Errors.INVALIDAPI,
+                f"target should be one of {', '.join(DARKNET_TARGETS)}.",
+            )
         self._load_label_map_()
         self._key_ = get_hash(self._directory_)
         return self._key_, self
@@ -97,47 +161,141 @@ class DarknetModel(BaseModel):
     def load(self):
         """Overloaded from Parent Class."""
         loaded_model = cv2.dnn.readNetFromDarknet(self._configname_, self._weightsname_)
+        # resolved once, getUnconnectedOutLayers returns flat or nested
+        # indices depending on the OpenCV version
+        self._output_layers_ = list(loaded_model.getUnconnectedOutLayersNames())
+        backend = self.kwargs.get("backend")
+        target = self.kwargs.get("target")
+        if backend == "auto":
+            self._backend_ = self._select_backend_(loaded_model)
+        elif backend is not None or target is not None:
+            backend = backend or "opencv"
+            target = target or "cpu"
+            if (backend, target) not in _available_backends():
+                raise PortalError(
+                    Errors.INVALIDAPI,
+                    f"backend {backend} with target {target} is not available "
+                    "in this OpenCV build.",
+                )
+            self._set_backend_(loaded_model, backend, target)
+            self._backend_ = {"backend": backend, "target": target}
+        else:
+            self._backend_ = {"backend": "default", "target": "default"}
         self._model_ = loaded_model
 
+    @staticmethod
+    def _set_backend_(model, backend, target):
+        """Set the preferable backend and target of the network."""
+        model.setPreferableBackend(getattr(cv2.dnn, DARKNET_BACKENDS[backend]))
+        model.setPreferableTarget(getattr(cv2.dnn, DARKNET_TARGETS[target]))
+
+    def _select_backend_(self, model):
+        """Time every available backend and target, and keep the fastest.
+
+        :param model: The network, set to the fastest backend and target.
+        :return: The backend and target kept, with the latency in
+            milliseconds of every one timed, or None if it failed.
+        """
+        blob = np.zeros((1, 3, self._height_, self._width_), dtype=np.float32)
+        latencies = {}
+        for backend, target in _available_backends():
+            try:
+                self._set_backend_(model, backend, target)
+                model.setInput(blob)
+                # the first inference initializes the backend
+                model.forward(self._output_layers_)
+                runs = []
+                for _ in range(AUTO_BACKEND_RUNS):
+                    start = time.perf_counter()
+                    model.setInput(blob)
+                    model.forward(self._output_layers_)
+                    runs.append((time.perf_counter() - start) * 1000)
+                latencies[f"{backend}/{target}"] = round(min(runs), 2)
+            except cv2.error:
+                latencies[f"{backend}/{target}"] = None
+        timed = {name: ms for name, ms in latencies.items() if ms is not None}
+        if not timed:
+            raise PortalError(
+                Errors.INVALIDAPI, "No cv2.dnn backend is available for the model."
+            )
+        backend, target = min(timed, key=timed.get).split("/")
+        self._set_backend_(model, backend, target)
+        return {"backend": backend, "target": target, "latencies": latencies}
+
+    def _decode_(self, layer_outputs, score_threshold=None):
+        """Decode the YOLO output rows of all layers into detections.
+
+        Every row is [centerX, centerY, width, height, objectness, scores...]
+        where the class scores are already scaled by the objectness, so rows
+        with an objectness below score_threshold cannot hold a detection
+        scoring above it and are dropped before the class scores are read.
+
+        :param layer_outputs: The outputs of the output layers.
+        :param score_threshold: The minimum score of the detections to keep,
+            None keeps every detection.
+        :return: The detections dictionary described in BaseModel.predict.
+        """
+        rows = np.concatenate(
+            [output.reshape(-1, output.shape[-1]) for output in layer_outputs]
+        )
+        if score_threshold is not None:
+            rows = rows[rows[:, 4] >= score_threshold]
+        class_ids = np.argmax(rows[:, 5:], axis=1)
+        confidences = rows[np.arange(len(rows)), 5 + class_ids]
+        if score_threshold is not None:
+            keep = confidences >= score_threshold
+            rows, class_ids, confidences = (
+                rows[keep],
+                class_ids[keep],
+                confidences[keep],
+            )
+        center_x, center_y, width, height = rows[:, :4].astype(np.float64).T
+        xmin = center_x - (width / 2)
+        ymin = center_y - (height / 2)
+        return {
+            "detection_masks": None,
+            "detection_boxes": np.stack(
+                [ymin, xmin, ymin + height, xmin + width], axis=1
+            ),
+            "detection_scores": confidences.astype(np.float64),
+            "detection_classes": class_ids,
+        }
+
+    def _forward_(self, image_array, score_threshold=None):
+        """Run the network on an image array and decode its output."""
+        blob = cv2.dnn.blobFromImage(
+            image_array,
+            1 / 255.0,
+            (self._height_, self._width_),
+            swapRB=True,
+            crop=False,
+        )
+        self._model_.setInput(blob)
+        return self._decode_(
+            self._model_.forward(self._output_layers_), score_threshold
+        )
+
     def predict(self, image_array):
         """Overloaded from Parent Class."""
         try:
-            model = self._model_
-            (H, W) = image_array.shape[:2]
-            ln = model.getLayerNames()
-            ln = [ln[i[0] - 1] for i in model.getUnconnectedOutLayers()]
-            blob = cv2.dnn.blobFromImage(
-                image_array,
-                1 / 255.0,
-                (self._height_, self._width_),
-                swapRB=True,
-                crop=False,
-            )
-            model.setInput(blob)
-            layerOutputs = model.forward(ln)
-            boxes = []
-            confidences = []
-            classIDs = []
-
-            for output in layerOutputs:
-                for detection in output:
-                    scores = detection[5:]
-                    classID = np.argmax(scores)
-                    confidence = scores[classID]
-                    box = detection[0:4]
-                    (centerX, centerY, width, height) = box
-                    xmin = centerX - (width / 2)
-                    ymin = centerY - (height / 2)
-                    xmax = xmin + width
-                    ymax = ymin + height
-                    boxes.append([ymin, xmin, ymax, xmax])
-                    confidences.append(float(confidence))
-                    classIDs.append(classID)
-            detections = {}
-            detections["detection_masks"] = None
-            detections["detection_boxes"] = np.squeeze(np.array(boxes))
-            detections["detection_scores"] = np.squeeze(np.array(confidences))
-            detections["detection_classes"] = np.squeeze(np.array(classIDs))
-            return detections
+            return self._forward_(image_array)
+        except Exception as e:
+            raise PortalError(Errors.FAILEDPREDICTION, str(e))
+
+    def predict_batch(self, image_arrays, top_k=None, score_threshold=None):
+        """Overloaded from Parent Class.
+
+        The score threshold is applied while decoding, ahead of reading the
+        class scores of every row.
+        """
+        try:
+            return [
+                prefilter_detections(
+                    self._forward_(image_array, score_threshold),
+                    top_k,
+                    score_threshold,
+                )
+                for image_array in image_arrays
+            ]
         except Exception as e:
             raise PortalError(Errors.FAILEDPREDICTION, str(e))
@@ -14,36 +14,228 @@
 @Desc    :   Module containing the Endpoint Model class.
 """
 import hashlib
-from base64 import encodebytes
+import threading
+import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 import requests
 from PIL import Image, ImageDraw
+from requests.adapters import HTTPAdapter
 from server.models.abstract.BaseModel import BaseModel
+from server.models.model_utils import prefilter_detections
 from server.services.errors import Errors, PortalError
+from urllib3.util.retry import Retry
+
+# Connection options accepted in the model kwargs, with their defaults.
+ENDPOINT_OPTIONS = {
+    # seconds to wait for the connection to the endpoint.
+    "connect_timeout": 5.0,
+    # seconds to wait for the response of the endpoint.
+    "read_timeout": 30.0,
+    # retries of the requests failing to connect or answered with
+    # ENDPOINT_RETRY_STATUSES, 0 to never retry.
+    "retries": 3,
+    # seconds of the exponential backoff between the retries.
+    "backoff": 0.5,
+    # requests in flight during the predictions of a batch.
+    "concurrency": 4,
+    # JPEG quality of the uploaded images, from 1 to 100.
+    "jpeg_quality": 95,
+    # [width, height] the uploaded images are downscaled to fit in, keeping
+    # their aspect ratio, such as the input size of the endpoint model.
+    # None uploads them at their own size.
+    "upload_size": None,
+    # "base64" sends the image in base64 JSON, "multipart" sends the raw
+    # JPEG bytes as multipart form data, for endpoints accepting it.
+    "upload_format": "base64",
+}
+ENDPOINT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+ENDPOINT_UPLOAD_FORMATS = ("base64", "multipart")
+
+
+def parse_endpoint_options(kwargs: dict) -> dict:
+    """Validate the connection options given in the model kwargs.
+
+    :param kwargs: The model kwargs, keys that are not connection options
+        are ignored.
+    :return: The connection options, with the defaults of the missing ones.
+    """
+    options = dict(ENDPOINT_OPTIONS)
+    options.update(
+        {key: value for key, value in kwargs.items() if key in ENDPOINT_OPTIONS}
+    )
+    for key in ("connect_timeout", "read_timeout", "backoff"):
+        value = options[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise PortalError(
+                Errors.INVALIDAPI, f"{key} should be a non negative number."
+            )
+    for key, minimum in (("retries", 0), ("concurrency", 1)):
+        value = options[key]
+        if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+            raise PortalError(
+                Errors.INVALIDAPI, f"{key} should be an integer of at least {minimum}."
+            )
+    quality = options["jpeg_quality"]
+    if (
+        isinstance(quality, bool)
+        or not isinstance(quality, int)
+        or not 1 <= quality <= 100
+    ):
+        raise PortalError(
+            Errors.INVALIDAPI, "jpeg_quality should be an integer from 1 to 100."
+        )
+    size = options["upload_size"]
+    if size is not None and (
+        not isinstance(size, (list, tuple))
+        or len(size) != 2
+        or any(
+            isinstance(dim, bool) or not isinstance(dim, int) or dim < 1 for dim in size
+        )
+    ):
+        raise PortalError(
+            Errors.INVALIDAPI,
+            "upload_size should be a [width, height] list of positive integers.",
+        )
+    if options["upload_format"] not in ENDPOINT_UPLOAD_FORMATS:
+        raise PortalError(
+            Errors.INVALIDAPI,
+            f"upload_format should be one of {', '.join(ENDPOINT_UPLOAD_FORMATS)}.",
+        )
+    return options
 
 
 class EndpointModel(BaseModel):
-    """Implementation of the Endpoint Model."""
+    """Implementation of the Endpoint Model.
+
+    Requests go through a session keeping the connections to the endpoint
+    alive, with the timeouts and retries given in the model kwargs (see
+    ENDPOINT_OPTIONS). The images of a batch are sent concurrently, with up
+    to "concurrency" requests in flight.
+
+    The images are uploaded as JPEG, optionally downscaled first. The
+    endpoint returns coordinates relative to the image size, so the
+    detections do not depend on the upload size. The bytes sent and
+    received and the latency of the predictions are shown in get_info().
+    """
+
+    def get_info(self):
+        """Overloaded from Parent Class."""
+        info = super().get_info()
+        with self._session_lock_:
+            transfer = dict(self._transfer_)
+        requests_sent = transfer["requests"]
+        if requests_sent:
+            transfer["meanBytesSent"] = round(transfer["bytesSent"] / requests_sent)
+            transfer["meanLatencyMs"] = round(transfer["latencyMs"] / requests_sent, 2)
+        info["transfer"] = transfer
+        return info
+
+    def _record_transfer_(self, sent, received, latency):
+        """Add the bytes on the wire and the latency of one prediction."""
+        with self._session_lock_:
+            transfer = self._transfer_
+            transfer["requests"] += 1
+            transfer["bytesSent"] += sent
+            transfer["bytesReceived"] += received
+            transfer["latencyMs"] += latency * 1000
+            transfer["lastBytesSent"] = sent
+            transfer["lastLatencyMs"] = round(latency * 1000, 2)
+
+    def _encode_(self, image_array):
+        """Encode a BGR image array into the JPEG bytes uploaded."""
+        upload_size = self._options_["upload_size"]
+        if upload_size is not None:
+            height, width = image_array.shape[:2]
+            scale = min(upload_size[0] / width, upload_size[1] / height)
+            if scale < 1:
+                image_array = cv2.resize(
+                    image_array,
+                    (max(1, round(width * scale)), max(1, round(height * scale))),
+                    interpolation=cv2.INTER_AREA,
+                )
+        _, bts = cv2.imencode(
+            ".jpg",
+            image_array,
+            [cv2.IMWRITE_JPEG_QUALITY, self._options_["jpeg_quality"]],
+        )
+        return bts.tobytes()
+
+    def _session_(self):
+        """Get the session of the endpoint, creating it if needed.
+
+        Must be called with _session_lock_ held.
+        """
+        if self._http_ is None:
+            retry = Retry(
+                total=self._options_["retries"],
+                backoff_factor=self._options_["backoff"],
+                status_forcelist=ENDPOINT_RETRY_STATUSES,
+                allowed_methods=frozenset({"GET", "POST"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self._options_["concurrency"],
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Authorization"] = "Bearer " + self.kwargs["project_secret"]
+            self._http_ = session
+        return self._http_
+
+    def _request_(self, method, link, **kwargs):
+        """Send a request to the endpoint through its session.
+
+        Throws PortalError Errors.ENDPOINTFAILED if the endpoint cannot be
+        reached or does not answer with 200.
+        """
+        with self._session_lock_:
+            session = self._session_()
+            self._in_flight_ += 1
+        try:
+            response = session.request(
+                method,
+                link,
+                timeout=(
+                    self._options_["connect_timeout"],
+                    self._options_["read_timeout"],
+                ),
+                **kwargs,
+            )
+        except requests.RequestException as e:
+            raise PortalError(
+                Errors.ENDPOINTFAILED, f"Could not reach the endpoint: {e}"
+            ) from e
+        finally:
+            with self._session_lock_:
+                self._in_flight_ -= 1
+                self._session_idle_.notify_all()
+        if response.status_code != 200:
+            raise PortalError(
+                Errors.ENDPOINTFAILED,
+                f"The endpoint answered with status {response.status_code}.",
+            )
+        return response
 
     def _load_label_map_(self):
         """Overloaded from Parent Class."""
         index = self.kwargs["link"].rfind("/predict")
         link = self.kwargs["link"][:index] + "/classes"
-        project_secret = self.kwargs["project_secret"]
-        headers = {"Authorization": "Bearer " + project_secret}
-        response = requests.get(
-            url=link,
-            headers=headers,
-        )
-        if response.status_code != 200:
+        try:
+            response = self._request_("GET", link)
+        except PortalError as e:
             raise PortalError(
                 Errors.ENDPOINTFAILED,
                 "Could not load the endpoint label map. "
                 "This could signify that the endpoint is "
                 "corrupted or simply not present.",
-            )
+            ) from e
         label_map = response.json()
         self._label_map_ = {}
         for id, dct in label_map.items():
@@ -52,6 +244,21 @@ class EndpointModel(BaseModel):
 
     def register(self):
         """Overloaded from Parent Class."""
+        self._options_ = parse_endpoint_options(self.kwargs)
+        self._session_lock_ = threading.Lock()
+        # notified when a request completes, see unload
+        self._session_idle_ = threading.Condition(self._session_lock_)
+        self._in_flight_ = 0
+        self._http_ = None
+        self._executor_ = None
+        self._transfer_ = {
+            "requests": 0,
+            "bytesSent": 0,
+            "bytesReceived": 0,
+            "latencyMs": 0.0,
+            "lastBytesSent": None,
+            "lastLatencyMs": None,
+        }
         self._load_label_map_()
         link = self.kwargs["link"]
         project_secret = self.kwargs["project_secret"]
@@ -65,6 +272,28 @@ class EndpointModel(BaseModel):
         """Overloaded from Parent Class."""
         pass
 
+    def unload(self):
+        """Overloaded from Parent Class.
+
+        Closes the connections to the endpoint, they are opened again by the
+        next request. The predictions in progress are completed first.
+        """
+        with self._session_lock_:
+            executor, self._executor_ = self._executor_, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._session_lock_:
+            self._session_idle_.wait_for(lambda: self._in_flight_ == 0)
+            if self._http_ is not None:
+                self._http_.close()
+                self._http_ = None
+
+    def warmup(self, runs=3):
+        """Overloaded from Parent Class.
+
+        Endpoints are not loaded locally, and their predictions are billed.
+        """
+
     def predict(self, image_array):
         """Overloaded from Parent Class."""
         # convert potential rgba to rgb:
@@ -77,20 +306,27 @@ class EndpointModel(BaseModel):
             if channels == 4
             else cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
         )
-        _, bts = cv2.imencode(".jpg", image_array)
-        base64_array = {
-            "data": encodebytes(bts.tostring()).decode("ascii"),
-            "image_type": "base_64",
-        }
-        link = self.kwargs["link"]
-        project_secret = self.kwargs["project_secret"]
-        headers = {"Authorization": "Bearer " + project_secret}
-        response = requests.post(
-            url=link,
-            json=base64_array,
-            headers=headers,
-        )
+        start = time.perf_counter()
+        jpeg = self._encode_(image_array)
+        if self._options_["upload_format"] == "multipart":
+            upload = {
+                "data": {"image_type": "binary"},
+                "files": {"data": ("image.jpg", jpeg, "image/jpeg")},
+            }
+        else:
+            upload = {
+                "json": {
+                    "data": b64encode(jpeg).decode("ascii"),
+                    "image_type": "base_64",
+                }
+            }
+        response = self._request_("POST", self.kwargs["link"], **upload)
         output = response.json()
+        self._record_transfer_(
+            len(response.request.body or b""),
+            len(response.content),
+            time.perf_counter() - start,
+        )
 
         # convert output into the tensor required by the BaseModel predict
         boxes = []
@@ -144,3 +380,24 @@ class EndpointModel(BaseModel):
         detections["detection_scores"] = np.squeeze(np.array(scores))
         detections["detection_classes"] = np.squeeze(np.array(classes))
         return detections
+
+    def predict_batch(self, image_arrays, top_k=None, score_threshold=None):
+        """Overloaded from Parent Class.
+
+        The images are sent concurrently, with up to "concurrency" requests
+        in flight, and their detections returned in order.
+        """
+        if len(image_arrays) <= 1 or self._options_["concurrency"] == 1:
+            return super().predict_batch(image_arrays, top_k, score_threshold)
+        # submitted under the lock, so that unload waits for all of them
+        with self._session_lock_:
+            if self._executor_ is None:
+                self._executor_ = ThreadPoolExecutor(self._options_["concurrency"])
+            futures = [
+                self._executor_.submit(self.predict, image_array)
+                for image_array in image_arrays
+            ]
+        return [
+            prefilter_detections(future.result(), top_k, score_threshold)
+            for future in futures
+        ]
@@ -13,6 +13,11 @@
 @License :   Apache License 2.0
 @Desc    :   Model utilities init file.
 """
+from .onnx_runtime import (  # noqa: F401
+    OnnxIOBinding,
+    create_onnx_session,
+    parse_onnx_options,
+)
 from .predict import (  # noqa: F401
     onnx_predict,
     tf_predict,
@@ -22,8 +27,11 @@ from .predict import (  # noqa: F401
 )
 from .utils import (  # noqa: F401
     MODEL_FORMATS,
+    get_binary_image_masks,
     get_polygons,
     infer_input_details,
     infer_model_type_and_path,
+    prefilter_detections,
     reframe_box_masks_to_image_masks,
+    select_detections,
 )
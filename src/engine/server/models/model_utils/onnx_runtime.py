@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   onnx_runtime.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   ONNX Runtime session options and IO binding.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# Session options accepted in the model kwargs, with their defaults. None
+# keeps the ONNX Runtime default.
+ONNX_SESSION_OPTIONS = {
+    # threads running one operator, 0 lets ONNX Runtime decide.
+    "intra_op_threads": None,
+    # threads running independent operators in the parallel execution mode.
+    "inter_op_threads": None,
+    # "sequential" or "parallel".
+    "execution_mode": None,
+    # "disable", "basic", "extended" or "all".
+    "graph_optimization": None,
+    # save the optimized model in the cache folder, later loads skip the
+    # graph optimizations.
+    "optimized_model_cache": False,
+    "enable_mem_pattern": None,
+    "enable_cpu_mem_arena": None,
+    # run through an IO binding reusing the same input and output buffers.
+    "io_binding": False,
+}
+
+_EXECUTION_MODES = {"sequential": "ORT_SEQUENTIAL", "parallel": "ORT_PARALLEL"}
+_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def parse_onnx_options(kwargs: dict) -> dict:
+    """Validates the ONNX Runtime options given in the model kwargs.
+
+    Args:
+        kwargs: The model kwargs, keys that are not session options are
+                ignored.
+
+    Returns:
+        The session options, with the defaults of the missing ones.
+
+    Raises:
+        ValueError: If an option has an invalid value.
+    """
+    options = dict(ONNX_SESSION_OPTIONS)
+    options.update(
+        {key: value for key, value in kwargs.items() if key in ONNX_SESSION_OPTIONS}
+    )
+    for key in ("intra_op_threads", "inter_op_threads"):
+        value = options[key]
+        if value is not None and (
+            isinstance(value, bool) or not isinstance(value, int) or value < 0
+        ):
+            raise ValueError(f"{key} should be a non negative integer.")
+    for key, allowed in (
+        ("execution_mode", _EXECUTION_MODES),
+        ("graph_optimization", _GRAPH_OPTIMIZATION_LEVELS),
+    ):
+        if options[key] is not None and options[key] not in allowed:
+            raise ValueError(f"{key} should be one of {', '.join(allowed)}.")
+    for key in (
+        "optimized_model_cache",
+        "enable_mem_pattern",
+        "enable_cpu_mem_arena",
+        "io_binding",
+    ):
+        if options[key] is not None and not isinstance(options[key], bool):
+            raise ValueError(f"{key} should be a boolean.")
+    return options
+
+
+def _optimized_model_path(model_path: str, options: dict) -> str:
+    """Path of the optimized model cached for a model file and its options.
+
+    The name changes with the model file and the options, so that stale
+    optimized models are never loaded.
+    """
+    stat = os.stat(model_path)
+    signature = json.dumps(
+        [
+            os.path.abspath(model_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            options["graph_optimization"],
+        ]
+    )
+    cache_folder = os.path.join(
+        os.path.dirname(os.getenv("CACHE_DIR", os.path.join("server", "cache", "_"))),
+        "onnx",
+    )
+    os.makedirs(cache_folder, exist_ok=True)
+    return os.path.join(
+        cache_folder, hashlib.md5(signature.encode()).hexdigest() + ".onnx"
+    )
+
+
+def create_onnx_session(model_path: str, options: dict):
+    """Creates an ONNX Runtime inference session.
+
+    Args:
+        model_path: Path of the ONNX model.
+        options: The session options returned by parse_onnx_options.
+
+    Returns:
+        The inference session.
+    """
+    # pylint: disable=import-outside-toplevel
+    import onnxruntime as ort
+
+    session_options = ort.SessionOptions()
+    if options["intra_op_threads"] is not None:
+        session_options.intra_op_num_threads = options["intra_op_threads"]
+    if options["inter_op_threads"] is not None:
+        session_options.inter_op_num_threads = options["inter_op_threads"]
+    if options["execution_mode"] is not None:
+        session_options.execution_mode = getattr(
+            ort.ExecutionMode, _EXECUTION_MODES[options["execution_mode"]]
+        )
+    if options["graph_optimization"] is not None:
+        session_options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel,
+            _GRAPH_OPTIMIZATION_LEVELS[options["graph_optimization"]],
+        )
+    if options["enable_mem_pattern"] is not None:
+        session_options.enable_mem_pattern = options["enable_mem_pattern"]
+    if options["enable_cpu_mem_arena"] is not None:
+        session_options.enable_cpu_mem_arena = options["enable_cpu_mem_arena"]
+    if options["optimized_model_cache"]:
+        optimized_path = _optimized_model_path(model_path, options)
+        if os.path.isfile(optimized_path):
+            # already optimized, do not run the optimizations again
+            model_path = optimized_path
+            session_options.graph_optimization_level = (
+                ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            )
+        else:
+            session_options.optimized_model_filepath = optimized_path
+    return ort.InferenceSession(model_path, session_options)
+
+
+class OnnxIOBinding:
+    """Runs an inference session through an IO binding.
+
+    The inputs are copied into buffers allocated once per input shape, on
+    the device of the session, and stay bound between runs. The float
+    outputs of static shape are written into buffers allocated once, the
+    other outputs, whose shape can change from one run to the next, are
+    allocated by the session on its device. It exposes the same run method
+    as the session, so it can be used in its place.
+    """
+
+    def __init__(self, session):
+        """Initializes the OnnxIOBinding class.
+
+        Args:
+            session: The ONNX Runtime inference session.
+        """
+        # pylint: disable=import-outside-toplevel
+        import onnxruntime as ort
+
+        self._ort_ = ort
+        self._session_ = session
+        self._binding_ = session.io_binding()
+        self._device_ = (
+            "cuda" if "CUDAExecutionProvider" in session.get_providers() else "cpu"
+        )
+        self._inputs_ = {}
+        self._outputs_ = {
+            output.name: ort.OrtValue.ortvalue_from_shape_and_type(
+                output.shape, np.float32, self._device_, 0
+            )
+            for output in session.get_outputs()
+            if output.type == "tensor(float)"
+            and all(isinstance(dim, int) for dim in output.shape)
+        }
+        self._lock_ = threading.Lock()
+
+    def _bind_input_(self, name: str, array: np.ndarray) -> None:
+        """Copies an input into its buffer, allocating it for a new shape."""
+        layout = (array.shape, array.dtype)
+        if name not in self._inputs_ or self._inputs_[name][0] != layout:
+            buffer = self._ort_.OrtValue.ortvalue_from_shape_and_type(
+                array.shape, array.dtype, self._device_, 0
+            )
+            self._binding_.bind_ortvalue_input(name, buffer)
+            self._inputs_[name] = (layout, buffer)
+        self._inputs_[name][1].update_inplace(np.ascontiguousarray(array))
+
+    def _bind_outputs_(self, output_names: list) -> None:
+        """Binds the outputs to their buffers, or to the session device."""
+        self._binding_.clear_binding_outputs()
+        for name in output_names:
+            if name in self._outputs_:
+                self._binding_.bind_ortvalue_output(name, self._outputs_[name])
+            else:
+                self._binding_.bind_output(name, self._device_)
+
+    def run(self, output_names: list, input_feed: dict) -> list:
+        """Runs the session, see InferenceSession.run.
+
+        Args:
+            output_names: Names of the outputs.
+            input_feed: Dictionary of the input names to their arrays.
+
+        Returns:
+            List of the output arrays, copied out of the bound buffers.
+        """
+        with self._lock_:
+            for name, array in input_feed.items():
+                self._bind_input_(name, array)
+            self._bind_outputs_(output_names)
+            self._session_.run_with_iobinding(self._binding_)
+            return self._binding_.copy_outputs_to_cpu()
@@ -1,37 +1,46 @@
 import numpy as np
 
 
-def yolov8_predict(model, image_array, input_size):
+def yolov8_predict(model, image_arrays, input_size):
     """Prediction function for YOLOv8.
 
     Args:
         model: YOLOV8 model.
-        image_array: Image ndarray to predict on.
+        image_arrays: List of image ndarrays to predict on.
         input_size: A tuple of (height, width) specifying the
                     input size of the model.
 
     Returns:
-        A dictionary of detections containing bounding boxes, classes,
-        scores and masks (if task is segmentation else None).
+        A list with one dictionary of detections per image, containing
+        bounding boxes, classes, scores and masks (if task is segmentation
+        else None).
     """
-    detections = {}
-    detections_output = model.predict(image_array,
-                                      imgsz=input_size,
-                                      conf=0.0,
-                                      verbose=False)
-    detections_output = detections_output[0]
-    boxes = detections_output.boxes.xyxyn.numpy()
-    boxes = boxes[:, [1, 0, 3, 2]]
-    classes = detections_output.boxes.cls.numpy()
-    scores = detections_output.boxes.conf.numpy()
-    masks = detections_output.masks.data.numpy(
-    ) if detections_output.masks is not None else None
-
-    detections["detection_boxes"] = boxes
-    detections["detection_classes"] = classes
-    detections["detection_scores"] = scores
-    detections["detection_masks"] = masks
-    return detections
+    detections_outputs = model.predict(list(image_arrays),
+                                       imgsz=input_size,
+                                       conf=0.0,
+                                       verbose=False)
+    detections_list = []
+    for detections_output in detections_outputs:
+        detections = {}
+        boxes = detections_output.boxes.xyxyn.numpy()
+        boxes = boxes[:, [1, 0, 3, 2]]
+        classes = detections_output.boxes.cls.numpy()
+        scores = detections_output.boxes.conf.numpy()
+        masks = detections_output.masks.data.numpy(
+        ) if detections_output.masks is not None else None
+
+        detections["detection_boxes"] = boxes
+        detections["detection_classes"] = classes
+        detections["detection_scores"] = scores
+        detections["detection_masks"] = masks
+        detections_list.append(detections)
+    return detections_list
+
+
+def _split_instance_batch(bboxes, masks, scores, classes):
+    """Split batched instance segmentation outputs into per-image tuples."""
+    return [(bboxes[index], masks[index], scores[index], classes[index])
+            for index in range(len(scores))]
 
 
 def onnx_predict(model, model_format, input_name, output_name, image_array):
@@ -42,19 +51,17 @@ def onnx_predict(model, model_format, input_name, output_name, image_array):
         model_format: Model format of the model.
         input_name: Name of the input tensor.
         output_name: Name of the output tensor.
-        image_array: Image ndarray to predict on.
+        image_array: Batch of images as an ndarray to predict on.
 
     Returns:
-        A tensor of output detections.
+        A list with the output detections of every image in the batch.
     """
     if model_format == "instance":
         detections_output = model.run(output_name, {input_name: image_array})
         _, scores, classes, bboxes, masks = detections_output
-        detections_output = bboxes, masks, scores, classes
-    else:
-        detections_output = model.run([output_name], {input_name: image_array})
-        detections_output = detections_output[0][0]
-    return detections_output
+        return _split_instance_batch(bboxes, masks, scores, classes)
+    detections_output = model.run([output_name], {input_name: image_array})
+    return list(detections_output[0])
 
 
 def tflite_predict(model, model_format, image_array):
@@ -63,10 +70,10 @@ def tflite_predict(model, model_format, image_array):
     Args:
         model: TFLite model.
         model_format: Model format of the model.
-        image_array: Image ndarray to predict on.
+        image_array: Batch of a single image as an ndarray to predict on.
 
     Returns:
-        A tensor of output detections.
+        A list with the output detections of the image.
     """
     detections_output = model(inputs=image_array)
     if model_format == "bounding box":
@@ -82,12 +89,12 @@ def tflite_predict(model, model_format, image_array):
         classes = np.array(detections_output["output_2"]).astype(np.int16)
         bboxes = np.array(detections_output["output_3"])
         masks = np.array(detections_output["output_4"])
-        detections_output = bboxes, masks, scores, classes
+        return _split_instance_batch(bboxes, masks, scores, classes)
     elif model_format == "semantic":
         detections_output = detections_output["output"][0]
     else:
         raise ValueError(model_format)
-    return detections_output
+    return [detections_output]
 
 
 def torch_predict(model, image_array):
@@ -95,15 +102,15 @@ def torch_predict(model, image_array):
 
     Args:
         model: PyTorch model.
-        image_array: Image ndarray to predict on.
+        image_array: Batch of images as an ndarray to predict on.
 
     Returns:
-        A tensor of output detections.
+        A list with the output detections of every image in the batch.
     """
     import torch
-    detections_output = model(torch.Tensor(image_array))
-    detections_output = detections_output[0].detach().numpy()
-    return detections_output
+    with torch.no_grad():
+        detections_output = model(torch.from_numpy(image_array))
+    return list(detections_output.detach().numpy())
 
 
 def tf_predict(model, model_format, output_name, image_array):
@@ -113,10 +120,10 @@ def tf_predict(model, model_format, output_name, image_array):
         model: TensorFlow model.
         model_format: Model format of the model.
         output_name: Name of the output tensor.
-        image_array: Image ndarray to predict on.
+        image_array: Batch of images as an ndarray to predict on.
 
     Returns:
-        A tensor of output detections.
+        A list with the output detections of every image in the batch.
     """
     detections_output = model(inputs=image_array)
     if model_format == "instance":
@@ -124,7 +131,5 @@ def tf_predict(model, model_format, output_name, image_array):
         masks = detections_output["output_4"].numpy()
         scores = detections_output["output_1"].numpy()
         classes = detections_output["output_2"].numpy().astype(np.int16)
-        detections_output = bboxes, masks, scores, classes
-    else:
-        detections_output = np.array(detections_output[output_name][0])
-    return detections_output
+        return _split_instance_batch(bboxes, masks, scores, classes)
+    return list(np.array(detections_output[output_name]))
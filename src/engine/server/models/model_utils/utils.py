@@ -15,11 +15,10 @@
 """
 import ast
 import os
-from typing import List, Tuple
+from typing import Optional, Tuple
 
 import cv2
 import numpy as np
-import tensorflow as tf
 from server.services.errors import Errors, PortalError
 
 MODEL_TYPES = {
@@ -80,15 +79,148 @@ def infer_input_details(prediction_script):
         return height, width, info_line
 
 
+def select_detections(
+    scores: np.ndarray,
+    top_k: Optional[int] = None,
+    score_threshold: Optional[float] = None,
+) -> np.ndarray:
+    """Selects the detections to be kept ahead of non max suppression.
+
+    The score threshold is applied the same way as in non max suppression,
+    so it only drops detections that would have been filtered out anyway.
+
+    Args:
+        scores: The detection scores.
+        top_k: The maximum number of detections to keep, the highest scoring
+               ones being kept. None keeps every detection.
+        score_threshold: The minimum score of the detections to keep.
+                         None keeps every detection.
+
+    Returns:
+        The indices of the selected detections, in their original order.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if score_threshold is None:
+        indices = np.arange(len(scores))
+    else:
+        indices = np.flatnonzero(scores >= score_threshold)
+    if top_k is not None and indices.size > top_k:
+        top = np.argsort(-scores[indices], kind="stable")[:top_k]
+        indices = np.sort(indices[top])
+    return indices
+
+
+def prefilter_detections(
+    detections: dict,
+    top_k: Optional[int] = None,
+    score_threshold: Optional[float] = None,
+) -> dict:
+    """Applies select_detections on the output dictionary of a model.
+
+    Args:
+        detections: The detections dictionary returned by a model predict.
+        top_k: See select_detections.
+        score_threshold: See select_detections.
+
+    Returns:
+        The detections dictionary restricted to the selected detections.
+    """
+    if top_k is None and score_threshold is None:
+        return detections
+    keep = select_detections(detections["detection_scores"], top_k, score_threshold)
+    for key in (
+        "detection_boxes",
+        "detection_scores",
+        "detection_classes",
+        "detection_masks",
+    ):
+        if detections.get(key) is not None:
+            detections[key] = np.asarray(detections[key])[keep]
+    return detections
+
+
+def _crop_and_resize_coordinates(start, end, box_size, image_size):
+    """Computes where the image pixels along one axis sample a box mask.
+
+    Follows the sampling of tf.image.crop_and_resize in float32, with the
+    "crop" being the image and the "image" being the box mask. The image
+    pixels sampling outside of the box mask are extrapolated to 0, so only
+    the contiguous range of pixels inside the box mask is returned.
+
+    Args:
+      start: The image start relative to the box (float32).
+      end: The image end relative to the box (float32).
+      box_size: The size of the box mask along the axis.
+      image_size: The size of the image along the axis.
+
+    Returns:
+      Tuple of the index of the first image pixel inside the box mask and
+      the float32 box mask coordinates of the image pixels inside it.
+    """
+    if image_size > 1:
+        scale = (end - start) * np.float32(box_size - 1) / np.float32(image_size - 1)
+        coordinates = start * np.float32(box_size - 1) + (
+            np.arange(image_size, dtype=np.float32) * scale
+        )
+    else:
+        coordinates = np.array(
+            [0.5 * np.float64(start + end) * (box_size - 1)], dtype=np.float32
+        )
+    inside = np.flatnonzero((coordinates >= 0) & (coordinates <= box_size - 1))
+    if inside.size == 0:
+        return 0, coordinates[:0]
+    return inside[0], coordinates[inside[0] : inside[-1] + 1]
+
+
+def _resize_box_mask(box_mask, row_coordinates, col_coordinates, resize_method):
+    """Samples a box mask at the given coordinates.
+
+    Args:
+      box_mask: An array of size [mask_height, mask_width].
+      row_coordinates: The float32 row coordinates to sample.
+      col_coordinates: The float32 column coordinates to sample.
+      resize_method: The resize method, either 'bilinear' or 'nearest'.
+
+    Returns:
+      A float32 array of size [len(row_coordinates), len(col_coordinates)].
+    """
+    box_mask = box_mask.astype(np.float32)
+    if resize_method == "nearest":
+        # rounded half away from zero, like roundf
+        rows = np.floor(row_coordinates.astype(np.float64) + 0.5).astype(np.intp)
+        cols = np.floor(col_coordinates.astype(np.float64) + 0.5).astype(np.intp)
+        return box_mask[rows][:, cols]
+    top = np.floor(row_coordinates)
+    left = np.floor(col_coordinates)
+    y_lerp = (row_coordinates - top)[:, np.newaxis]
+    x_lerp = col_coordinates - left
+    top_rows = box_mask[top.astype(np.intp)]
+    bottom_rows = box_mask[np.ceil(row_coordinates).astype(np.intp)]
+    left_cols = left.astype(np.intp)
+    right_cols = np.ceil(col_coordinates).astype(np.intp)
+    top_left, top_right = top_rows[:, left_cols], top_rows[:, right_cols]
+    bottom_left, bottom_right = bottom_rows[:, left_cols], bottom_rows[:, right_cols]
+    top_values = top_left + (top_right - top_left) * x_lerp
+    bottom_values = bottom_left + (bottom_right - bottom_left) * x_lerp
+    return top_values + (bottom_values - top_values) * y_lerp
+
+
 def reframe_box_masks_to_image_masks(
-    box_masks, boxes, image_height, image_width, resize_method="bilinear"
+    box_masks,
+    boxes,
+    image_height,
+    image_width,
+    resize_method="bilinear",
+    return_roi=False,
 ):
     """Transforms the box masks back to full image masks.
     Embeds masks in bounding boxes of larger masks whose shapes correspond to
-    image shape.
+    image shape. Equivalent to the tf.image.crop_and_resize of every box mask
+    over the image, but every box mask is only resized over the image region
+    (ROI) covered by its box.
     Args:
-      box_masks: A tensor of size [num_masks, mask_height, mask_width].
-      boxes: A tf.float32 tensor of size [num_masks, 4] containing the box
+      box_masks: An array of size [num_masks, mask_height, mask_width].
+      boxes: A float32 array of size [num_masks, 4] containing the box
              corners. Row i contains [ymin, xmin, ymax, xmax] of the box
              corresponding to mask i. Note that the box corners are in
              normalized coordinates.
@@ -99,104 +231,136 @@ def reframe_box_masks_to_image_masks(
       resize_method: The resize method, either 'bilinear' or 'nearest'.
                      Note that 'bilinear' is only respected if box_masks
                      is a float.
+      return_roi: Return the resized box masks cropped to their ROI instead
+                  of full image masks.
     Returns:
-      A tensor of size [num_masks, image_height, image_width]
-      with the same dtype as `box_masks`.
+      An array of size [num_masks, image_height, image_width]
+      with the same dtype as `box_masks`. If return_roi is set, a list with
+      a tuple (roi_mask, (top, left)) per box mask instead, where roi_mask
+      is the part of the image mask starting at row top and column left,
+      outside of which the image mask is 0.
     """
-    resize_method = "nearest" if box_masks.dtype == tf.uint8 else resize_method
-
-    def __reframe_box_masks_to_image_masks_default():
-        """The default function when there are more than 0 box masks."""
-
-        def transform_boxes_relative_to_boxes(boxes, reference_boxes):
-            boxes = tf.reshape(boxes, [-1, 2, 2])
-            min_corner = tf.expand_dims(reference_boxes[:, 0:2], 1)
-            max_corner = tf.expand_dims(reference_boxes[:, 2:4], 1)
-            denom = max_corner - min_corner
-            # Prevent a divide by zero.
-            denom = tf.math.maximum(denom, 1e-4)
-            transformed_boxes = (boxes - min_corner) / denom
-            return tf.reshape(transformed_boxes, [-1, 4])
-
-        box_masks_expanded = tf.expand_dims(box_masks, axis=3)
-        num_boxes = tf.shape(box_masks_expanded)[0]
-        unit_boxes = tf.concat([tf.zeros([num_boxes, 2]), tf.ones([num_boxes, 2])], 1)
-        reverse_boxes = transform_boxes_relative_to_boxes(unit_boxes, boxes)
-
-        resized_crops = tf.image.crop_and_resize(
-            box_masks_expanded,
-            reverse_boxes,
-            tf.range(num_boxes),
-            [image_height, image_width],
-            method=resize_method,
-            extrapolation_value=0,
+    box_masks = np.asarray(box_masks)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    resize_method = "nearest" if box_masks.dtype == np.uint8 else resize_method
+    # boxes of the image relative to the boxes, the denominator being
+    # clipped to prevent a divide by zero.
+    denom = np.maximum(boxes[:, 2:] - boxes[:, :2], np.float32(1e-4))
+    image_starts = (np.float32(0) - boxes[:, :2]) / denom
+    image_ends = (np.float32(1) - boxes[:, :2]) / denom
+
+    roi_masks = []
+    for box_mask, image_start, image_end in zip(box_masks, image_starts, image_ends):
+        top, row_coordinates = _crop_and_resize_coordinates(
+            image_start[0], image_end[0], box_mask.shape[0], image_height
+        )
+        left, col_coordinates = _crop_and_resize_coordinates(
+            image_start[1], image_end[1], box_mask.shape[1], image_width
+        )
+        roi_mask = _resize_box_mask(
+            box_mask, row_coordinates, col_coordinates, resize_method
+        )
+        roi_masks.append((roi_mask.astype(box_masks.dtype), (top, left)))
+    if return_roi:
+        return roi_masks
+
+    image_masks = np.zeros((len(roi_masks), image_height, image_width), box_masks.dtype)
+    for image_mask, (roi_mask, (top, left)) in zip(image_masks, roi_masks):
+        image_mask[top : top + roi_mask.shape[0], left : left + roi_mask.shape[1]] = (
+            roi_mask
         )
-        return tf.cast(resized_crops, box_masks.dtype)
+    return image_masks
 
-    image_masks = tf.cond(
-        tf.shape(box_masks)[0] > 0,
-        __reframe_box_masks_to_image_masks_default,
-        lambda: tf.zeros([0, image_height, image_width, 1], box_masks.dtype),
+
+def get_binary_image_masks(box_masks, boxes, image_height, image_width, threshold=0.5):
+    """Reframes the box masks into binary full image masks.
+    Args:
+      box_masks: See reframe_box_masks_to_image_masks.
+      boxes: See reframe_box_masks_to_image_masks.
+      image_height: Image height.
+      image_width: Image width.
+      threshold: The (non negative) value above which a pixel is set.
+    Returns:
+      A uint8 array of size [num_masks, image_height, image_width].
+    """
+    roi_masks = reframe_box_masks_to_image_masks(
+        box_masks, boxes, image_height, image_width, return_roi=True
     )
-    return tf.squeeze(image_masks, axis=3)
+    image_masks = np.zeros((len(roi_masks), image_height, image_width), np.uint8)
+    for image_mask, (roi_mask, (top, left)) in zip(image_masks, roi_masks):
+        image_mask[top : top + roi_mask.shape[0], left : left + roi_mask.shape[1]] = (
+            roi_mask > threshold
+        )
+    return image_masks
 
 
 def get_polygons(
     mask: np.ndarray,
-) -> Tuple[List[np.ndarray], List[List[float]], List[int], List[float]]:
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """Convert AutoDetect Model semantic segmentation output to polygons.
 
+    Every 8-connected component of at least 2 pixels of a class becomes an
+    instance, scored with the average normalized probability of its pixels.
+
     Arguments:
         mask:   Probability map with shape [num_classes, height, width].
 
     Return:
-        Tuple containing polygon masks and their respective bounding boxes,
-        labels and confidences.
+        Tuple containing the uint8 instance masks with shape
+        [num_instances, height, width] and their respective bounding boxes
+        (in normalized [ymin, xmin, ymax, xmax] format), labels and
+        confidences.
 
     NOTE: num_classes includes the background class indexed at 0.
           This will be filtered out within this function.
     """
     height = mask.shape[1]
     width = mask.shape[2]
-    mask_list = []
+    roi_list = []
     class_list = []
     scores_list = []
     bbox_list = []
-    # Step 2: for each class mask, convert to polygons
     normalized_mask = (mask - np.min(mask)) / (np.max(mask) - np.min(mask))
-    for class_id, (class_mask, normalized_class_mask) in enumerate(
-        zip(mask, normalized_mask)
-    ):
-        if class_id > 0:
-            background_class = np.zeros_like(class_mask, np.uint8)
-
-            background_class[np.where(class_mask > 0.0)] = 1
-            contours, _ = cv2.findContours(
-                background_class,
-                cv2.RETR_LIST,
-                cv2.CHAIN_APPROX_NONE,
+    # for each class mask, convert the connected components to instances
+    for class_id in range(1, mask.shape[0]):
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            (mask[class_id] > 0.0).astype(np.uint8), connectivity=8
+        )
+        # label 0 is the background, and single pixels do not form polygons
+        components = np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] > 1) + 1
+        if components.size == 0:
+            continue
+        total_scores = np.bincount(
+            labels.ravel(),
+            weights=normalized_mask[class_id].ravel(),
+            minlength=num_labels,
+        )
+        left, top, box_width, box_height, area = stats[components].T
+        scores_list.append(total_scores[components] / area)
+        bbox_list.append(
+            np.stack(
+                [
+                    top / height,
+                    left / width,
+                    (top + box_height - 1) / height,
+                    (left + box_width - 1) / width,
+                ],
+                axis=1,
             )
-            if contours:
-                for cnt_id, contour in enumerate(contours):
-                    if len(contour) > 1:
-                        instance = np.zeros_like(class_mask, np.uint8)
-                        cv2.drawContours(instance, contours, cnt_id, 1, -1)
-                        total_area = np.count_nonzero(instance)
-                        total_score = np.sum(
-                            normalized_class_mask[np.where(instance > 0)]
-                        )
-                        average_score = total_score / total_area
-                        contour = tuple(
-                            (cnt[0][1] / width, cnt[0][0] / height)
-                            for cnt in contour.tolist()
-                        )
-                        y_coordinates, x_coordinates = zip(*contour)
-                        xmin = min(x_coordinates)
-                        ymin = min(y_coordinates)
-                        xmax = max(x_coordinates)
-                        ymax = max(y_coordinates)
-                        bbox_list.append([xmin, ymin, xmax, ymax])
-                        mask_list.append(instance.tolist())
-                        class_list.append(class_id)
-                        scores_list.append(average_score)
-    return mask_list, bbox_list, class_list, scores_list
+        )
+        class_list.append(np.full(components.size, class_id))
+        for label, (x, y, w, h, _) in zip(components, stats[components]):
+            rows, cols = slice(y, y + h), slice(x, x + w)
+            roi_list.append(((rows, cols), labels[rows, cols] == label))
+
+    masks = np.zeros((len(roi_list), height, width), np.uint8)
+    for instance, (roi, roi_mask) in zip(masks, roi_list):
+        instance[roi] = roi_mask
+    if not roi_list:
+        return masks, np.zeros((0, 4)), np.zeros(0, np.int64), np.zeros(0)
+    return (
+        masks,
+        np.concatenate(bbox_list),
+        np.concatenate(class_list),
+        np.concatenate(scores_list),
+    )
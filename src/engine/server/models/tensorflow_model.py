@@ -17,17 +17,38 @@ import os
 
 import cv2
 import numpy as np
-import tensorflow as tf
 from server.models.abstract.BaseModel import BaseModel
-from server.models.model_utils import reframe_box_masks_to_image_masks
+from server.models.model_utils import get_binary_image_masks, prefilter_detections
 
 # pylint: disable=E0401, E0611
 from server.services.errors import Errors, PortalError
 from server.services.hashing import get_hash
 
 
+def _signature_input_size(loaded_model):
+    """Get the static input height and width of a SavedModel, if any.
+
+    :param loaded_model: The loaded SavedModel.
+    :return: The (height, width) of the image input of the serving
+        signature, or None if they are not fixed.
+    """
+    signature = loaded_model.signatures.get("serving_default")
+    if signature is None:
+        return None
+    _, inputs = signature.structured_input_signature
+    for spec in inputs.values():
+        shape = spec.shape
+        if shape.rank == 4 and shape[1] is not None and shape[2] is not None:
+            return int(shape[1]), int(shape[2])
+    return None
+
+
 class TensorflowModel(BaseModel):
-    """Implementation of the TensorFlow Model."""
+    """Implementation of the TensorFlow Model.
+
+    The input size is read from the serving signature of the SavedModel when
+    it is fixed, else it defaults to 1024 x 1024.
+    """
 
     def _load_label_map_(self):
         """Overloaded from Parent Class."""
@@ -74,13 +95,24 @@ class TensorflowModel(BaseModel):
 
     def load(self):
         """Overloaded from Parent Class."""
+        import tensorflow as tf
+
         loaded_model = tf.saved_model.load(
             os.path.join(self._directory_, "saved_model")
         )
+        input_size = _signature_input_size(loaded_model)
+        if input_size is not None:
+            self._height_, self._width_ = input_size
         self._model_ = loaded_model
 
-    def predict(self, image_array):
-        """Overloaded from Parent Class."""
+    def predict(self, image_array, top_k=None, score_threshold=None):
+        """Overloaded from Parent Class.
+
+        The detections are filtered with prefilter_detections before their
+        masks are reframed.
+        """
+        import tensorflow as tf
+
         height, width, _ = image_array.shape
         if self._model_ is None:
             raise PortalError(Errors.NOTFOUND, "Model is not Loaded")
@@ -88,21 +120,26 @@ class TensorflowModel(BaseModel):
         image_tensor = tf.convert_to_tensor(
             cv2.resize(
                 image_array,
-                (self._height_, self._width_),
+                (self._width_, self._height_),
             )
         )[tf.newaxis, ...]
         try:
             detections = model(image_tensor)
             for key, value in detections.items():
                 detections[key] = np.squeeze(value.numpy())
+            detections = prefilter_detections(detections, top_k, score_threshold)
             if "detection_masks" in detections:
                 box_masks = detections["detection_masks"]
                 boxes = detections["detection_boxes"]
-                image_masks = reframe_box_masks_to_image_masks(
-                    tf.convert_to_tensor(box_masks), boxes, height, width
-                )
-                image_masks = tf.cast(image_masks > 0.5, tf.uint8).numpy()
+                image_masks = get_binary_image_masks(box_masks, boxes, height, width)
                 detections["detection_masks"] = image_masks
             return detections
         except Exception as e:  # pylint: disable=broad-except
             raise PortalError(Errors.FAILEDPREDICTION, str(e)) from e
+
+    def predict_batch(self, image_arrays, top_k=None, score_threshold=None):
+        """Overloaded from Parent Class."""
+        return [
+            self.predict(image_array, top_k, score_threshold)
+            for image_array in image_arrays
+        ]
@@ -13,6 +13,7 @@
 @License :   Apache License 2.0
 @Desc    :   Module containing all API routes.
 """
+import json
 import os
 from functools import wraps
 
@@ -26,13 +27,19 @@ from server.services.filesystem.file import (
     allowed_video,
     generate_thumbnail,
 )
-from server.services.model_loader import model_loader
+from server.services.model_loader import cancel_load, model_loader
 from server.services.model_register import (
     register_endpoint,
     register_hub,
     register_local,
 )
-from server.services.predictions import predict_image, predict_video
+from server.services.predictions import (
+    image_prediction_key,
+    predict_folder,
+    predict_image,
+    predict_video,
+    video_prediction_key,
+)
 from server.utils.prediction_utilities import corrected_predict_query
 
 # Ignore import-error and no-name-in-module due to Pyshell
@@ -48,7 +55,8 @@ def portal_function_handler(clear_status: bool) -> callable:
         1. clear the global store atomic status only for functions that
            meet the requirements
         2. handles the case of simultaneous api calls
-           (2 or more same calls in a split second)
+           (2 or more same calls in a split second), by passing the
+           response on to the identical calls, keyed by their full status
         3. handles exceptions of all functions, converts them to be
            read by front-end and logs
     """
@@ -59,27 +67,19 @@ def portal_function_handler(clear_status: bool) -> callable:
         def wrapper(*args, **kwargs):
 
             # Error handling section
+            succeeded = False
             try:
-                fn_output = func(*args, **kwargs)
-
-                # Handling simultaneous API calls
-                global_store.set_caught_response(func.__name__, fn_output)
-                if clear_status:
-                    global_store.clear_status()
-                response = fn_output
+                response = func(*args, **kwargs)
+                succeeded = True
 
             except PortalError as e:
                 if logger is not None:
                     logger.exception(e)
                 e.set_fail_location(" - ".join([func.__module__, func.__name__]))
-                if e.get_error() != "ATOMICERROR" and clear_status:
-                    global_store.clear_status()
                 response = e.output()
             except Exception as e:  # pylint: disable=broad-except
                 if logger is not None:
                     logger.exception(e)
-                if clear_status:
-                    global_store.clear_status()
 
                 response = PortalError(
                     Errors.UNKNOWN,
@@ -87,6 +87,11 @@ def portal_function_handler(clear_status: bool) -> callable:
                     " - ".join([func.__module__, func.__name__]),
                 ).output()
 
+            # Handling simultaneous API calls, only successful responses
+            # are served to the identical calls arriving after completion
+            if clear_status:
+                global_store.clear_status(response, retain=succeeded)
+
             return response
 
         return wrapper
@@ -134,9 +139,11 @@ def heartbeat() -> tuple:
 @cross_origin()
 @portal_function_handler(clear_status=False)
 def kill_video() -> Response:
-    """Stop the current video prediction route."""
-    status = global_store.get_status()
-    if status is not None and "predict_video_" in status:
+    """Stop the current video or folder prediction route."""
+    if any(
+        "predict_video_" in status or "predict_folder_" in status
+        for status in global_store.get_status()
+    ):
         global_store.set_stop()
     return Response(status=200)
 
@@ -149,9 +156,12 @@ def prediction_progress() -> Response:
 
     Returns payload in the format
     {
-        "status": "none" (for image/idle) | "video" (for video),
-        "progress": 1 (for image/idle) | <current_frame_count> (for video),
-        "total": 1 (for image/idle) | <total_frames_in_video> (for video),
+        "status": "none" (for image/idle) | "video" (for video)
+                  | "folder" (for folder),
+        "progress": 1 (for image/idle) | <current_frame_count> (for video)
+                    | <predicted_images_count> (for folder),
+        "total": 1 (for image/idle) | <total_frames_in_video> (for video)
+                 | <total_images_in_folder> (for folder),
     }
     """
     return jsonify(global_store.get_prediction_progress())
@@ -198,6 +208,33 @@ def reject_cache() -> Response:
     return Response(status=200)
 
 
+@app.route("/api/cache/stats", methods=["GET"])
+@cross_origin()
+@portal_function_handler(clear_status=False)
+def get_cache_stats() -> tuple:
+    """Get the size and the counters of the prediction caches.
+
+    Returns payload in the format
+    {
+        "maxBytes": <memory budget in bytes, null if unlimited>,
+        "bytes": <size of the predictions in memory>,
+        "entries": <number of predictions, in memory or spilled to disk>,
+        "spilledEntries": <number of predictions spilled to disk>,
+        "hits": <lookups of predictions in memory>,
+        "spillHits": <lookups of predictions spilled to disk>,
+        "misses": <lookups of predictions not cached>,
+        "evictions": <predictions spilled to disk>,
+        "models": {
+            <model_id>: {"entries", "spilledEntries", "bytes", "hits",
+                         "spillHits", "misses", "evictions"}
+        },
+        "rawDetections": {"maxBytes", "bytes", "entries", "hits", "misses",
+                          "evictions"}
+    }
+    """
+    return (jsonify(global_store.get_prediction_cache_stats()), 200)
+
+
 @app.route("/set_gpu", methods=["POST"])
 @cross_origin()
 @portal_function_handler(clear_status=False)
@@ -232,6 +269,11 @@ def get_gpu() -> Response:
 def register_model() -> tuple:
     """Register tf model from local file.
 
+    The optional "options" dictionary of the API body is saved with the
+    model in the registry, such as the ONNX Runtime session options of
+    autodetect models (see ONNX_SESSION_OPTIONS) or the connection options
+    of endpoints (see ENDPOINT_OPTIONS).
+
     :return: Tuple of jsonified registered model list and 200 if successful.
 
     Possible Errors:
@@ -255,9 +297,26 @@ def register_model() -> tuple:
         model_url: str = input_credentials["modelURL"]
         model_type: str = data["modelType"]
         input_directory: str = data["directory"]
-        if global_store.set_status("register_model_" + model_key):
-            wait_for_process()
-            return global_store.get_caught_response("register_model_")
+        model_options: dict = data.get("options") or {}
+        # keyed by every field of the registration, so that only identical
+        # registrations share a response
+        registration = json.dumps(
+            [
+                input_type,
+                input_directory,
+                model_type,
+                model_name,
+                model_description,
+                model_key,
+                model_url,
+                project_key,
+                model_options,
+            ],
+            sort_keys=True,
+        )
+        process = global_store.set_status("register_model_" + registration, "registry")
+        if process is not None:
+            return wait_for_process(process)
 
         # Check for invalid inputs.
         if input_type not in ["local", "endpoint", "hub"]:
@@ -296,9 +355,17 @@ def register_model() -> tuple:
                 Errors.INVALIDAPI,
                 "only autodetect models are supported for Hub.",
             )
+        if not isinstance(model_options, dict):
+            raise PortalError(Errors.INVALIDAPI, "options should be a dictionary.")
         # Register the model using the respective registration code.
         if input_type == "local":
-            register_local(input_directory, model_type, model_name, model_description)
+            register_local(
+                input_directory,
+                model_type,
+                model_name,
+                model_description,
+                options=model_options,
+            )
 
         if input_type == "hub":
             register_hub(
@@ -307,6 +374,7 @@ def register_model() -> tuple:
                 project_secret,
                 model_name,
                 model_description,
+                options=model_options,
             )
 
         if input_type == "endpoint":
@@ -315,6 +383,7 @@ def register_model() -> tuple:
                 project_secret=project_secret,
                 name=model_name,
                 description=model_description,
+                options=model_options,
             )
 
         return (jsonify(global_store.get_registered_model_info()), 200)
@@ -367,11 +436,14 @@ def deregister_model(model_id: str) -> Response:
     Possible Errors:
         INVALIDMODELKEY:    Model key does not exist in registered model list.
     """
-    if global_store.set_status("DeregisterModel_" + model_id):
-        wait_for_process()
-        return global_store.get_caught_response("deregister_model")
+    process = global_store.set_status(
+        "DeregisterModel_" + model_id, "registry", "loaded", model_id
+    )
+    if process is not None:
+        return wait_for_process(process)
 
     try:
+        cancel_load(model_id)
         if model_id in global_store.get_loaded_model_keys():
             global_store.unload_model(model_id)
 
@@ -403,31 +475,67 @@ def get_registry() -> tuple:
 def get_loaded_list() -> tuple:
     """Obtain the list of all loaded models.
 
-    :return: Jsonified list of loaded models and 200.
+    :QueryParam details: (Optional) "true" to obtain, for every loaded model,
+                         its estimated memory in bytes and its load and last
+                         use time in seconds since the epoch:
+                         {
+                             <model_id>: {
+                                 "bytes": int,
+                                 "loadedAt": float,
+                                 "lastUsed": float,
+                             }
+                         }
+    :return: Jsonified list of loaded models, least recently used first,
+             and 200.
     """
+    if request.args.get("details") == "true":
+        return (jsonify(global_store.get_loaded_model_info()), 200)
     return (jsonify(global_store.get_loaded_model_keys()), 200)
 
 
 @app.route("/api/model/<model_id>/load", methods=["POST"])
 @cross_origin()
-@portal_function_handler(clear_status=True)
+@portal_function_handler(clear_status=False)
 def load_model(model_id: str) -> Response:
     """Load the model.
 
-    ~THIS FUNCTION IS ATOMIC~
+    The model is loaded in the background, identical loads sharing the same
+    background load. See /api/model/loadState for its progress.
 
     :param model_id: The model key.
-    :return: Response of status 200 if successful.
+    :QueryParam wait: (Optional) "false" to return as soon as the load is
+                      queued instead of once the model is loaded.
+    :return: Response of status 200 if successful, or Jsonified load state
+             (see /api/model/loadState) and 202 if the model is being
+             loaded and wait is "false".
 
     Possible Errors:
+        OVERLOADED:         The least recently used models are in use and
+                            cannot be unloaded to fit the model.
         See Respective load functions.
     """
-    if global_store.set_status("LoadModelFromFile_" + model_id):
-        wait_for_process()
-        return global_store.get_caught_response("load_model")
-    if global_store.check_model_limit():
-        raise PortalError(Errors.OVERLOADED, "Maximum loadable model reached.")
-    return model_loader(model_id)
+    return model_loader(model_id, wait_loaded=request.args.get("wait") != "false")
+
+
+@app.route("/api/model/loadState", methods=["GET"])
+@cross_origin()
+@portal_function_handler(clear_status=False)
+def get_load_states() -> tuple:
+    """Obtain the load state of the models being loaded, loaded or that
+    failed to load. The same states are pushed to the SocketIO clients as
+    "modelLoadState" events: {"modelId": str, "state": str, "error": str}.
+
+    :return: Jsonified dictionary of the model keys to their load state and
+             200:
+             {
+                 <model_id>: {
+                     "state": "queued" | "loading" | "warming" | "ready"
+                              | "failed",
+                     "error": <error message of a failed load, else null>,
+                 }
+             }
+    """
+    return (jsonify(global_store.get_load_states()), 200)
 
 
 @app.route("/api/model/<model_id>/unload", methods=["PUT"])
@@ -441,9 +549,10 @@ def unload_model(model_id: str) -> Response:
     :param model_id: The model key.
     :return: Response of status 200 if successful.
     """
-    if global_store.set_status("UnloadModel_" + model_id):
-        wait_for_process()
-        return global_store.get_caught_response("unload_model")
+    process = global_store.set_status("UnloadModel_" + model_id, "loaded", model_id)
+    if process is not None:
+        return wait_for_process(process)
+    cancel_load(model_id)
     if model_id in global_store.get_loaded_model_keys():
         global_store.unload_model(model_id)
     return Response(status=200)
@@ -458,6 +567,8 @@ def predict_single_image(model_id: str) -> tuple:
 
     ~THIS FUNCTION IS ATOMIC~
 
+    The model is loaded first if it is not loaded, see load_model.
+
     :param model_id: The model key.
     :QueryParam filepath: (Compulsory) The path of the image to be
                                        sent for prediction.
@@ -470,19 +581,22 @@ def predict_single_image(model_id: str) -> tuple:
                                 Default is 0.8.
     :QueryParam filter: (Optional) Obtain the outputs of
                                    only the specified class.
+    :QueryParam topK: (Optional) The maximum number of highest scoring
+                                 detections kept ahead of non max
+                                 suppression. Default is no maximum.
     :QueryParam reanalyse: (Optional) Flag to bypass cache and
                                       force reanalysis.
     :return: Jsonified tuple of (either json detections of image)
              and 200 if successful.
 
     Possible Errors:
-        UNINITIALIZED:      Empty loaded model list.
+        OVERLOADED:         The model is not loaded and cannot be loaded.
         INVALIDFILETYPE:    Image file extension is not allowed.
         INVALIDQUERY:       Wrongly given query parameters.
         FAILEDPREDICTION:   Prediction failed.
                             See error message for more information.
         NOTFOUND:           Image directory not found.
-        INVALIDMODELKEY:    Model key is not in loaded model list.
+        INVALIDMODELKEY:    Model key is not in registered model list.
     """
     try:
         if request.args.get("filepath") is None:
@@ -494,36 +608,44 @@ def predict_single_image(model_id: str) -> tuple:
         if not allowed_image(image_directory):
             raise PortalError(Errors.INVALIDFILETYPE, image_directory)
 
-        corrected_dict = corrected_predict_query("format", "iou", request=request)
+        corrected_dict = corrected_predict_query(
+            "format", "iou", "top_k", request=request
+        )
         format_arg = corrected_dict["format"]
         iou = corrected_dict["iou"]
+        top_k = corrected_dict["top_k"]
         reanalyse = corrected_dict["reanalyse"]
-        prediction_key = (
-            model_id,
-            image_directory,
-            format_arg + str(iou),
+        prediction_key = image_prediction_key(
+            model_id, image_directory, format_arg, iou, top_k
         )
-        prediction_status = (
-            "predict_single_image_" + model_id + image_directory + format_arg + str(iou)
+        # keyed by content so that copies of an image are predicted once
+        prediction_status = "_".join(
+            ("predict_single_image", *prediction_key, str(reanalyse))
         )
         # check if another atomic process / duplicate process exists
-        if global_store.set_status(prediction_status):
-            wait_for_process()
-            return global_store.get_caught_response("predict_single_image")
+        process = global_store.set_status(
+            prediction_status, model_id, invalidates=False
+        )
+        if process is not None:
+            return wait_for_process(process)
         # reanalyse needs to be false, and the prediction cache must
         # contain the corresponding output, in order for the cache to be
         # served. else, we continue prediction as per norma
         if global_store.check_prediction_cache(prediction_key) and reanalyse is False:
             output = global_store.get_predictions(prediction_key)
         else:
-            if not global_store.get_loaded_model_keys():
-                raise PortalError(Errors.UNINITIALIZED, "No Models loaded.")
-            if model_id not in global_store.get_loaded_model_keys():
-                raise PortalError(Errors.NOTFOUND, "model_id not loaded.")
-
+            model_loader(model_id)
             model_class = global_store.get_model_class(model_id)
 
-            output = predict_image(model_class, format_arg, iou, image_directory)
+            output = predict_image(
+                model_class,
+                format_arg,
+                iou,
+                image_directory,
+                top_k=top_k,
+                prediction_key=prediction_key,
+                reanalyse=reanalyse,
+            )
             global_store.add_predictions(prediction_key, output)
 
         return (jsonify(output), 200)
@@ -545,6 +667,8 @@ def predict_video_fn(model_id: str) -> tuple:
 
     ~THIS FUNCTION IS ATOMIC~
 
+    The model is loaded first if it is not loaded, see load_model.
+
     :param model_id: The model key.
     :QueryParam filepath: (Compulsory) The path of the image to be sent
                                        for prediction.
@@ -555,19 +679,24 @@ def predict_video_fn(model_id: str) -> tuple:
     :QueryParam filter: (Optional) Obtain the outputs of only the
                                    specified class.
     :QueryParam confidence: (Optional) The confidence threshold.
+    :QueryParam batchSize: (Optional) The maximum number of frames
+                                      per model call.
+    :QueryParam topK: (Optional) The maximum number of highest scoring
+                                 detections kept ahead of non max
+                                 suppression. Default is no maximum.
     :QueryParam reanalyse: (Optional) Flag to bypass cache and
                                       force reanalysis.
     :return: Jsonified tuple of (either json detections of image)
              and 200 if successful.
 
     Possible Errors:
-        UNINITIALIZED:      Empty loaded model list.
+        OVERLOADED:         The model is not loaded and cannot be loaded.
         INVALIDFILETYPE:    Image file extension is not allowed.
         INVALIDQUERY:       Wrongly given query parameters.
         FAILEDPREDICTION:   Prediction failed.
                             See error message for more information.
         NOTFOUND:           Image directory not found.
-        INVALIDMODELKEY:    Model key is not in loaded model list.
+        INVALIDMODELKEY:    Model key is not in registered model list.
     """
     try:
         if request.args.get("filepath") is None:
@@ -577,32 +706,32 @@ def predict_video_fn(model_id: str) -> tuple:
                 Errors.INVALIDQUERY, "frameInterval is a compulsory query"
             )
         frame_interval = int(request.args.get("frameInterval"))
+        if frame_interval < 1:
+            raise ValueError("frameInterval must be a positive integer.")
         video_directory = decode(request.args.get("filepath"))
         if not os.path.isfile(video_directory):
             raise PortalError(Errors.NOTFOUND, "Video is not found from filepath param")
         if not allowed_video(video_directory):
             raise PortalError(Errors.INVALIDFILETYPE, video_directory)
 
-        corrected_dict = corrected_predict_query("iou", "confidence", request=request)
+        corrected_dict = corrected_predict_query(
+            "iou", "confidence", "batch_size", "top_k", request=request
+        )
         iou = corrected_dict["iou"]
         confidence = corrected_dict["confidence"]
+        batch_size = corrected_dict["batch_size"]
+        top_k = corrected_dict["top_k"]
         reanalyse = corrected_dict["reanalyse"]
-        prediction_key = (
-            model_id,
-            video_directory,
-            str(frame_interval) + str(iou) + str(confidence),
+        prediction_key = video_prediction_key(
+            model_id, video_directory, frame_interval, iou, confidence, top_k
         )
-        prediction_status = (
-            "predict_video_"
-            + model_id
-            + video_directory
-            + str(frame_interval)
-            + str(iou)
-            + str(confidence)
+        prediction_status = "_".join(("predict_video", *prediction_key, str(reanalyse)))
+        # videos and folders share the prediction progress and stop flag
+        process = global_store.set_status(
+            prediction_status, model_id, "progress", invalidates=False
         )
-        if global_store.set_status(prediction_status):
-            wait_for_process()
-            return global_store.get_caught_response("predict_video")
+        if process is not None:
+            return wait_for_process(process)
 
         # reanalyse needs to be false, and the prediction cache must
         # contain the corresponding output, in order for the cache to be
@@ -610,10 +739,7 @@ def predict_video_fn(model_id: str) -> tuple:
         if global_store.check_prediction_cache(prediction_key) and reanalyse is False:
             output = global_store.get_predictions(prediction_key)
         else:
-            if not global_store.get_loaded_model_keys():
-                raise PortalError(Errors.UNINITIALIZED, "No Models loaded.")
-            if model_id not in global_store.get_loaded_model_keys():
-                raise PortalError(Errors.NOTFOUND, "model_id not loaded.")
+            model_loader(model_id)
             model_class = global_store.get_model_class(model_id)
 
             output = predict_video(
@@ -622,6 +748,10 @@ def predict_video_fn(model_id: str) -> tuple:
                 video_directory=video_directory,
                 frame_interval=frame_interval,
                 confidence=confidence,
+                batch_size=batch_size,
+                top_k=top_k,
+                prediction_key=prediction_key,
+                reanalyse=reanalyse,
             )
             global_store.add_predictions(prediction_key, output)
 
@@ -638,6 +768,118 @@ def predict_video_fn(model_id: str) -> tuple:
         raise PortalError(Errors.INVALIDQUERY, str(e)) from e
 
 
+@app.route("/api/model/<model_id>/predict/folder", methods=["POST"])
+@cross_origin()
+@portal_function_handler(clear_status=True)
+def predict_folder_fn(model_id: str) -> tuple:
+    """Predict all images within a targeted folder.
+
+    ~THIS FUNCTION IS ATOMIC~
+
+    The model is loaded first if it is not loaded, see load_model.
+
+    The predictions are added into the prediction cache, to be served by the
+    single image prediction route. Progress is reported by the prediction
+    status route and the prediction can be stopped with the kill route.
+
+    :param model_id: The model key.
+    :APIBody directory: (Compulsory) The path of the targeted folder
+                                     (or one of its subfolders).
+    :QueryParam format: (Optional) Output format.
+                                   Either "json" or "image".
+                                   Default is "json".
+    :QueryParam iou: (Optional) Intersection of Union for
+                                Bounding Boxes/Masks.
+                                Requires float in the range of [0.0,1.0].
+                                Default is 0.8.
+    :QueryParam batchSize: (Optional) The maximum number of images
+                                      per model call.
+    :QueryParam topK: (Optional) The maximum number of highest scoring
+                                 detections kept ahead of non max
+                                 suppression. Default is no maximum.
+    :QueryParam reanalyse: (Optional) Flag to bypass cache and
+                                      force reanalysis.
+    :return: Jsonified tuple of the number of images in the folder, and the
+             number of them that were predicted, cached or could not be read
+             and 200 if successful.
+
+    Possible Errors:
+        NOAPIBODY:          API body is required but not given.
+        OVERLOADED:         The model is not loaded and cannot be loaded.
+        INVALIDQUERY:       Wrongly given query parameters.
+        FAILEDPREDICTION:   Prediction failed.
+                            See error message for more information.
+        NOTFOUND:           Folder is not a targeted folder.
+        INVALIDMODELKEY:    Model key is not in registered model list.
+        STOPPEDPROCESS:     Folder prediction has been stopped.
+    """
+    try:
+        data = request.get_json()
+        if not data or not data.get("directory"):
+            raise PortalError(Errors.NOAPIBODY, "API body is required but not given.")
+        folder_directory = data["directory"]
+        if request.args.get("format") is None:
+            format_arg = "json"
+            corrected_dict = corrected_predict_query(
+                "iou", "batch_size", "top_k", request=request
+            )
+        else:
+            corrected_dict = corrected_predict_query(
+                "format", "iou", "batch_size", "top_k", request=request
+            )
+            format_arg = corrected_dict["format"]
+        iou = corrected_dict["iou"]
+        batch_size = corrected_dict["batch_size"]
+        top_k = corrected_dict["top_k"]
+        reanalyse = corrected_dict["reanalyse"]
+        prediction_status = "_".join(
+            (
+                "predict_folder",
+                model_id,
+                folder_directory,
+                format_arg,
+                str(iou),
+                str(top_k),
+                str(reanalyse),
+            )
+        )
+        process = global_store.set_status(
+            prediction_status, model_id, "progress", invalidates=False
+        )
+        if process is not None:
+            return wait_for_process(process)
+
+        model_loader(model_id)
+        model_class = global_store.get_model_class(model_id)
+
+        image_directories = [
+            decode(asset)
+            for asset in global_store.get_targeted_folders().get_folder_assets(
+                folder_directory
+            )
+            if allowed_image(decode(asset))
+        ]
+        output = predict_folder(
+            model_class,
+            model_id,
+            format_arg=format_arg,
+            iou=iou,
+            image_directories=image_directories,
+            batch_size=batch_size,
+            reanalyse=reanalyse,
+            top_k=top_k,
+        )
+        return (jsonify(output), 200)
+
+    # Except Block
+    # Catches all possible native exceptions here and
+    # translates them into PortalError.
+    except FileNotFoundError as e:
+        raise PortalError(Errors.NOTFOUND, str(e)) from e
+    except KeyError as e:
+        raise PortalError(Errors.INVALIDMODELKEY, str(e)) from e
+
+
 @app.route("/api/model/<model_id>/cachelist", methods=["GET"])
 @cross_origin()
 @portal_function_handler(clear_status=False)
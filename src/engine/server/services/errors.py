@@ -87,6 +87,10 @@ class PortalError(Exception):
         """Get the error name."""
         return self._error_
 
+    def get_message(self) -> str:
+        """Get the error message."""
+        return self._message_
+
     def output(self) -> tuple:
         """Jsonify the output of the PortalError.
 
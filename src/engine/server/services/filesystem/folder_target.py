@@ -41,6 +41,17 @@ class FolderTargets:
         """Obtain all assets."""
         return self._flatten_assets_([], self._folders_)
 
+    def get_folder_assets(self, path):
+        """Obtain all assets within a tracked folder and its subfolders."""
+        # Ensure all encoded path are encoded with the same format
+        decoded_path = os.path.normpath(decode(path))
+        folder = self._find_folder_(encode(decoded_path), self._folders_)
+        if folder is None:
+            raise PortalError(
+                Errors.NOTFOUND, f"{decoded_path} is not a targeted folder."
+            )
+        return self._flatten_assets_([], [folder])
+
     def get_tree(self):
         """Obtain all nested folders given a folder."""
         trees_arr = []
@@ -116,6 +127,22 @@ class FolderTargets:
         if not is_exist:
             self._folders_.append(Folder(path, tail, datetime.datetime.utcnow()))
 
+    def _find_folder_(self, path, folders):
+        """
+        This method recursively searches for the folder with the given path
+        :param path: encoded path of the folder to search for
+        :param folders: array of folders to search the folder from
+        :return: the folder if it is found, else None
+        """
+        for f in folders:
+            if path == f.get_path():
+                return f
+            if path.startswith(f.get_path()):
+                found = self._find_folder_(path, f.get_folders())
+                if found is not None:
+                    return found
+        return None
+
     def _flatten_assets_(self, arr, folders):
         """
         This method recursively flattens the files in the list of folders given
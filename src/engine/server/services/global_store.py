@@ -15,10 +15,11 @@
 """
 import atexit
 import gc
-import json
 import os
+import threading
 import time
-from typing import Optional, Union
+from concurrent.futures import Future
+from typing import Iterator, Optional, Union
 
 import jsonpickle
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -33,11 +34,15 @@ from server.services.errors import Errors, PortalError
 
 # pylint: disable=cyclic-import
 from server.services.filesystem.folder_target import FolderTargets
-
-
-def _delete_store_():
-    if os.path.isfile(os.getenv("CACHE_DIR")):
-        os.remove(os.getenv("CACHE_DIR"))
+from server.services.hashing import FileFingerprints
+from server.services.model_pool import ModelPool
+from server.services.prediction_cache import (
+    PredictionCache,
+    RawDetectionCache,
+    RawDetections,
+)
+from server.services.single_flight import SingleFlight
+from server.services.store_journal import StoreJournal, prediction_record
 
 
 # pylint: disable=R0904
@@ -45,21 +50,33 @@ class GlobalStore:
     """Storage of global variables."""
 
     # MODEL INITIALIZER AND DESTRUCTOR
-    def __init__(self, model_load_limit, idle_minutes, caching_system) -> None:
+    # pylint: disable=R0913
+    def __init__(
+        self,
+        model_load_limit,
+        model_pool_bytes,
+        idle_minutes,
+        caching_system,
+        prediction_cache_bytes,
+        raw_detection_cache_bytes,
+        full_content_hash=False,
+        atomic_timeout=None,
+        coalesce_seconds=0,
+    ) -> None:
         """Initialize the GlobalStore class."""
         self._global_server_time_ = time.time()
         self._is_cache_called_ = False
         self._scheduler_ = None
-        self._loaded_model_list_ = {}
-        self._op_status_ = {"status": None}
-        self._op_atomic_ = False
+        self._models_ = ModelPool(model_load_limit, model_pool_bytes)
+        self._load_states_ = {}
+        self._op_flight_ = SingleFlight(atomic_timeout, coalesce_seconds)
         self._image_list_cache_ = []
         self._targeted_folders_ = FolderTargets()
         self._image_unchanged_ = False
         self._bulk_info_ = {"image_name": None, "progress": 100.0}
-        self._process_stop_ = False
-        self._caught_response_ = {}
-        self._model_load_limit_ = model_load_limit
+        # statuses of the video and folder predictions to be stopped
+        self._process_stop_ = set()
+        self._progress_lock_ = threading.Lock()
         self._prediction_progress_ = {
             "status": "none",
             "progress": 1,
@@ -71,9 +88,12 @@ class GlobalStore:
         self.caching_system = caching_system
         self._store_ = {
             "registry": {},
-            "predictions": {},
             "targeted_folders": jsonpickle.encode(self._targeted_folders_),
         }
+        self._predictions_ = PredictionCache(prediction_cache_bytes)
+        self._raw_detections_ = RawDetectionCache(raw_detection_cache_bytes)
+        self._fingerprints_ = FileFingerprints(full_content_hash)
+        self._journal_ = StoreJournal(os.getenv("CACHE_DIR"), self._cache_documents_)
 
     def _is_shutdown_server_(self, timer):
         """Check if the server should be shut down.
@@ -92,7 +112,7 @@ class GlobalStore:
 
         :return: void
         """
-        if self._is_shutdown_server_(self._idle_minutes_) or self._op_atomic_:
+        if self._is_shutdown_server_(self._idle_minutes_) or self.get_atomic():
             time.sleep(5)
         else:
             os._exit(0)  # pylint: disable=W0212
@@ -141,7 +161,7 @@ class GlobalStore:
             encoding="utf-8",
         ) as cache_flag:
             cache_flag.write("0")
-        _delete_store_()
+        self._journal_.delete()
         self.caching_system = False
 
     def query_autosave(self):
@@ -153,28 +173,39 @@ class GlobalStore:
 
         Transfers data from
         "./server/cache/store.portalCache" into self._store_
+        The journal is then compacted, dropping any record that was only
+        partially written when the server last stopped.
         """
-        if os.path.isfile(os.getenv("CACHE_DIR")):
-            with open(os.getenv("CACHE_DIR"), "r", encoding="utf-8") as cache:
-                self._store_ = json.load(cache)
-                self._targeted_folders_ = jsonpickle.decode(
-                    self._store_["targeted_folders"]
+        if self._journal_.exists():
+            try:
+                self._store_ = self._journal_.read()
+            except ValueError as e:
+                raise PortalError(
+                    Errors.NOTFOUND,
+                    "cache file is corrupted",
+                    "global_store.load_cache",
+                ) from e
+            self._predictions_.load(self._store_.pop("predictions"))
+            self._fingerprints_.load(self._store_.pop("fingerprints", {}))
+            self._targeted_folders_ = jsonpickle.decode(
+                self._store_["targeted_folders"]
+            )
+            store_registry = self._store_["registry"]
+            # pylint: disable=R1721
+            deepcopy_store_registry = {
+                key: value for key, value in store_registry.items()
+            }
+            for _, value in deepcopy_store_registry.items():
+                reg_model = Model(
+                    value["model_type"],
+                    value["model_dir"],
+                    value["model_name"],
+                    "",
+                    **value["model_kwargs"],
                 )
-                store_registry = self._store_["registry"]
-                # pylint: disable=R1721
-                deepcopy_store_registry = {
-                    key: value for key, value in store_registry.items()
-                }
-                for _, value in deepcopy_store_registry.items():
-                    reg_model = Model(
-                        value["model_type"],
-                        value["model_dir"],
-                        value["model_name"],
-                        "",
-                        **value["model_kwargs"],
-                    )
-                    self.add_registered_model(*reg_model.register())
-                self._is_cache_called_ = True
+                self.add_registered_model(*reg_model.register())
+            self._save_store_()
+            self._is_cache_called_ = True
         else:
             raise PortalError(
                 Errors.NOTFOUND,
@@ -182,41 +213,67 @@ class GlobalStore:
                 "global_store.load_cache",
             )
 
+    def _cache_registry_(self) -> dict:
+        """Retrieve the registry entries to be saved in the cache."""
+        return {
+            registry_key: {
+                key: value
+                for key, value in self._store_["registry"][registry_key].items()
+                if key
+                in [
+                    "model_type",
+                    "model_dir",
+                    "model_name",
+                    "model_kwargs",
+                    "save_in_cache",
+                ]
+            }
+            for registry_key in list(self._store_["registry"].keys())
+            if self._store_["registry"][registry_key]["save_in_cache"]
+        }
+
+    def _cache_documents_(self) -> Iterator[Union[dict, str]]:
+        """Retrieve the store to be saved in the cache.
+
+        The predictions are saved as records following the store, see
+        store_journal.StoreJournal.
+        """
+        cache_store = self._store_.copy()
+        cache_store["registry"] = self._cache_registry_()
+        cache_store["predictions"] = {}
+        cache_store["fingerprints"] = self._fingerprints_.items()
+        yield cache_store
+        for key, encoded in self._predictions_.records():
+            yield prediction_record(key, encoded)
+
     def _save_store_(self):
         """Save to cache.
 
         Transfers data from self._store_ into
-        "./server/cache/store.portalCache"
+        "./server/cache/store.portalCache" as a new snapshot.
         """
         if self.caching_system:
-            cache_store = self._store_.copy()
-            updated_registry = {
-                registry_key: {
-                    key: value
-                    for key, value in self._store_["registry"][registry_key].items()
-                    if key
-                    in [
-                        "model_type",
-                        "model_dir",
-                        "model_name",
-                        "model_kwargs",
-                        "save_in_cache",
-                    ]
-                }
-                for registry_key in list(self._store_["registry"].keys())
-                if self._store_["registry"][registry_key]["save_in_cache"]
-            }
-            cache_store["registry"] = updated_registry
+            self._journal_.compact()
+
+    def _journal_store_(self, record: Union[dict, str], flush: Optional[bool] = True):
+        """Save a change of self._store_ to cache.
+
+        Appends the record to the journal in
+        "./server/cache/store.portalCache"
 
-            with open(os.getenv("CACHE_DIR"), "w+", encoding="utf-8") as cache:
-                json.dump(cache_store, cache)
+        :param record: The journal record, see store_journal.apply_record,
+            or its JSON encoding.
+        :param flush: Whether to write the record to disk right away.
+        """
+        if self.caching_system:
+            self._journal_.append(record, flush=flush)
 
     def has_cache(self):
         """Check if there's cache
 
         :return: Boolean representing the output of the function.
         """
-        return os.path.isfile(os.getenv("CACHE_DIR"))
+        return self._journal_.exists()
 
     def is_cache_called(self):
         """Check existing cache has once been loaded
@@ -236,68 +293,74 @@ class GlobalStore:
         To be done before entire system closes.
         """
         if self.caching_system:
-            _delete_store_()
+            self._journal_.delete()
 
     # ATOMIC FUNCTION CHECKS
     def get_atomic(self) -> bool:
-        """Getter for self._op_atomic_"""
-        return self._op_atomic_
+        """Check if any atomic function is running."""
+        return self._op_flight_.is_running()
 
     def set_stop(self) -> None:
-        """Set the process_stop flag (Currently only for videos)"""
-        if self._op_atomic_:
-            self._process_stop_ = True
+        """Set the process_stop flag of the running video and folder
+        predictions."""
+        with self._progress_lock_:
+            self._process_stop_.update(
+                status
+                for status in self._op_flight_.running()
+                if "predict_video_" in status or "predict_folder_" in status
+            )
 
     def clear_stop(self) -> None:
-        """Clear the process_stop flag"""
-        self._process_stop_ = False
+        """Clear the process_stop flag of the prediction of the current
+        thread."""
+        with self._progress_lock_:
+            self._process_stop_.discard(self._op_flight_.current())
 
     def get_stop(self) -> bool:
-        """Get the value of the process_stop flag"""
-        return self._process_stop_
-
-    def set_status(self, status: str) -> bool:
+        """Get the value of the process_stop flag of the prediction of the
+        current thread."""
+        with self._progress_lock_:
+            return self._op_flight_.current() in self._process_stop_
+
+    def set_status(
+        self, status: str, *resources: str, invalidates: bool = True
+    ) -> Optional[Future]:
         """Set the status when an atomic function is running.
 
-        :param status: string representing the name of the atomic function.
-        :return: boolean representing if the same function is already running.
+        Atomic functions sharing a resource run one at a time, while atomic
+        functions on different resources, such as predictions on different
+        models, run concurrently. An atomic function without any resource
+        runs alone. The calling thread waits for the conflicting functions
+        to complete, up to the atomic timeout. See SingleFlight.
+
+        :param status: string representing the atomic function and all the
+            arguments changing its response.
+        :param resources: the resources used by the atomic function.
+        :param invalidates: whether the atomic function changes its
+            resources, discarding the responses kept for the others.
+        :return: The future of the same function if it is running or has
+            just completed, to be awaited with wait_for_process, else None
+            once the status is set.
         """
-        if self._op_atomic_ is False:
-            self._op_atomic_ = True
-            self._op_status_["status"] = status
-            return False
-        if self._op_status_["status"] == status:
-            return True
-        raise PortalError(
-            Errors.ATOMICERROR, "Another atomic process is already running."
-        )
+        return self._op_flight_.acquire(status, resources, invalidates)
 
-    def get_status(self) -> None:
-        """Acquire the status of the atomic function."""
-        return self._op_status_["status"]
+    def get_status(self) -> list:
+        """Acquire the statuses of the running atomic functions."""
+        return self._op_flight_.running()
 
-    def clear_status(self) -> None:
-        """Reset the status attribute."""
-        self._op_status_["status"] = None
-        self._op_atomic_ = False
-
-    def set_caught_response(
-        self, response_name: str, response: Union[Response, tuple]
+    def clear_status(
+        self, response: Union[Response, tuple] = None, retain: bool = True
     ) -> None:
-        """Store the return of a function.
-
-        :param response_name: The string signifying the origin of the response.
-        :param response: The response contents.
-        """
-        self._caught_response_[response_name] = response
-
-    def get_caught_response(self, origin: str) -> Union[Response, tuple]:
-        """Retrieves the response corresponding to the origin.
+        """Reset the status set by the current thread.
 
-        :param origin: The string signifying the origin of the response.
-        :return: The response corresponding to the origin.
+        :param response: The response of the atomic function, passed on to
+            the callers of the same function.
+        :param retain: Whether to serve the response to the callers of the
+            same function arriving shortly after.
         """
-        return self._caught_response_[origin]
+        # a stop set after the last check must not stop the next call
+        self.clear_stop()
+        self._op_flight_.release(response, retain)
 
     # MODEL (DE)REGISTRATION AND INFORMATION
     def get_registered_model_list(self) -> dict:
@@ -343,7 +406,7 @@ class GlobalStore:
             "model_kwargs": model_kwargs,
             "save_in_cache": store_cache,
         }
-        self._save_store_()
+        self._journal_store_({"op": "registry", "registry": self._cache_registry_()})
 
     def get_registered_model(self, key: str) -> BaseModel:
         """Retrieve the model given its model key
@@ -369,78 +432,128 @@ class GlobalStore:
         """
         self._store_["registry"].pop(key)
         gc.collect()
-        self._save_store_()
+        self._journal_store_({"op": "registry", "registry": self._cache_registry_()})
 
     # MODEL (UN)LOADING AND MODEL INFORMATIONS
-    def check_model_limit(self):
-        """Check if current registered models exceeds the model limit."""
-        return len(self._loaded_model_list_) >= self._model_load_limit_
-
     def load_model(self, key: str, model_class: BaseModel) -> None:
         """Add a model into the loaded model list.
 
+        The least recently used models that are not predicting are unloaded
+        when the model load limit is reached. Their predictions are kept.
+
         :param key: The model key.
         :param model_class: The model class that the model key represents.
         """
-        self._loaded_model_list_[key] = model_class
+        evicted = self._models_.put(
+            key,
+            model_class,
+            model_class.estimate_size(),
+            busy=self._op_flight_.resources(),
+        )
+        for evicted_key, model in evicted.items():
+            model.unload()
+            self._load_states_.pop(evicted_key, None)
+        if evicted:
+            gc.collect()
 
     def get_loaded_model_keys(self) -> list:
         """Retrieve all model keys in the loaded model list."""
-        return list(self._loaded_model_list_.keys())
+        return self._models_.keys()
+
+    def set_load_state(self, key: str, state: str, error: Optional[str] = None) -> None:
+        """Update the load state of a model.
+
+        See model_loader.py -> load_model_async()
+        :param key: The model key.
+        :param state: string of either "queued", "loading", "warming",
+            "ready" or "failed".
+        :param error: The error message of a failed load.
+        """
+        self._load_states_[key] = {"state": state, "error": error}
+
+    def get_load_states(self) -> dict:
+        """Retrieve the load state of the models being loaded, loaded or
+        that failed to load."""
+        return dict(self._load_states_)
+
+    def get_loaded_model_info(self) -> dict:
+        """Retrieve the estimated bytes, load and last use time of all
+        loaded models. See ModelPool.info."""
+        return self._models_.info()
 
     def unload_model(self, key: str) -> None:
         """Unload a model from the loaded model list given its model key.
 
         :param key: The model key.
         """
-        self._loaded_model_list_.pop(key)
-        if key in self._store_["predictions"]:
-            self._store_["predictions"].pop(key)
+        self._models_.pop(key).unload()
+        self._load_states_.pop(key, None)
+        self._raw_detections_.clear(key)
+        if self._predictions_.has_model(key):
+            self._predictions_.clear(key)
+            self._journal_store_({"op": "clear_predictions", "model_id": key})
         gc.collect()
 
-        self._save_store_()
-
     def get_model_class(self, key: str) -> tuple:
         """Retrieve the model, label map, height and width given the model key.
 
         :param key: The model key.
         :return: The model class that the model key represents.
         """
-        return self._loaded_model_list_[key]
+        return self._models_.get(key)
 
     # PREDICTIONS
-    def add_predictions(self, key: tuple, value: str) -> None:
+    def get_content_hash(self, path: str) -> str:
+        """Obtain the content hash of an image or a video, which is part of
+        its prediction key.
+
+        The file is only hashed if it is new or has been modified since it
+        was last hashed.
+
+        :param path: The path of the image or the video.
+        :return: The content hash.
+        """
+        content_hash, entry = self._fingerprints_.get(path)
+        if entry is not None:
+            self._journal_store_(
+                {"op": "fingerprint", "path": path, "entry": entry}, flush=False
+            )
+        return content_hash
+
+    def add_predictions(
+        self, key: tuple, value: str, store_cache: Optional[bool] = True
+    ) -> None:
         """Add predictions into the prediction cache.
 
         :param key: The prediction key as a tuple of:
-            (model_id, image/video directory, additional_parameters)
+            (model_id, image/video content hash, additional_parameters)
         :param value: The predictions.
+        :param store_cache: Whether to write the cache to disk right away.
+            Bulk predictions only write every few predictions.
         """
-        model_id = key[0]
-        img_vid_dir = key[1]
-        params = key[2]
-        if model_id not in self._store_["predictions"]:
-            self._store_["predictions"][model_id] = {}
-        if img_vid_dir not in self._store_["predictions"][model_id]:
-            self._store_["predictions"][model_id][img_vid_dir] = {}
-        self._store_["predictions"][model_id][img_vid_dir][params] = value
-        self._save_store_()
+        encoded = self._predictions_.put(key, value)
+        self._journal_store_(prediction_record(key, encoded), flush=store_cache)
+
+    def save_predictions(self) -> None:
+        """Save the prediction cache after adding predictions with
+        store_cache set to False."""
+        if self.caching_system:
+            self._journal_.flush()
 
     def check_prediction_cache(self, key: tuple) -> bool:
         """Check if a prediction key is in the prediction cache."""
-        return key[2] in list(
-            self._store_["predictions"].get(key[0], {}).get(key[1], {}).keys()
-        )
+        return self._predictions_.contains(key)
 
     def get_predicted_images(self, model_id: str) -> list:
         """Return a list of all successfully predicted images."""
-        return list(self._store_["predictions"].get(model_id, {}).keys())
+        return self._fingerprints_.paths(set(self._predictions_.contents(model_id)))
 
     def clear_predicted_images(self, model_id: str) -> None:
         """Clears the cache of predicted images of a model_id."""
-        self._store_["predictions"].pop(model_id)
+        self._raw_detections_.clear(model_id)
+        self._predictions_.clear(model_id)
         gc.collect()
-        self._save_store_()
+        self._journal_store_({"op": "clear_predictions", "model_id": model_id})
 
     def get_predictions(self, key: tuple) -> Union[list, dict]:
         """Get the predictions given the prediction key.
@@ -448,25 +561,61 @@ class GlobalStore:
         :param key: The prediction key.
         :return: The predictions.
         """
-        return (
-            self._store_["predictions"].get(key[0], {}).get(key[1], {}).get(key[2], {})
-        )
+        return self._predictions_.get(key, {})
+
+    def get_prediction_cache_stats(self) -> dict:
+        """Retrieve the size and the hit, miss and eviction counters of the
+        prediction cache and of the raw detection cache."""
+        return {
+            **self._predictions_.stats(),
+            "rawDetections": self._raw_detections_.stats(),
+        }
+
+    def add_raw_detections(self, key: tuple, detections: RawDetections) -> None:
+        """Add raw detections into the raw detection cache.
+
+        :param key: The raw detection key as a tuple of:
+            (model_id, image/video content hash, additional_parameters)
+        :param detections: The raw detections returned by the model.
+        """
+        self._raw_detections_.put(key, detections)
+
+    def get_raw_detections(
+        self, key: tuple, score_threshold: float
+    ) -> Optional[RawDetections]:
+        """Get raw detections from the raw detection cache.
+
+        :param key: The raw detection key.
+        :param score_threshold: The score threshold of the outputs to be
+            derived from the detections.
+        :return: The raw detections, or None if they are not cached.
+        """
+        return self._raw_detections_.get(key, score_threshold)
 
     def get_prediction_progress(self) -> dict:
-        """Retrieve the _prediction_progress_ attribute."""
-        return self._prediction_progress_
+        """Retrieve a copy of the _prediction_progress_ attribute."""
+        with self._progress_lock_:
+            return dict(self._prediction_progress_)
 
     def set_prediction_progress(self, status: str, progress: int, total: int):
         """Update the _prediction_progress_ attribute.
 
         See routes.py -> prediction_progress()
-        :param status: string of either "none" or "video".
-        :param progress: int of 1 or the current video frame.
-        :param total: int of 1 or the the total frames in the video.
+        :param status: string of either "none", "video" or "folder".
+        :param progress: int of 1, the current video frame or the number
+            of predicted images in the folder.
+        :param total: int of 1, the total frames in the video or the total
+            images in the folder.
+
+        Video and folder predictions share the "progress" status resource,
+        so only one of them updates it at a time.
         """
-        self._prediction_progress_["status"] = status
-        self._prediction_progress_["progress"] = progress
-        self._prediction_progress_["total"] = total
+        with self._progress_lock_:
+            self._prediction_progress_ = {
+                "status": status,
+                "progress": progress,
+                "total": total,
+            }
 
     # IMAGE AND FOLDERS
     def add_targeted_folder(self, new_path):
@@ -477,7 +626,9 @@ class GlobalStore:
         self._targeted_folders_.add_folders(new_path)
         seriliazable_folders = jsonpickle.encode(self._targeted_folders_)
         self._store_["targeted_folders"] = seriliazable_folders
-        self._save_store_()
+        self._journal_store_(
+            {"op": "targeted_folders", "targeted_folders": seriliazable_folders}
+        )
 
     def update_targeted_folder(self, new_path):
         """Update the cache given the folder path
@@ -487,7 +638,9 @@ class GlobalStore:
         self._targeted_folders_.update_folder(new_path)
         seriliazable_folders = jsonpickle.encode(self._targeted_folders_)
         self._store_["targeted_folders"] = seriliazable_folders
-        self._save_store_()
+        self._journal_store_(
+            {"op": "targeted_folders", "targeted_folders": seriliazable_folders}
+        )
 
     def update_all_targeted_folders(self):
         """Update the cache
@@ -497,7 +650,9 @@ class GlobalStore:
         self._targeted_folders_.update_all_folders()
         seriliazable_folders = jsonpickle.encode(self._targeted_folders_)
         self._store_["targeted_folders"] = seriliazable_folders
-        self._save_store_()
+        self._journal_store_(
+            {"op": "targeted_folders", "targeted_folders": seriliazable_folders}
+        )
 
     def delete_targeted_folder(self, new_path):
         """Delete the folder path from the cache.
@@ -507,7 +662,9 @@ class GlobalStore:
         self._targeted_folders_.delete_folder(new_path)
         seriliazable_folders = jsonpickle.encode(self._targeted_folders_)
         self._store_["targeted_folders"] = seriliazable_folders
-        self._save_store_()
+        self._journal_store_(
+            {"op": "targeted_folders", "targeted_folders": seriliazable_folders}
+        )
 
     def get_targeted_folders(self):
         """Getter for the targeted folders."""
@@ -13,10 +13,18 @@
 @License :   Apache License 2.0
 @Desc    :   A service responsible for hashing.
 """
+import functools
 import hashlib
+import os
+import threading
+from typing import Callable
 
 from dirhash import dirhash
 
+# Number of bytes hashed at the start and at the end of a file for its
+# partial content hash.
+CONTENT_HASH_CHUNK = 64 * 1024
+
 
 def get_hash(path_to_directory: str) -> str:
     """Obtain the hash given the directory.
@@ -28,3 +36,101 @@ def get_hash(path_to_directory: str) -> str:
     double_hash = hashlib.md5((directory_contents_hash + path_to_directory).encode())
 
     return double_hash.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _content_hasher() -> Callable:
+    """Hash constructor of the content hashes, xxh3 if xxhash is installed."""
+    try:
+        import xxhash  # pylint: disable=import-outside-toplevel
+
+        return xxhash.xxh3_128
+    except ImportError:
+        return functools.partial(hashlib.blake2b, digest_size=16)
+
+
+def get_content_hash(path: str, full: bool = False) -> str:
+    """Obtain the content hash of a file.
+
+    Unless full is set, only the first and the last CONTENT_HASH_CHUNK bytes
+    of the file are hashed, along with its size.
+
+    :param path: Path of the file.
+    :param full: Whether to hash the whole file.
+    :return: Hash string, prefixed by the size of the file.
+    """
+    size = os.path.getsize(path)
+    hasher = _content_hasher()()
+    with open(path, "rb") as file:
+        if full or size <= 2 * CONTENT_HASH_CHUNK:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        else:
+            hasher.update(file.read(CONTENT_HASH_CHUNK))
+            file.seek(-CONTENT_HASH_CHUNK, os.SEEK_END)
+            hasher.update(file.read(CONTENT_HASH_CHUNK))
+    return str(size) + "-" + hasher.hexdigest()
+
+
+class FileFingerprints:
+    """Index of the content hashes of files.
+
+    Every path is indexed with the size and the modification time of the file
+    when it was hashed, so that the file is only hashed again once it has been
+    modified.
+    """
+
+    def __init__(self, full_hash: bool = False) -> None:
+        """Initialize the FileFingerprints class.
+
+        :param full_hash: Whether to hash whole files, see get_content_hash.
+        """
+        self._full_hash_ = full_hash
+        # path -> [size, modification time in ns, content hash]
+        self._index_ = {}
+        self._lock_ = threading.Lock()
+
+    def get(self, path: str) -> tuple:
+        """Obtain the content hash of a file, hashing it if it is not indexed
+        or has been modified.
+
+        :param path: Path of the file.
+        :return: Tuple of the content hash, and the index entry of the file if
+            it has been updated, else None.
+        """
+        stat = os.stat(path)
+        with self._lock_:
+            entry = self._index_.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2], None
+        entry = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            get_content_hash(path, self._full_hash_),
+        ]
+        with self._lock_:
+            self._index_[path] = entry
+        return entry[2], entry
+
+    def paths(self, content_hashes: set) -> list:
+        """List the indexed paths of files with the given content hashes."""
+        with self._lock_:
+            return [
+                path
+                for path, entry in self._index_.items()
+                if entry[2] in content_hashes
+            ]
+
+    def items(self) -> dict:
+        """Copy the index, as path -> [size, modification time, content hash]."""
+        with self._lock_:
+            return dict(self._index_)
+
+    def load(self, index: dict) -> None:
+        """Replace the index.
+
+        :param index: The index, as path -> [size, modification time,
+            content hash].
+        """
+        with self._lock_:
+            self._index_ = dict(index)
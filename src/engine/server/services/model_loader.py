@@ -13,39 +13,159 @@
 @License :   Apache License 2.0
 @Desc    :   Module containing the loading functions.
 """
-from flask import Response
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Optional
+
+from flask import Response, jsonify
 
 # pylint: disable=E0401, E0611
-from server import global_store
+from server import MODEL_LOAD_WORKERS, MODEL_WARMUP, global_store, logger, server
 from server.models.abstract.BaseModel import BaseModel
 from server.services.errors import Errors, PortalError
 
+# Models are loaded in the background, so that a long load does not hold the
+# request, nor the atomic status, that started it.
+_load_executor = ThreadPoolExecutor(
+    max_workers=MODEL_LOAD_WORKERS, thread_name_prefix="model_loader"
+)
+_load_lock = threading.Lock()
+# model key -> future of its latest load
+_loads = {}
+
+
+def _set_load_state(model_id: str, state: str, error: Optional[str] = None) -> None:
+    """Record the load state of a model and push it to the SocketIO clients.
+
+    :param model_id: The model key.
+    :param state: One of queued, loading, warming, ready or failed.
+    :param error: The error message of a failed load.
+    """
+    global_store.set_load_state(model_id, state, error)
+    server.socket.emit(
+        "modelLoadState", {"modelId": model_id, "state": state, "error": error}
+    )
+
+
+def _load_error(model_id: str, error: Exception) -> PortalError:
+    """Translate the exception raised by a load into a PortalError.
+
+    :param model_id: The model key.
+    :param error: The exception raised.
+    :return: The corresponding PortalError.
+    """
+    if isinstance(error, PortalError):
+        return error
+    if isinstance(error, KeyError):
+        return PortalError(
+            Errors.INVALIDMODELKEY,
+            model_id + " is not found in registered model list.",
+        )
+    if isinstance(error, TypeError):
+        return PortalError(Errors.UNINITIALIZED, "No models are registered.")
+    if isinstance(error, FileNotFoundError):
+        return PortalError(Errors.INVALIDFILEPATH, str(error))
+    return PortalError(Errors.UNKNOWN, str(error))
+
+
+def _warmup(model: BaseModel) -> None:
+    """Warm up a loaded model, see BaseModel.warmup.
+
+    A model failing on the dummy input is still loaded, its predictions
+    reporting the error if it is broken.
+
+    :param model: The loaded model.
+    """
+    try:
+        model.warmup()
+    except Exception as e:  # pylint: disable=broad-except
+        if logger is not None:
+            logger.warning("Model warm up failed: %s", e)
+
+
+def _load(model_id: str) -> None:
+    """Load and warm up a registered model, then add it to the loaded
+    model list. Runs on the load executor.
+
+    :param model_id: The model key.
+    """
+    registered_model = None
+    try:
+        _set_load_state(model_id, "loading")
+        registered_model: BaseModel = global_store.get_registered_model(model_id)
+        registered_model.load()
+        if MODEL_WARMUP:
+            _set_load_state(model_id, "warming")
+            _warmup(registered_model)
+        global_store.load_model(model_id, registered_model)
+    except Exception as e:  # pylint: disable=broad-except
+        if registered_model is not None:
+            # release the model that could not be loaded or does not fit in
+            # the loaded model list
+            registered_model.unload()
+        error = _load_error(model_id, e)
+        _set_load_state(model_id, "failed", error.get_message())
+        if error is e:
+            raise
+        raise error from e
+    _set_load_state(model_id, "ready")
+
+
+def load_model_async(model_id: str) -> Future:
+    """Queue the load of a model, unless it is already loaded or loading.
+
+    :param model_id: The model key.
+    :return: The future of the load, raising PortalError if it fails.
+    """
+    with _load_lock:
+        future = _loads.get(model_id)
+        if future is not None and not future.done():
+            return future
+        if model_id in global_store.get_loaded_model_keys():
+            future = Future()
+            future.set_result(None)
+            return future
+        # fail right away for unknown models
+        global_store.get_registered_model(model_id)
+        _set_load_state(model_id, "queued")
+        future = _load_executor.submit(_load, model_id)
+        _loads[model_id] = future
+        return future
+
+
+def cancel_load(model_id: str) -> None:
+    """Cancel the queued load of a model, or wait for its running load to
+    complete, so that the model can be unloaded.
 
-def model_loader(model_id: str) -> Response:
+    :param model_id: The model key.
+    """
+    with _load_lock:
+        future = _loads.get(model_id)
+        if future is not None and future.cancel():
+            _set_load_state(model_id, "failed", "Load cancelled.")
+            return
+    if future is not None:
+        wait([future])
+
+
+def model_loader(model_id: str, wait_loaded: bool = True) -> Response:
     """Load the model that is locally stored.
 
     :param model_id: The model key.
-    :returns: Response of status 200 if successful.
+    :param wait_loaded: Whether to wait for the model to be loaded.
+    :returns: Response of status 200 if the model is loaded, or of status
+        202 with the load state if wait_loaded is False and the model is
+        being loaded.
 
     Potential Errors:
         INVALIDMODELKEY:    Model key is not found in registered model list.
         UNINITIALIZED:      No models are registered.
         INVALIDFILEPATH:    saved_model.pbtxt or saved_model.pb not found
                             in directory/saved_model.
+        OVERLOADED:         The model does not fit in the loaded model list.
     """
-    if model_id in list(global_store.get_loaded_model_keys()):
+    future = load_model_async(model_id)
+    if wait_loaded or future.done():
+        future.result()
         return Response(status=200)
-    try:
-        registered_model: BaseModel = global_store.get_registered_model(model_id)
-        registered_model.load()
-        global_store.load_model(model_id, registered_model)
-        return Response(status=200)
-    except KeyError as e:
-        raise PortalError(
-            Errors.INVALIDMODELKEY,
-            model_id + " is not found in registered model list.",
-        ) from e
-    except TypeError as e:
-        raise PortalError(Errors.UNINITIALIZED, "No models are registered.") from e
-    except FileNotFoundError as e:
-        raise PortalError(Errors.INVALIDFILEPATH, str(e)) from e
+    return (jsonify(global_store.get_load_states()[model_id]), 202)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   model_pool.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Module containing the pool of loaded models.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+# Ignore import-error and no-name-in-module due to Pyshell
+# pylint: disable=E0401, E0611
+from server.models.abstract.BaseModel import BaseModel
+from server.services.errors import Errors, PortalError
+
+
+class ModelPool:
+    """Loaded models, within a budget of models and of estimated bytes.
+
+    Models are kept from the least to the most recently used. Loading a
+    model over the budget evicts the least recently used idle models until
+    it fits, models in use being skipped. The load fails with OVERLOADED,
+    without evicting anything, when it cannot fit.
+    """
+
+    def __init__(self, max_models: int, max_bytes: Optional[int]) -> None:
+        """Initialize the ModelPool class.
+
+        :param max_models: The maximum number of loaded models.
+        :param max_bytes: The maximum estimated bytes of the loaded models,
+            None for no limit.
+        """
+        self._max_models_ = max(1, max_models)
+        self._max_bytes_ = max_bytes
+        self._lock_ = threading.RLock()
+        # key -> {"model", "bytes", "loadedAt", "lastUsed"}
+        self._models_ = OrderedDict()
+
+    def _fits_(self, count: int, size: int) -> bool:
+        """Check if count models of size bytes fit in the budget."""
+        return count <= self._max_models_ and (
+            self._max_bytes_ is None or size <= self._max_bytes_
+        )
+
+    def put(
+        self, key: str, model: BaseModel, size: int, busy: Iterable[str] = ()
+    ) -> Dict[str, BaseModel]:
+        """Add a model, evicting the least recently used idle models.
+
+        :param key: The model key.
+        :param model: The loaded model.
+        :param size: The estimated bytes of the model.
+        :param busy: The keys of the models in use, which are not evicted.
+        :return: Dictionary of the evicted model keys to their models.
+        """
+        busy = set(busy)
+        with self._lock_:
+            self._models_.pop(key, None)
+            count = len(self._models_) + 1
+            total = self.size() + size
+            evicted = []
+            for candidate, entry in self._models_.items():
+                if self._fits_(count, total):
+                    break
+                if candidate in busy:
+                    continue
+                evicted.append(candidate)
+                count -= 1
+                total -= entry["bytes"]
+            if not self._fits_(count, total):
+                raise PortalError(
+                    Errors.OVERLOADED,
+                    "Maximum loadable model reached, unload a model in use "
+                    "or raise the model budget.",
+                )
+            now = time.time()
+            self._models_[key] = {
+                "model": model,
+                "bytes": size,
+                "loadedAt": now,
+                "lastUsed": now,
+            }
+            return {
+                candidate: self._models_.pop(candidate)["model"]
+                for candidate in evicted
+            }
+
+    def get(self, key: str) -> BaseModel:
+        """Retrieve a model and mark it as the most recently used.
+
+        :param key: The model key.
+        :return: The loaded model.
+        """
+        with self._lock_:
+            entry = self._models_[key]
+            self._models_.move_to_end(key)
+            entry["lastUsed"] = time.time()
+            return entry["model"]
+
+    def pop(self, key: str) -> BaseModel:
+        """Remove a model.
+
+        :param key: The model key.
+        :return: The removed model.
+        """
+        with self._lock_:
+            return self._models_.pop(key)["model"]
+
+    def keys(self) -> list:
+        """Retrieve the keys of the loaded models, least recently used first."""
+        with self._lock_:
+            return list(self._models_)
+
+    def size(self) -> int:
+        """Retrieve the estimated bytes of the loaded models."""
+        with self._lock_:
+            return sum(entry["bytes"] for entry in self._models_.values())
+
+    def info(self) -> dict:
+        """Retrieve the residency of every loaded model.
+
+        :return: Dictionary of the model keys, least recently used first, to
+            their estimated bytes, load time and last use time (in seconds
+            since the epoch).
+        """
+        with self._lock_:
+            return {
+                key: {
+                    "bytes": entry["bytes"],
+                    "loadedAt": entry["loadedAt"],
+                    "lastUsed": entry["lastUsed"],
+                }
+                for key, entry in self._models_.items()
+            }
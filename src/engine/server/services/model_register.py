@@ -14,6 +14,7 @@
 @Desc    :   Module containing the register functions.
 """
 import os
+from typing import Optional
 
 from datature.nexus import Client
 
@@ -28,10 +29,13 @@ def register_local(
     model_type: str,
     name: str,
     description: str,
+    options: Optional[dict] = None,
 ) -> None:
     """Register a locally stored model.
 
     :param directory: The model directory.
+    :param options: The model options, such as the ONNX Runtime session
+        options of autodetect models, saved with the model in the registry.
     :param height: The model height.
     :param width: The model width.
 
@@ -40,7 +44,7 @@ def register_local(
             saved_model/{saved_model.pb|saved_model.pbtxt}
             is not found in given directory.
     """
-    reg_model = Model(model_type, directory, name, description)
+    reg_model = Model(model_type, directory, name, description, **(options or {}))
     global_store.add_registered_model(*reg_model.register(), store_cache=True)
 
 
@@ -50,12 +54,14 @@ def register_hub(
     project_secret: str,
     name: str,
     description: str,
+    options: Optional[dict] = None,
 ) -> None:
     """Register a model from hub.
 
     :param model_key: The model key obtained from Nexus.
     :param project_key: The project key obtained from Nexus.
     :param project_secret: The project secret obtained from Nexus.
+    :param options: The model options, see register_local.
     """
     try:
         client = Client(secret_key=project_secret)
@@ -89,6 +95,7 @@ def register_hub(
             main_path,
             name,
             description,
+            **(options or {}),
         )
         global_store.add_registered_model(*reg_model.register(), store_cache=True)
 
@@ -102,19 +109,24 @@ def register_hub(
 
 
 def register_endpoint(
-    link: str, project_secret: str, name: str, description: str
+    link: str,
+    project_secret: str,
+    name: str,
+    description: str,
+    options: Optional[dict] = None,
 ) -> None:
     """Register a model from an endpoint.
 
     :param link: The URL of the endpoint.
     :param project_secret: The proejct secret to access the endpoint.
+    :param options: The model options, such as the connection options of
+        the endpoint (see ENDPOINT_OPTIONS).
     """
     reg_model = Model(
         "endpoint",
         "",
         name,
         description,
-        link=link,
-        project_secret=project_secret,
+        **{**(options or {}), "link": link, "project_secret": project_secret},
     )
     global_store.add_registered_model(*reg_model.register(), store_cache=False)
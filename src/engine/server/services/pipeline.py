@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   pipeline.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Module containing the pipelined prediction runner.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+# pylint: disable=E0401, E0611
+from server import PIPELINE_DECODE_WORKERS, PIPELINE_QUEUE_SIZE
+
+# Marks the end of the stream between two stages.
+_END = object()
+
+
+class PredictionPipeline:
+    """Run predictions as threaded stages connected by bounded queues.
+
+    The stages are:
+        1. decode:      a thread pool iterating over the sources, where every
+                        source yields (key, payload) tuples.
+        2. preprocess:  payload -> model input.
+        3. inference:   list of model inputs -> list of detections.
+        4. postprocess: detections -> output.
+
+    Every stage runs on its own thread so that decoding and preprocessing of
+    the next items overlap the model inference of the current one. The model
+    is only ever called from the inference thread, with batches of up to
+    batch_size inputs gathered from the items already waiting in its queue
+    (it never waits for a batch to fill up). Results are yielded in
+    completion order, callers needing a deterministic order should sort on
+    the keys.
+
+    Usage:
+        with PredictionPipeline(preprocess, inference, postprocess) as pipe:
+            for key, output in pipe.run(sources):
+                ...
+    """
+
+    # pylint: disable=R0913
+    def __init__(
+        self,
+        preprocess: Callable,
+        inference: Callable,
+        postprocess: Callable,
+        batch_size: int = 1,
+        decode_workers: int = PIPELINE_DECODE_WORKERS,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+    ) -> None:
+        """Initialize the PredictionPipeline class.
+
+        :param preprocess: Function converting a decoded payload into the
+            model input.
+        :param inference: Function running the model on a list of model
+            inputs, returning a list of detections of the same length.
+        :param postprocess: Function converting detections into the output.
+        :param batch_size: The maximum number of inputs per inference call.
+        :param decode_workers: The number of threads decoding the sources.
+        :param queue_size: The maximum number of items waiting between two
+            stages.
+        """
+        self._stages_ = [preprocess, inference, postprocess]
+        self._batch_size_ = max(1, batch_size)
+        self._decode_workers_ = max(1, decode_workers)
+        self._queues_ = [queue.Queue(maxsize=queue_size) for _ in range(4)]
+        self._stop_event_ = threading.Event()
+        self._threads_ = []
+        self._error_ = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _fail_(self, error: Exception) -> None:
+        """Record the first error raised by a stage and stop the pipeline."""
+        if self._error_ is None:
+            self._error_ = error
+        self._stop_event_.set()
+
+    def _put_(self, target: queue.Queue, item) -> bool:
+        """Put an item into a queue, giving up if the pipeline is stopped.
+
+        :return: Boolean representing if the item has been queued.
+        """
+        while not self._stop_event_.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get_(self, source: queue.Queue):
+        """Get an item from a queue, returning _END if the pipeline is stopped."""
+        while not self._stop_event_.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _decode_source_(self, source: Iterable[Tuple]) -> None:
+        """Push every (key, payload) of a source into the first queue."""
+        try:
+            for item in source:
+                if not self._put_(self._queues_[0], item):
+                    break
+        except Exception as e:  # pylint: disable=broad-except
+            self._fail_(e)
+        finally:
+            # release the resources held by unfinished generators
+            close = getattr(source, "close", None)
+            if close is not None:
+                close()
+
+    def _decode_(self, sources: List[Iterable[Tuple]]) -> None:
+        """Decode all sources with the decode thread pool."""
+        with ThreadPoolExecutor(max_workers=self._decode_workers_) as executor:
+            wait([executor.submit(self._decode_source_, src) for src in sources])
+        self._put_(self._queues_[0], _END)
+
+    def _next_batch_(self, source: queue.Queue, batch_size: int) -> list:
+        """Wait for an item, then gather the waiting items up to batch_size.
+
+        :return: List of (key, value) items, ending with _END at the end of
+            the stream.
+        """
+        batch = [self._get_(source)]
+        while len(batch) < batch_size and batch[-1] is not _END:
+            try:
+                batch.append(source.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_stage_(self, index: int) -> None:
+        """Apply a stage function to every item between two queues."""
+        function = self._stages_[index]
+        is_inference = index == 1
+        batch_size = self._batch_size_ if is_inference else 1
+        source, target = self._queues_[index], self._queues_[index + 1]
+        while True:
+            batch = self._next_batch_(source, batch_size)
+            ended = batch[-1] is _END
+            items = batch[:-1] if ended else batch
+            try:
+                if not items:
+                    values = []
+                elif is_inference:
+                    values = function([value for _, value in items])
+                else:
+                    values = [function(items[0][1])]
+            except Exception as e:  # pylint: disable=broad-except
+                self._fail_(e)
+                return
+            for (key, _), value in zip(items, values):
+                if not self._put_(target, (key, value)):
+                    return
+            if ended:
+                self._put_(target, _END)
+                return
+
+    def run(self, sources: List[Iterable[Tuple]]) -> Iterator[Tuple]:
+        """Run the pipeline over the sources.
+
+        :param sources: List of iterables yielding (key, payload) tuples.
+        :return: Generator of (key, output) tuples.
+        """
+        self._threads_ = [threading.Thread(target=self._decode_, args=(sources,))]
+        self._threads_ += [
+            threading.Thread(target=self._run_stage_, args=(index,))
+            for index in range(len(self._stages_))
+        ]
+        for thread in self._threads_:
+            thread.daemon = True
+            thread.start()
+        while True:
+            item = self._get_(self._queues_[-1])
+            if item is _END:
+                break
+            yield item
+        if self._error_ is not None:
+            raise self._error_
+
+    def close(self) -> None:
+        """Stop all stages and wait for their threads to exit."""
+        self._stop_event_.set()
+        for thread in self._threads_:
+            thread.join()
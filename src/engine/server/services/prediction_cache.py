@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   prediction_cache.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Module containing the memory bounded prediction caches.
+"""
+import atexit
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterator, Optional, Tuple
+
+import numpy as np
+
+# Detection arrays kept by the raw detection cache, the other entries of the
+# detections dictionary are not used by non max suppression.
+RAW_DETECTION_KEYS = (
+    "detection_boxes",
+    "detection_scores",
+    "detection_classes",
+    "detection_masks",
+)
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its values.
+
+    Every value is stored with its size in bytes, as given by the caller.
+    When the total size goes over max_bytes, the least recently used values
+    are evicted and handed to on_evict, with their key and size.
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        on_evict: Optional[Callable[[Hashable, Any, int], None]] = None,
+    ) -> None:
+        """Initialize the LRUCache class.
+
+        :param max_bytes: The maximum total size of the values, None for no
+            limit.
+        :param on_evict: Function called with the key, the value and the size
+            of every evicted entry.
+        """
+        self.max_bytes = max_bytes
+        self._on_evict_ = on_evict
+        self._entries_ = OrderedDict()
+        self._lock_ = threading.RLock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries_
+
+    def __len__(self) -> int:
+        return len(self._entries_)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value, marking it as the most recently used.
+
+        :param key: The key of the value.
+        :param default: The value returned if the key is not in the cache.
+        :return: The value.
+        """
+        with self._lock_:
+            if key not in self._entries_:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries_.move_to_end(key)
+            return self._entries_[key][0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        """Add or replace a value, evicting values if the cache is full.
+
+        :param key: The key of the value.
+        :param value: The value.
+        :param size: The size of the value in bytes.
+        """
+        with self._lock_:
+            self.pop(key)
+            self._entries_[key] = (value, size)
+            self.bytes += size
+            while self.max_bytes is not None and self.bytes > self.max_bytes:
+                evicted_key, (evicted_value, evicted_size) = self._entries_.popitem(
+                    last=False
+                )
+                self.bytes -= evicted_size
+                self.evictions += 1
+                if self._on_evict_ is not None:
+                    self._on_evict_(evicted_key, evicted_value, evicted_size)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a value without evicting it.
+
+        :param key: The key of the value.
+        :param default: The value returned if the key is not in the cache.
+        :return: The value.
+        """
+        with self._lock_:
+            if key not in self._entries_:
+                return default
+            value, size = self._entries_.pop(key)
+            self.bytes -= size
+            return value
+
+    def size(self, key: Hashable) -> int:
+        """Get the size of a value in bytes, 0 if the key is not in the cache."""
+        entry = self._entries_.get(key)
+        return 0 if entry is None else entry[1]
+
+    def items(self) -> list:
+        """List the (key, value) entries from the least recently used."""
+        with self._lock_:
+            return [(key, entry[0]) for key, entry in self._entries_.items()]
+
+    def clear(self) -> None:
+        """Remove all values without evicting them."""
+        with self._lock_:
+            self._entries_.clear()
+            self.bytes = 0
+
+
+class PredictionCache:
+    """Predictions of every model, bounded in memory.
+
+    Predictions are kept in memory as their JSON encoding, computed once when
+    they are added, in a LRUCache keyed by prediction key, (model_id,
+    image/video content hash, additional_parameters), and sized by its
+    length. The same encoding is spilled and journaled, and decoded into a
+    new object by every get. The least recently used predictions
+    over the byte budget are spilled to a SQLite file in the temporary
+    directory and moved back into memory when they are used again.
+
+    Lookups made by contains are counted per model, as hits for predictions
+    in memory, spill hits for predictions on disk and misses otherwise.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        """Initialize the PredictionCache class.
+
+        :param max_bytes: The maximum size of the predictions kept in memory,
+            None for no limit.
+        """
+        self._memory_ = LRUCache(max_bytes, on_evict=self._spill_)
+        self._lock_ = threading.RLock()
+        # model_id -> image/video content hash -> set of additional_parameters
+        self._index_ = {}
+        self._model_bytes_ = {}
+        self._counters_ = {}
+        self._spill_path_ = None
+        self._spill_db_ = None
+        self._spilled_ = 0
+
+    def _count_(self, model_id: str, counter: str, increment: int = 1) -> None:
+        """Increment a counter of a model."""
+        counters = self._counters_.setdefault(
+            model_id, {"hits": 0, "spillHits": 0, "misses": 0, "evictions": 0}
+        )
+        counters[counter] += increment
+
+    def _spill_database_(self) -> sqlite3.Connection:
+        """Open the spill file on the first spill."""
+        if self._spill_db_ is None:
+            spill_fd, self._spill_path_ = tempfile.mkstemp(suffix=".portalSpill")
+            os.close(spill_fd)
+            self._spill_db_ = sqlite3.connect(
+                self._spill_path_, check_same_thread=False, isolation_level=None
+            )
+            self._spill_db_.execute("PRAGMA journal_mode=OFF")
+            self._spill_db_.execute("PRAGMA synchronous=OFF")
+            self._spill_db_.execute(
+                "CREATE TABLE spill (model_id TEXT, content TEXT, params TEXT,"
+                " value TEXT, PRIMARY KEY (model_id, content, params))"
+            )
+            atexit.register(self.close)
+        return self._spill_db_
+
+    def _spill_(self, key: tuple, encoded: str, size: int) -> None:
+        """Write a prediction evicted from memory to the spill file."""
+        self._model_bytes_[key[0]] -= size
+        self._count_(key[0], "evictions")
+        self._spill_database_().execute(
+            "INSERT OR REPLACE INTO spill VALUES (?, ?, ?, ?)",
+            (*key, encoded),
+        )
+        self._spilled_ += 1
+
+    def _unspill_(self, key: tuple) -> Tuple[bool, Any]:
+        """Remove a prediction from the spill file.
+
+        :return: Boolean representing if the prediction was spilled, and
+            the JSON encoding of the prediction.
+        """
+        if self._spill_db_ is None:
+            return False, None
+        row = self._spill_db_.execute(
+            "SELECT value FROM spill WHERE model_id=? AND content=? AND params=?",
+            key,
+        ).fetchone()
+        if row is None:
+            return False, None
+        self._spill_db_.execute(
+            "DELETE FROM spill WHERE model_id=? AND content=? AND params=?", key
+        )
+        self._spilled_ -= 1
+        return True, row[0]
+
+    def put(self, key: tuple, value: Any) -> str:
+        """Add or replace a prediction.
+
+        :param key: The prediction key.
+        :param value: The prediction, JSON serializable.
+        :return: The JSON encoding of the prediction.
+        """
+        encoded = json.dumps(value)
+        self._put_encoded_(key, encoded)
+        return encoded
+
+    def _put_encoded_(self, key: tuple, encoded: str) -> None:
+        """Add or replace the JSON encoding of a prediction."""
+        model_id, content_hash, params = key
+        with self._lock_:
+            params_set = self._index_.setdefault(model_id, {}).setdefault(
+                content_hash, set()
+            )
+            if params in params_set and key not in self._memory_:
+                self._unspill_(key)
+            params_set.add(params)
+            size = len(encoded)
+            self._model_bytes_[model_id] = (
+                self._model_bytes_.get(model_id, 0) - self._memory_.size(key) + size
+            )
+            self._memory_.put(key, encoded, size)
+
+    def contains(self, key: tuple) -> bool:
+        """Check if a prediction is cached, counting the lookup."""
+        with self._lock_:
+            cached = key[2] in self._index_.get(key[0], {}).get(key[1], ())
+            if not cached:
+                self._count_(key[0], "misses")
+            elif key in self._memory_:
+                self._count_(key[0], "hits")
+            else:
+                self._count_(key[0], "spillHits")
+            return cached
+
+    def get(self, key: tuple, default: Any = None) -> Any:
+        """Get a prediction, moving it back into memory if it was spilled.
+
+        :param key: The prediction key.
+        :param default: The value returned if the prediction is not cached.
+        :return: The prediction.
+        """
+        with self._lock_:
+            if key in self._memory_:
+                return json.loads(self._memory_.get(key))
+            spilled, encoded = self._unspill_(key)
+            if not spilled:
+                return default
+            self._put_encoded_(key, encoded)
+            return json.loads(encoded)
+
+    def has_model(self, model_id: str) -> bool:
+        """Check if any prediction of a model is cached."""
+        return model_id in self._index_
+
+    def contents(self, model_id: str) -> list:
+        """List the image/video content hashes with predictions of a model."""
+        with self._lock_:
+            return list(self._index_.get(model_id, {}).keys())
+
+    def clear(self, model_id: str) -> None:
+        """Remove all predictions of a model.
+
+        :param model_id: The model key.
+        :raises KeyError: If the model has no predictions.
+        """
+        with self._lock_:
+            contents = self._index_.pop(model_id)
+            for content_hash, params_set in contents.items():
+                for params in params_set:
+                    self._memory_.pop((model_id, content_hash, params))
+            self._model_bytes_.pop(model_id, None)
+            if self._spill_db_ is not None:
+                self._spilled_ -= self._spill_db_.execute(
+                    "DELETE FROM spill WHERE model_id=?", (model_id,)
+                ).rowcount
+
+    def load(self, predictions: dict) -> None:
+        """Replace the cache with the predictions loaded from the store.
+
+        :param predictions: The predictions as a nested dictionary of
+            model_id -> image/video content hash -> additional_parameters.
+        """
+        with self._lock_:
+            for model_id in list(self._index_):
+                self.clear(model_id)
+            for model_id, contents in predictions.items():
+                for content_hash, params_dict in contents.items():
+                    for params, value in params_dict.items():
+                        self.put((model_id, content_hash, params), value)
+
+    def records(self) -> Iterator[Tuple[tuple, str]]:
+        """Iterate over every (key, JSON encoding of the prediction), in
+        memory or spilled.
+
+        The cache is locked until the iteration ends.
+        """
+        with self._lock_:
+            yield from self._memory_.items()
+            if self._spill_db_ is not None:
+                for row in self._spill_db_.execute("SELECT * FROM spill"):
+                    yield tuple(row[:3]), row[3]
+
+    def stats(self) -> dict:
+        """Retrieve the size and the counters of the cache."""
+        with self._lock_:
+            models = {}
+            spilled = {}
+            if self._spill_db_ is not None:
+                spilled = dict(
+                    self._spill_db_.execute(
+                        "SELECT model_id, COUNT(*) FROM spill GROUP BY model_id"
+                    ).fetchall()
+                )
+            for model_id, contents in self._index_.items():
+                entries = sum(len(params_set) for params_set in contents.values())
+                models[model_id] = {
+                    "entries": entries,
+                    "spilledEntries": spilled.get(model_id, 0),
+                    "bytes": self._model_bytes_.get(model_id, 0),
+                    **self._counters_.get(
+                        model_id,
+                        {"hits": 0, "spillHits": 0, "misses": 0, "evictions": 0},
+                    ),
+                }
+            totals = {
+                counter: sum(counters[counter] for counters in self._counters_.values())
+                for counter in ["hits", "spillHits", "misses", "evictions"]
+            }
+            return {
+                "maxBytes": self._memory_.max_bytes,
+                "bytes": self._memory_.bytes,
+                "entries": len(self._memory_) + self._spilled_,
+                "spilledEntries": self._spilled_,
+                **totals,
+                "models": models,
+            }
+
+    def close(self) -> None:
+        """Close and delete the spill file."""
+        with self._lock_:
+            if self._spill_db_ is not None:
+                self._spill_db_.close()
+                self._spill_db_ = None
+                os.remove(self._spill_path_)
+                self._spilled_ = 0
+
+
+def _is_binary(array: np.ndarray) -> bool:
+    """Check if an array only holds zeros and ones."""
+    if array.dtype == bool:
+        return True
+    if array.dtype.kind == "u":
+        return array.size == 0 or array.max() <= 1
+    return np.array_equal(array, array != 0)
+
+
+def _pack_detections(detections: dict) -> Tuple[dict, int]:
+    """Store the raw detections of an image compactly.
+
+    Binary masks are bit-packed along their last axis, the other arrays are
+    copied as they are, so that unpacking them is lossless.
+
+    :param detections: The detections dictionary returned by a model predict.
+    :return: Tuple of the packed detections and their size in bytes.
+    """
+    packed = {}
+    size = 0
+    for key in RAW_DETECTION_KEYS:
+        if detections.get(key) is None:
+            continue
+        array = np.asarray(detections[key])
+        if key == "detection_masks" and _is_binary(array):
+            bits = np.packbits(
+                array if array.dtype.kind in "bu" else array != 0, axis=-1
+            )
+            packed[key] = {"bits": bits, "shape": array.shape, "dtype": array.dtype}
+            size += bits.nbytes
+        else:
+            packed[key] = np.array(array)
+            size += array.nbytes
+    return packed, size
+
+
+def _unpack_detections(packed: dict) -> dict:
+    """Restore the detections packed by _pack_detections."""
+    detections = {}
+    for key, array in packed.items():
+        if isinstance(array, dict):
+            array = (
+                np.unpackbits(array["bits"], axis=-1, count=array["shape"][-1])
+                .reshape(array["shape"])
+                .astype(array["dtype"], copy=False)
+            )
+        detections[key] = array
+    return detections
+
+
+class RawDetections:
+    """Raw detections of an image, or of the frames of a video, before non
+    max suppression.
+
+    The detections are packed as they are added. Once they take more than
+    max_bytes, they are dropped as they would not fit in the cache anyway.
+    """
+
+    def __init__(self, score_threshold: float, max_bytes: Optional[int] = None):
+        """Initialize the RawDetections class.
+
+        :param score_threshold: The score threshold the detections were
+            filtered with by the model.
+        :param max_bytes: The maximum size of the packed detections, None for
+            no limit.
+        """
+        self.score_threshold = score_threshold
+        self.size = 0
+        self.overflowed = False
+        self._max_bytes_ = max_bytes
+        self._frames_ = {}
+
+    def add(self, index: int, detections: dict) -> None:
+        """Add the detections of a frame.
+
+        :param index: The frame index, 0 for images.
+        :param detections: The detections dictionary returned by the model.
+        """
+        if self.overflowed:
+            return
+        self._frames_[index], size = _pack_detections(detections)
+        self.size += size
+        if self._max_bytes_ is not None and self.size > self._max_bytes_:
+            self._frames_ = {}
+            self.overflowed = True
+
+    def frames(self) -> Iterator[Tuple[int, dict]]:
+        """Iterate over the (frame index, detections), unpacking them one at
+        a time."""
+        for index, packed in self._frames_.items():
+            yield index, _unpack_detections(packed)
+
+
+class RawDetectionCache:
+    """Cache of RawDetections keyed by (model_id, content hash,
+    additional_parameters).
+
+    The additional parameters must only contain the parameters applied by the
+    model ahead of non max suppression, so that the outputs of any iou can be
+    derived from an entry. An entry serves the outputs of any confidence
+    threshold at or above the score threshold of its detections.
+
+    Entries are kept in memory only, in a LRUCache sized by the bytes of
+    their packed arrays.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        """Initialize the RawDetectionCache class.
+
+        :param max_bytes: The maximum size of the entries, None for no limit.
+        """
+        self._memory_ = LRUCache(max_bytes)
+        self._lock_ = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, key: tuple, detections: RawDetections) -> None:
+        """Add or replace an entry, unless its detections overflowed.
+
+        :param key: The raw detection key.
+        :param detections: The raw detections.
+        """
+        if not detections.overflowed:
+            self._memory_.put(key, detections, detections.size)
+
+    def get(self, key: tuple, score_threshold: float) -> Optional[RawDetections]:
+        """Get an entry that can serve a score threshold.
+
+        :param key: The raw detection key.
+        :param score_threshold: The score threshold of the outputs.
+        :return: The raw detections, or None if there is no such entry.
+        """
+        detections = self._memory_.get(key)
+        with self._lock_:
+            if detections is None or detections.score_threshold > score_threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return detections
+
+    def clear(self, model_id: str) -> None:
+        """Remove all entries of a model."""
+        for key, _ in self._memory_.items():
+            if key[0] == model_id:
+                self._memory_.pop(key)
+
+    def stats(self) -> dict:
+        """Retrieve the size and the counters of the cache."""
+        return {
+            "maxBytes": self._memory_.max_bytes,
+            "bytes": self._memory_.bytes,
+            "entries": len(self._memory_),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self._memory_.evictions,
+        }
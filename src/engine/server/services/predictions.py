@@ -14,13 +14,23 @@
 @Desc    :   Module containing the prediction function.
 """
 import os
-from typing import Optional
+import time
+from typing import Callable, Optional
 
 import cv2
 import numpy as np
-from server import global_store
+from server import (
+    PIPELINE_DECODE_WORKERS,
+    PIPELINE_MODE,
+    PIPELINE_QUEUE_SIZE,
+    PREDICTION_BATCH_SIZE,
+    RAW_DETECTION_CACHE_BYTES,
+    global_store,
+)
 from server.models.abstract.BaseModel import BaseModel
 from server.services.errors import Errors, PortalError
+from server.services.pipeline import PredictionPipeline
+from server.services.prediction_cache import RawDetections
 
 # pylint: disable=E0401, E0611
 from server.utils.prediction_utilities import (
@@ -31,28 +41,45 @@ from server.utils.prediction_utilities import (
     visualize,
 )
 
+# Heuristics of the video sampler. Seeking restarts decoding from the closest
+# preceding keyframe, so sequential decoding is preferred unless the sampling
+# interval spans more than one keyframe interval.
+KEYFRAME_SECONDS = 2
+MIN_KEYFRAME_INTERVAL = 12
+INTRA_ONLY_CODECS = {"mjpg", "mjpa", "mjpb", "jpeg", "png ", "ffv1"}
+# Number of images predicted by a folder prediction between two saves of the
+# prediction cache.
+FOLDER_CHECKPOINT_INTERVAL = 50
+
+
+def _preprocess_image(image_array: np.ndarray) -> np.ndarray:
+    """Convert a BGR(A) image read by OpenCV into the RGB model input.
+
+    :param image_array: The single image as an array.
+    :return: The RGB image array.
+    """
+    return cv2.cvtColor(image_array, cv2.COLOR_BGRA2RGB)
+
 
 # pylint: disable=R0913
-def _predict_single_image(
+def _postprocess_detections(
     model_class: BaseModel,
     format_arg: str,
     iou: float,
     image_array: np.ndarray,
+    detections: dict,
     confidence: Optional[float] = 0.001,
 ):
-    """Make predictions on a single image.
+    """Suppress the raw detections and convert them into the output format.
 
     :param model_class: A dictionary of the loaded model and its model class.
     :param format_arg: The output format.
     :param iou: The intersection of union threshold.
-    :param image_array: The single image as an array.
+    :param image_array: The preprocessed image as an array.
+    :param detections: The detections returned by the model.
     :param confidence: The confidence threshold.
     :return: The predictions in the format requested by format_arg.
     """
-    image_array = cv2.cvtColor(image_array, cv2.COLOR_BGRA2RGB)
-    detections = model_class.predict(
-        image_array=image_array,
-    )
     suppressed_output = get_suppressed_output(
         detections=detections,
         filter_id=None,
@@ -75,29 +102,699 @@ def _predict_single_image(
     return output
 
 
+# pylint: disable=R0913
+def _predict_single_image(
+    model_class: BaseModel,
+    format_arg: str,
+    iou: float,
+    image_array: np.ndarray,
+    confidence: Optional[float] = 0.001,
+    top_k: Optional[int] = None,
+    raw_detections: Optional[RawDetections] = None,
+    frame_index: int = 0,
+):
+    """Make predictions on a single image.
+
+    :param model_class: A dictionary of the loaded model and its model class.
+    :param format_arg: The output format.
+    :param iou: The intersection of union threshold.
+    :param image_array: The single image as an array.
+    :param confidence: The confidence threshold.
+    :param top_k: The maximum number of detections kept ahead of non max
+        suppression, or None to keep all of them.
+    :param raw_detections: RawDetections collecting the detections returned
+        by the model, under frame_index.
+    :param frame_index: The frame index of the image, 0 for images.
+    :return: The predictions in the format requested by format_arg.
+    """
+    image_array = _preprocess_image(image_array)
+    detections = model_class.predict_batch(
+        [image_array],
+        top_k=top_k,
+        score_threshold=confidence,
+    )[0]
+    if raw_detections is not None:
+        raw_detections.add(frame_index, detections)
+    return _postprocess_detections(
+        model_class=model_class,
+        format_arg=format_arg,
+        iou=iou,
+        image_array=image_array,
+        detections=detections,
+        confidence=confidence,
+    )
+
+
+# pylint: disable=R0913
 def predict_image(
     model_class: BaseModel,
     format_arg: str,
     iou: float,
     image_directory: str,
+    top_k: Optional[int] = None,
+    prediction_key: Optional[tuple] = None,
+    reanalyse: bool = False,
 ):
     """Make predictions on a single image.
 
+    Given the prediction key, the raw detections of the model are cached so
+    that the predictions of any other iou or output format are derived from
+    them without running the model.
+
     :param model_class: A dictionary of the loaded model and its model class.
     :param format_arg: The output format.
     :param iou: The intersection of union threshold.
     :param image_directory: The directory of the single image.
+    :param top_k: The maximum number of detections kept ahead of non max
+        suppression, or None to keep all of them.
+    :param prediction_key: The prediction key, see image_prediction_key.
+    :param reanalyse: Flag to bypass the raw detection cache.
     :return: The predictions in the format requested by format_arg.
     """
-    image_arr = cv2.imread(image_directory)
-    return _predict_single_image(
+    raw_key = (
+        None
+        if prediction_key is None
+        else _raw_detection_key(prediction_key, _top_k_param(top_k))
+    )
+    cached = (
+        None
+        if raw_key is None or reanalyse
+        else global_store.get_raw_detections(raw_key, 0.001)
+    )
+    if cached is not None:
+        _, detections = next(cached.frames())
+        image_array = None
+        if format_arg == "image":
+            image_array = _preprocess_image(cv2.imread(image_directory))
+        return _postprocess_detections(
+            model_class=model_class,
+            format_arg=format_arg,
+            iou=iou,
+            image_array=image_array,
+            detections=detections,
+        )
+    raw_detections = RawDetections(0.001, RAW_DETECTION_CACHE_BYTES)
+    output = _predict_single_image(
         model_class=model_class,
         format_arg=format_arg,
         iou=iou,
-        image_array=image_arr,
+        image_array=cv2.imread(image_directory),
+        top_k=top_k,
+        raw_detections=raw_detections,
+    )
+    if raw_key is not None:
+        global_store.add_raw_detections(raw_key, raw_detections)
+    return output
+
+
+def _top_k_param(top_k: Optional[int]) -> str:
+    """Suffix of the prediction parameters for the pre-NMS top-K cap.
+
+    Left empty without a cap, so that existing cache entries remain valid.
+    """
+    return "" if top_k is None else "topK" + str(top_k)
+
+
+def _raw_detection_key(prediction_key: tuple, params: str) -> tuple:
+    """Build the raw detection cache key of the asset of a prediction key.
+
+    :param prediction_key: The prediction key.
+    :param params: The parameters applied by the model ahead of non max
+        suppression.
+    :return: The raw detection key.
+    """
+    return (prediction_key[0], prediction_key[1], params)
+
+
+def image_prediction_key(
+    model_id: str,
+    image_directory: str,
+    format_arg: str,
+    iou: float,
+    top_k: Optional[int] = None,
+) -> tuple:
+    """Build the prediction cache key of a single image prediction.
+
+    Images are keyed by content hash, so that copies of an image share their
+    predictions, and a modified image is predicted again.
+
+    :param model_id: The model key.
+    :param image_directory: The directory of the single image.
+    :param format_arg: The output format.
+    :param iou: The intersection of union threshold.
+    :param top_k: The pre-NMS top-K cap.
+    :return: The prediction key.
+    """
+    return (
+        model_id,
+        global_store.get_content_hash(image_directory),
+        format_arg + str(iou) + _top_k_param(top_k),
     )
 
 
+# pylint: disable=R0913
+def video_prediction_key(
+    model_id: str,
+    video_directory: str,
+    frame_interval: int,
+    iou: float,
+    confidence: float,
+    top_k: Optional[int] = None,
+) -> tuple:
+    """Build the prediction cache key of a video prediction, keyed by content
+    hash as for images.
+
+    :param model_id: The model key.
+    :param video_directory: The directory of the video.
+    :param frame_interval: The sampling interval of the video.
+    :param iou: The intersection of union threshold.
+    :param confidence: The confidence threshold.
+    :param top_k: The pre-NMS top-K cap.
+    :return: The prediction key.
+    """
+    return (
+        model_id,
+        global_store.get_content_hash(video_directory),
+        str(frame_interval) + str(iou) + str(confidence) + _top_k_param(top_k),
+    )
+
+
+def _read_images(image_directories: list):
+    """Read images from disk, skipping the files that cannot be decoded.
+
+    :param image_directories: List of image directories.
+    :return: Generator of (image directory, image array) tuples.
+    """
+    for image_directory in image_directories:
+        image_arr = cv2.imread(image_directory)
+        if image_arr is not None:
+            yield image_directory, image_arr
+
+
+def _predict_folder_pipelined(
+    inference: Callable,
+    postprocess: Callable,
+    image_directories: list,
+    add_inference: Callable,
+    batch_size: int,
+) -> None:
+    """Run the images through the model with the PredictionPipeline.
+
+    :param inference: The inference stage, see _pipeline_stages.
+    :param postprocess: The postprocess stage, see _pipeline_stages.
+    :param image_directories: List of the directories of the images.
+    :param add_inference: Function called with the directory of every image
+        and the output of its postprocess stage.
+    :param batch_size: The maximum number of images per model call.
+    """
+    sources = [
+        _read_images(image_directories[index::PIPELINE_DECODE_WORKERS])
+        for index in range(PIPELINE_DECODE_WORKERS)
+    ]
+    with PredictionPipeline(
+        _preprocess_image, inference, postprocess, batch_size=batch_size
+    ) as pipeline:
+        for image_directory, result in pipeline.run(sources):
+            add_inference(image_directory, result)
+
+
+def _predict_folder_serial(
+    inference: Callable,
+    postprocess: Callable,
+    image_directories: list,
+    add_inference: Callable,
+    **_,
+) -> None:
+    """Run the images through the model one after another.
+
+    :param inference: The inference stage, see _pipeline_stages.
+    :param postprocess: The postprocess stage, see _pipeline_stages.
+    :param image_directories: List of the directories of the images.
+    :param add_inference: Function called with the directory of every image
+        and the output of its postprocess stage.
+    """
+    for image_directory, image_array in _read_images(image_directories):
+        image_array = _preprocess_image(image_array)
+        add_inference(image_directory, postprocess(inference([image_array])[0]))
+
+
+# pylint: disable=R0913, R0914
+def predict_folder(
+    model_class: BaseModel,
+    model_id: str,
+    format_arg: str,
+    iou: float,
+    image_directories: list,
+    batch_size: int = PREDICTION_BATCH_SIZE,
+    reanalyse: bool = False,
+    top_k: Optional[int] = None,
+) -> dict:
+    """Make predictions on all images within a folder.
+
+    Images are read ahead by the decode thread pool of a PredictionPipeline
+    and run through the model in batches, or read and run through the model
+    one after another when PIPELINE_MODE is off. Every prediction is added into the
+    prediction cache under the same key as predict_image, and images which
+    are already cached are skipped unless reanalyse is set, so a folder
+    prediction that has been stopped resumes where it left off. Images with
+    the same content are only predicted once, and images with cached raw
+    detections are not run through the model.
+
+    :param model_class: A dictionary of the loaded model and its model class.
+    :param model_id: The model key.
+    :param format_arg: The output format.
+    :param iou: The intersection of union threshold.
+    :param image_directories: List of the directories of the images.
+    :param batch_size: The maximum number of images per model call.
+    :param reanalyse: Flag to bypass cache and force reanalysis.
+    :param top_k: The maximum number of detections kept ahead of non max
+        suppression, or None to keep all of them.
+    :return: Dictionary with the number of images in the folder, and the
+        number of them that were predicted, cached or could not be read.
+    """
+    # prediction key -> directories of the images with that content
+    pending = {}
+    total = len(image_directories)
+    cached = 0
+    for image_directory in image_directories:
+        try:
+            prediction_key = image_prediction_key(
+                model_id, image_directory, format_arg, iou, top_k
+            )
+        except OSError:
+            continue
+        if prediction_key in pending:
+            pending[prediction_key].append(image_directory)
+        elif reanalyse or not global_store.check_prediction_cache(prediction_key):
+            pending[prediction_key] = [image_directory]
+        else:
+            cached += 1
+    # the first image of every content is predicted
+    prediction_keys = {
+        directories[0]: prediction_key
+        for prediction_key, directories in pending.items()
+    }
+    raw_params = _top_k_param(top_k)
+    global_store.set_prediction_progress("folder", cached, total)
+    inference, postprocess = _pipeline_stages(
+        model_class, format_arg, iou, 0.001, top_k, keep_detections=True
+    )
+    predicted = 0
+    inferred = 0
+
+    def add_output(image_directory, output):
+        nonlocal predicted, inferred
+        # check between each image if the process-stop flag is set.
+        # kills the folder prediction if it has been set.
+        if global_store.get_stop():
+            global_store.clear_stop()
+            raise PortalError(Errors.STOPPEDPROCESS, "folder prediction killed.")
+        prediction_key = prediction_keys[image_directory]
+        predicted += len(pending[prediction_key])
+        inferred += 1
+        global_store.add_predictions(
+            prediction_key,
+            output,
+            store_cache=inferred % FOLDER_CHECKPOINT_INTERVAL == 0,
+        )
+        global_store.set_prediction_progress("folder", cached + predicted, total)
+
+    def add_inference(image_directory, inference_output):
+        output, detections = inference_output
+        raw_detections = RawDetections(0.001, RAW_DETECTION_CACHE_BYTES)
+        raw_detections.add(0, detections)
+        global_store.add_raw_detections(
+            _raw_detection_key(prediction_keys[image_directory], raw_params),
+            raw_detections,
+        )
+        add_output(image_directory, output)
+
+    uncached_directories = []
+    try:
+        for image_directory, prediction_key in prediction_keys.items():
+            raw_detections = (
+                None
+                if reanalyse
+                else global_store.get_raw_detections(
+                    _raw_detection_key(prediction_key, raw_params), 0.001
+                )
+            )
+            if raw_detections is None:
+                uncached_directories.append(image_directory)
+                continue
+            image_array = None
+            if format_arg == "image":
+                image_array = cv2.imread(image_directory)
+                if image_array is None:
+                    continue
+                image_array = _preprocess_image(image_array)
+            add_output(
+                image_directory,
+                _postprocess_detections(
+                    model_class=model_class,
+                    format_arg=format_arg,
+                    iou=iou,
+                    image_array=image_array,
+                    detections=next(raw_detections.frames())[1],
+                ),
+            )
+        predict_images = (
+            _predict_folder_pipelined if PIPELINE_MODE else _predict_folder_serial
+        )
+        predict_images(
+            inference,
+            postprocess,
+            uncached_directories,
+            add_inference,
+            batch_size=batch_size,
+        )
+    finally:
+        global_store.save_predictions()
+        global_store.set_prediction_progress("none", 1, 1)
+    return {
+        "total": total,
+        "predicted": predicted,
+        "cached": cached,
+        "failed": total - cached - predicted,
+    }
+
+
+def _estimate_keyframe_interval(cap: cv2.VideoCapture) -> int:
+    """Estimate the number of frames between two keyframes of a video.
+
+    OpenCV does not expose the GOP size of a stream, so it is inferred from
+    the codec and the frame rate. Intra-only codecs have a keyframe on every
+    frame, while inter-frame codecs are assumed to place one every
+    KEYFRAME_SECONDS seconds.
+
+    :param cap: The opened video capture.
+    :return: The estimated keyframe interval in frames.
+    """
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    codec = "".join(chr((fourcc >> 8 * index) & 0xFF) for index in range(4))
+    if codec.lower() in INTRA_ONLY_CODECS:
+        return 1
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    return max(MIN_KEYFRAME_INTERVAL, int(round(fps * KEYFRAME_SECONDS)))
+
+
+def _seek_frame(cap: cv2.VideoCapture, frame_index: int) -> bool:
+    """Move a video capture to a frame.
+
+    Depending on the backend and the container, seeking can land on the
+    keyframe preceding the requested frame rather than on the frame itself.
+    The position is read back after the seek and the capture is grabbed
+    forward to the requested frame.
+
+    :param cap: The opened video capture.
+    :param frame_index: The index of the frame to be read next.
+    :return: Boolean representing if the capture is on the frame, False if
+        the seek went past it or the video ended before it.
+    """
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    if not 0 <= position <= frame_index:
+        return False
+    for _ in range(frame_index - position):
+        if not cap.grab():
+            return False
+    return True
+
+
+def _decode_to_frame(cap: cv2.VideoCapture, frame_index: int) -> bool:
+    """Move a video capture to a frame by decoding from the start of the video.
+
+    :param cap: The opened video capture.
+    :param frame_index: The index of the frame to be read next.
+    :return: Boolean representing if the video reached the frame.
+    """
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for _ in range(frame_index):
+        if not cap.grab():
+            return False
+    return True
+
+
+def sample_video_frames(
+    cap: cv2.VideoCapture,
+    frame_interval: int,
+    start_frame: int = 0,
+    end_frame: Optional[int] = None,
+):
+    """Yield every frame_interval-th frame of a video.
+
+    Frames are decoded sequentially and skipped frames are only grabbed
+    (decoded, but never converted to an array). Seeking makes the decoder
+    restart from the closest preceding keyframe, so it only pays off when the
+    sampling interval spans more than one keyframe interval. Every seek is
+    checked with _seek_frame, and if one does not reach its frame, the video
+    is decoded from the start up to that frame and seeking is not used
+    again, so that the sampled frames are the ones a sequential pass
+    would sample. The initial
+    choice is made from the estimated keyframe interval. Afterwards the cost
+    of both strategies is tracked (sequential decoding is estimated from the
+    first decoded frame, seeking is probed once) and the cheaper one is used.
+
+    :param cap: The opened video capture.
+    :param frame_interval: The sampling interval of the video.
+    :param start_frame: The index of the first frame to be sampled.
+    :param end_frame: The index of the frame to stop at (exclusive),
+        or None to sample until the end of the video.
+    :return: Generator of (frame index, frame) tuples.
+    """
+    exact_seek = True
+    frame_index = start_frame
+    if start_frame > 0 and not _seek_frame(cap, start_frame):
+        exact_seek = False
+        if not _decode_to_frame(cap, start_frame):
+            return
+    use_seek = exact_seek and frame_interval > _estimate_keyframe_interval(cap)
+    start = time.perf_counter()
+    ret, frame = cap.read()
+    # exponentially weighted cost of advancing to the next sampled frame,
+    # for sequential decoding (False) and for seeking (True).
+    advance_cost = {
+        False: (time.perf_counter() - start) * frame_interval,
+        True: None,
+    }
+    while ret:
+        yield frame_index, frame
+        frame_index += frame_interval
+        if end_frame is not None and frame_index >= end_frame:
+            return
+        start = time.perf_counter()
+        if use_seek:
+            if not _seek_frame(cap, frame_index):
+                exact_seek = use_seek = False
+                if not _decode_to_frame(cap, frame_index):
+                    return
+        else:
+            for _ in range(frame_interval - 1):
+                if not cap.grab():
+                    return
+        ret, frame = cap.read()
+        cost = time.perf_counter() - start
+        previous = advance_cost[use_seek]
+        advance_cost[use_seek] = (
+            cost if previous is None else 0.8 * previous + 0.2 * cost
+        )
+        if frame_interval > 1 and exact_seek:
+            # probe seeking once, then keep the cheaper strategy
+            use_seek = (
+                advance_cost[True] is None or advance_cost[True] < advance_cost[False]
+            )
+
+
+def _pipeline_stages(
+    model_class: BaseModel,
+    format_arg: str,
+    iou: float,
+    confidence: float,
+    top_k: Optional[int] = None,
+    keep_detections: bool = False,
+) -> tuple:
+    """Build the inference and postprocess stages of a PredictionPipeline.
+
+    :param model_class: A dictionary of the loaded model and its model class.
+    :param format_arg: The output format.
+    :param iou: The intersection of union threshold.
+    :param confidence: The confidence threshold.
+    :param top_k: The maximum number of detections kept ahead of non max
+        suppression, or None to keep all of them.
+    :param keep_detections: Whether postprocess returns the detections of
+        the model along with the output, as an (output, detections) tuple.
+    :return: Tuple of the inference and postprocess functions.
+    """
+
+    def inference(image_arrays):
+        detections = model_class.predict_batch(
+            image_arrays, top_k=top_k, score_threshold=confidence
+        )
+        return list(zip(image_arrays, detections))
+
+    def postprocess(inference_output):
+        image_array, detections = inference_output
+        output = _postprocess_detections(
+            model_class=model_class,
+            format_arg=format_arg,
+            iou=iou,
+            image_array=image_array,
+            detections=detections,
+            confidence=confidence,
+        )
+        return (output, detections) if keep_detections else output
+
+    return inference, postprocess
+
+
+def _video_segment(
+    video_directory: str,
+    frame_interval: int,
+    start_frame: int,
+    end_frame: Optional[int],
+):
+    """Sample one segment of a video with its own video capture.
+
+    :param video_directory: The directory of the video.
+    :param frame_interval: The sampling interval of the video.
+    :param start_frame: The index of the first frame of the segment.
+    :param end_frame: The index of the frame ending the segment (exclusive).
+    :return: Generator of (frame index, frame) tuples.
+    """
+    cap = cv2.VideoCapture(video_directory)
+    try:
+        yield from sample_video_frames(cap, frame_interval, start_frame, end_frame)
+    finally:
+        cap.release()
+
+
+def _split_video(
+    video_directory: str,
+    frame_interval: int,
+    total_frames: int,
+) -> list:
+    """Split a video into segments to be decoded by the decode thread pool.
+
+    Every segment starts on a sampled frame, so that the union of the
+    segments samples the same frames as a single sequential pass. Segments
+    after the first one start with a seek, so if a probe seek to the start
+    of the second segment does not reach its frame, the video is decoded as
+    a single segment instead.
+
+    :param video_directory: The directory of the video.
+    :param frame_interval: The sampling interval of the video.
+    :param total_frames: The number of frames reported by the container.
+    :return: List of segment generators.
+    """
+    samples = -(-total_frames // frame_interval)
+    num_segments = min(
+        PIPELINE_DECODE_WORKERS, max(1, samples // (2 * PIPELINE_QUEUE_SIZE))
+    )
+    segment_length = -(-samples // num_segments) * frame_interval
+    if num_segments > 1:
+        cap = cv2.VideoCapture(video_directory)
+        try:
+            if not _seek_frame(cap, segment_length):
+                num_segments = 1
+        finally:
+            cap.release()
+    return [
+        _video_segment(
+            video_directory,
+            frame_interval,
+            index * segment_length,
+            # the frame count reported by containers can be inaccurate,
+            # so the last segment always runs until the end of the video.
+            None if index == num_segments - 1 else (index + 1) * segment_length,
+        )
+        for index in range(num_segments)
+    ]
+
+
+def _stop_video_prediction() -> None:
+    """Clean up after the process-stop flag has been set."""
+    cv2.destroyAllWindows()
+    global_store.clear_stop()
+    raise PortalError(Errors.STOPPEDPROCESS, "video prediction killed.")
+
+
+# pylint: disable=R0913
+def _predict_video_pipelined(
+    model_class: BaseModel,
+    iou: float,
+    video_directory: str,
+    frame_interval: int,
+    confidence: float,
+    total_frames: int,
+    batch_size: int,
+    top_k: Optional[int],
+    raw_detections: Optional[RawDetections],
+) -> dict:
+    """Make predictions on the sampled frames with the PredictionPipeline.
+
+    :return: Dictionary of the predictions keyed by their frame index.
+    """
+    inference, postprocess = _pipeline_stages(
+        model_class, "json", iou, confidence, top_k, keep_detections=True
+    )
+    sources = _split_video(video_directory, frame_interval, max(total_frames, 0))
+    results = {}
+    with PredictionPipeline(
+        _preprocess_image, inference, postprocess, batch_size=batch_size
+    ) as pipeline:
+        for count, (single_output, detections) in pipeline.run(sources):
+            # check between each frame if the process-stop flag is set.
+            # kills the video prediction if it has been set.
+            if global_store.get_stop():
+                _stop_video_prediction()
+            results[count] = single_output
+            if raw_detections is not None:
+                raw_detections.add(count, detections)
+            global_store.set_prediction_progress(
+                "video", min(len(results) * frame_interval, total_frames), total_frames
+            )
+    return results
+
+
+# pylint: disable=R0913
+def _predict_video_serial(
+    model_class: BaseModel,
+    iou: float,
+    video_directory: str,
+    frame_interval: int,
+    confidence: float,
+    total_frames: int,
+    top_k: Optional[int],
+    raw_detections: Optional[RawDetections],
+    **_,
+) -> dict:
+    """Make predictions on the sampled frames one after another.
+
+    :return: Dictionary of the predictions keyed by their frame index.
+    """
+    results = {}
+    for count, frame in _video_segment(video_directory, frame_interval, 0, None):
+        # check between each iteration if the process-stop flag is set.
+        # kills the video prediction if it has been set.
+        if global_store.get_stop():
+            _stop_video_prediction()
+        # make inference the frame
+        results[count] = _predict_single_image(
+            model_class=model_class,
+            format_arg="json",
+            iou=iou,
+            image_array=frame,
+            confidence=confidence,
+            top_k=top_k,
+            raw_detections=raw_detections,
+            frame_index=count,
+        )
+        global_store.set_prediction_progress(
+            "video", count + frame_interval, total_frames
+        )
+    return results
+
+
 # pylint: disable=R0913
 def predict_video(
     model_class: BaseModel,
@@ -105,50 +802,84 @@ def predict_video(
     video_directory: str,
     frame_interval: int,
     confidence: float,
+    batch_size: int = PREDICTION_BATCH_SIZE,
+    top_k: Optional[int] = None,
+    prediction_key: Optional[tuple] = None,
+    reanalyse: bool = False,
 ):
     """Make predictions on a multiple images within the video.
 
+    Given the prediction key, the raw detections of the model on every frame
+    are cached so that the predictions of any other iou, or of a higher
+    confidence threshold, are derived from them without running the model.
+
     :param model_class: A dictionary of the loaded model and its model class.
     :param iou: The intersection of union threshold.
     :param video_directory: The directory of the video.
     :param frame_interval: The sampling interval of the video.
     :param confidence: The confidence threshold.
+    :param batch_size: The maximum number of frames per model call.
+    :param top_k: The maximum number of detections kept ahead of non max
+        suppression, or None to keep all of them.
+    :param prediction_key: The prediction key, see video_prediction_key.
+    :param reanalyse: Flag to bypass the raw detection cache.
     :return: The predictions in the format requested by format_arg.
     """
     cap = cv2.VideoCapture(os.path.join(video_directory))
     fps = cap.get(cv2.CAP_PROP_FPS)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    global_store.set_prediction_progress("video", 0, total_frames)
-    output_dict = {"fps": fps, "frames": {}}
-    count = 0
-    while cap.isOpened():
-        # check between each iteration if the process-stop flag is set.
-        # kills the video prediction if it has been set.
-        if global_store.get_stop():
-            cap.release()
-            cv2.destroyAllWindows()
-            global_store.clear_stop()
-            raise PortalError(Errors.STOPPEDPROCESS, "video prediction killed.")
-        # Capture frame-by-frame
-        ret, frame = cap.read()
-        if ret:
-            cap.set(1, count)
-            # make inference the frame
-            single_output = _predict_single_image(
+    cap.release()
+    raw_key = (
+        None
+        if prediction_key is None
+        else _raw_detection_key(
+            prediction_key, str(frame_interval) + _top_k_param(top_k)
+        )
+    )
+    cached = (
+        None
+        if raw_key is None or reanalyse
+        else global_store.get_raw_detections(raw_key, confidence)
+    )
+    if cached is not None:
+        results = {
+            count: _postprocess_detections(
                 model_class=model_class,
                 format_arg="json",
                 iou=iou,
-                image_array=frame,
+                image_array=None,
+                detections=detections,
                 confidence=confidence,
             )
-            # add the inferences into the dictionary
-            output_dict["frames"][int(count / fps * 1000)] = single_output
-            # move on to the next frame
-            count += frame_interval
-            global_store.set_prediction_progress("video", count, total_frames)
-        else:
-            cap.release()
-            break
+            for count, detections in cached.frames()
+        }
+    else:
+        global_store.set_prediction_progress("video", 0, total_frames)
+        predict_frames = (
+            _predict_video_pipelined if PIPELINE_MODE else _predict_video_serial
+        )
+        raw_detections = (
+            None
+            if raw_key is None
+            else RawDetections(confidence, RAW_DETECTION_CACHE_BYTES)
+        )
+        results = predict_frames(
+            model_class,
+            iou=iou,
+            video_directory=video_directory,
+            frame_interval=frame_interval,
+            confidence=confidence,
+            total_frames=total_frames,
+            batch_size=batch_size,
+            top_k=top_k,
+            raw_detections=raw_detections,
+        )
+        if raw_detections is not None:
+            global_store.add_raw_detections(raw_key, raw_detections)
+    # add the inferences into the dictionary in frame order
+    output_dict = {"fps": fps, "frames": {}}
+    for count in sorted(results):
+        output_dict["frames"][int(count / fps * 1000)] = results[count]
     global_store.set_prediction_progress("none", 1, 1)
     cv2.destroyAllWindows()
     return output_dict
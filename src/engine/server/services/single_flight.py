@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   single_flight.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Module containing the coalescing of atomic function calls.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Iterable, Optional
+
+# Ignore import-error and no-name-in-module due to Pyshell
+# pylint: disable=E0401, E0611
+from server.services.errors import Errors, PortalError
+
+
+class SingleFlight:
+    """Coalesce identical calls of atomic functions.
+
+    Every call is keyed by its full status, the name of the atomic function
+    followed by all the arguments changing its result. Identical calls share
+    one computation: the first call runs and the others wait for its
+    result. The result of a successful call is kept for ttl seconds after it
+    completes, so that identical calls arriving shortly after, such as the
+    same request sent from several tabs, are served without running again.
+
+    Calls also declare the resources they use. Calls sharing a resource run
+    one at a time, and a call without any resource runs alone. Starting a
+    call changing its resources, such as unloading a model, discards the
+    kept results of the calls sharing one of them.
+    """
+
+    def __init__(self, timeout: Optional[float], ttl: float) -> None:
+        """Initialize the SingleFlight class.
+
+        :param timeout: Seconds a call waits for the calls sharing one of its
+            resources before failing with ATOMICERROR, None to wait forever.
+        :param ttl: Seconds the result of a completed call is kept.
+        """
+        self._timeout_ = timeout
+        self._ttl_ = ttl
+        self._condition_ = threading.Condition()
+        # key -> (resources, future) of the running calls
+        self._running_ = {}
+        # key -> (resources, future, completion time) of the completed calls
+        self._completed_ = {}
+        self._thread_ = threading.local()
+
+    def acquire(
+        self, key: str, resources: Iterable[str], invalidates: bool = True
+    ) -> Optional[Future]:
+        """Start a call, or join the identical call.
+
+        :param key: The full status of the call.
+        :param resources: The resources used by the call.
+        :param invalidates: Whether the call changes its resources, and so
+            discards the kept results of the calls sharing them.
+        :return: The future of the identical call if it is running or
+            recently completed, else None once the call is started by the
+            current thread.
+        """
+        resources = frozenset(resources)
+        deadline = None if self._timeout_ is None else time.monotonic() + self._timeout_
+        with self._condition_:
+            while True:
+                self._expire_()
+                if key in self._running_:
+                    return self._running_[key][1]
+                if key in self._completed_:
+                    return self._completed_[key][1]
+                if not any(
+                    _conflicts(resources, used) for used, _ in self._running_.values()
+                ):
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PortalError(
+                        Errors.ATOMICERROR, "Another atomic process is already running."
+                    )
+                self._condition_.wait(remaining)
+            for completed_key, (used, _, _) in list(self._completed_.items()):
+                if invalidates and _conflicts(resources, used):
+                    del self._completed_[completed_key]
+            self._running_[key] = (resources, Future())
+        self._thread_.key = key
+        return None
+
+    def release(self, result: Any, retain: bool = True) -> None:
+        """Complete the call started by the current thread, if any.
+
+        :param result: The result passed on to the identical calls.
+        :param retain: Whether to keep the result for the identical calls
+            arriving within the ttl.
+        """
+        key = getattr(self._thread_, "key", None)
+        if key is None:
+            return
+        self._thread_.key = None
+        with self._condition_:
+            resources, future = self._running_.pop(key)
+            future.set_result(result)
+            if retain and self._ttl_ > 0:
+                self._completed_[key] = (resources, future, time.monotonic())
+            self._condition_.notify_all()
+
+    def _expire_(self) -> None:
+        """Discard the results kept for longer than the ttl."""
+        expiry = time.monotonic() - self._ttl_
+        for key, (_, _, completed) in list(self._completed_.items()):
+            if completed <= expiry:
+                del self._completed_[key]
+
+    def current(self) -> Optional[str]:
+        """Get the key of the call started by the current thread, if any."""
+        return getattr(self._thread_, "key", None)
+
+    def running(self) -> list:
+        """Get the keys of the running calls."""
+        with self._condition_:
+            return list(self._running_)
+
+    def resources(self) -> set:
+        """Get the resources used by the running calls."""
+        with self._condition_:
+            return set().union(*(used for used, _ in self._running_.values()))
+
+    def is_running(self) -> bool:
+        """Check if any call is running."""
+        return bool(self._running_)
+
+
+def _conflicts(resources: frozenset, used: frozenset) -> bool:
+    """Check if two calls using these resources cannot run concurrently."""
+    return not resources or not used or not resources.isdisjoint(used)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   store_journal.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Module containing the append-only journal of the store cache.
+"""
+import json
+import os
+import threading
+from typing import Callable, Iterable, Union
+
+# The journal is compacted once the records appended since the last snapshot
+# take more space than the snapshot itself, and at least this many bytes.
+COMPACTION_MIN_BYTES = 4 * 1024 * 1024
+
+
+def apply_record(store: dict, record: dict) -> None:
+    """Apply a journal record to a store.
+
+    :param store: The store, as saved in the cache.
+    :param record: The journal record.
+    """
+    operation = record["op"]
+    if operation == "prediction":
+        model_id, img_vid_dir, params = record["key"]
+        model_predictions = store["predictions"].setdefault(model_id, {})
+        model_predictions.setdefault(img_vid_dir, {})[params] = record["value"]
+    elif operation == "clear_predictions":
+        store["predictions"].pop(record["model_id"], None)
+    elif operation == "registry":
+        store["registry"] = record["registry"]
+    elif operation == "targeted_folders":
+        store["targeted_folders"] = record["targeted_folders"]
+    elif operation == "fingerprint":
+        store.setdefault("fingerprints", {})[record["path"]] = record["entry"]
+
+
+def prediction_record(key: tuple, encoded_value: str) -> str:
+    """Encode the journal record of a prediction.
+
+    :param key: The prediction key.
+    :param encoded_value: The JSON encoding of the prediction, inserted as
+        is so that the prediction is not encoded again.
+    :return: The JSON encoding of the record.
+    """
+    return (
+        '{"op": "prediction", "key": '
+        + json.dumps(list(key))
+        + ', "value": '
+        + encoded_value
+        + "}"
+    )
+
+
+class StoreJournal:
+    """Append-only persistence of the store cache.
+
+    The cache file holds one JSON document per line. It starts with a
+    snapshot of the whole store: the store itself, which is also the format
+    of cache files written before the journal, optionally followed by records
+    of its content. Every following line is a record of a single change (see
+    apply_record), so that saving a change costs the size of the change
+    instead of the size of the store.
+
+    Once the records outgrow the snapshot, the file is compacted into a new
+    snapshot written to a temporary file and moved over the cache file. A
+    crash can then only lose the last, partially written, record, which is
+    skipped when the journal is read.
+    """
+
+    def __init__(
+        self, path: str, snapshot: Callable[[], Iterable[Union[dict, str]]]
+    ) -> None:
+        """Initialize the StoreJournal class.
+
+        :param path: The path of the cache file.
+        :param snapshot: Function returning the documents of a snapshot, the
+            store followed by any number of records, as dictionaries or as
+            their JSON encoding.
+        """
+        self._path_ = path
+        self._snapshot_ = snapshot
+        self._lock_ = threading.Lock()
+        self._file_ = None
+        self._pending_ = []
+        self._snapshot_bytes_ = 0
+        self._journal_bytes_ = 0
+
+    def exists(self) -> bool:
+        """Check if the cache file exists."""
+        return os.path.isfile(self._path_)
+
+    def read(self) -> dict:
+        """Read the store from the cache file.
+
+        The snapshot is replayed with every record following it. Lines that
+        cannot be decoded, such as a record cut short by a crash, are skipped.
+
+        :return: The store.
+        """
+        store = None
+        with open(self._path_, "r", encoding="utf-8") as cache:
+            for line in cache:
+                try:
+                    document = json.loads(line)
+                except ValueError:
+                    continue
+                if "op" not in document:
+                    store = document
+                elif store is not None:
+                    apply_record(store, document)
+        if store is None:
+            raise ValueError("cache file does not contain a snapshot")
+        return store
+
+    def append(self, record: Union[dict, str], flush: bool = True) -> None:
+        """Append a record to the journal.
+
+        :param record: The journal record, or its JSON encoding.
+        :param flush: Whether to write the record to disk right away. Records
+            that are not flushed are written with the next flush.
+        """
+        with self._lock_:
+            self._pending_.append(_encode(record) + "\n")
+            if flush:
+                self._flush_()
+
+    def flush(self) -> None:
+        """Write the pending records to disk."""
+        with self._lock_:
+            self._flush_()
+
+    def _flush_(self) -> None:
+        """Write the pending records, compacting the journal when needed."""
+        if self._file_ is None or not self.exists():
+            # this process has not written the file yet, start from a snapshot
+            self._compact_()
+            return
+        if not self._pending_:
+            return
+        lines = "".join(self._pending_)
+        self._pending_ = []
+        self._file_.write(lines)
+        self._file_.flush()
+        self._journal_bytes_ += len(lines)
+        if self._journal_bytes_ > max(COMPACTION_MIN_BYTES, self._snapshot_bytes_):
+            self._compact_()
+
+    def compact(self) -> None:
+        """Replace the cache file with a snapshot of the store."""
+        with self._lock_:
+            self._compact_()
+
+    def _compact_(self) -> None:
+        """Write a snapshot to a temporary file and move it over the cache."""
+        self._close_()
+        self._pending_ = []
+        snapshot_bytes = 0
+        temporary_path = self._path_ + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as cache:
+            for document in self._snapshot_():
+                line = _encode(document) + "\n"
+                cache.write(line)
+                snapshot_bytes += len(line)
+            cache.flush()
+            os.fsync(cache.fileno())
+        os.replace(temporary_path, self._path_)
+        # pylint: disable=consider-using-with
+        self._file_ = open(self._path_, "a", encoding="utf-8")
+        self._snapshot_bytes_ = snapshot_bytes
+        self._journal_bytes_ = 0
+
+    def delete(self) -> None:
+        """Delete the cache file."""
+        with self._lock_:
+            self._close_()
+            self._pending_ = []
+            if self.exists():
+                os.remove(self._path_)
+
+    def _close_(self) -> None:
+        """Close the cache file."""
+        if self._file_ is not None:
+            self._file_.close()
+            self._file_ = None
+
+
+def _encode(document: Union[dict, str]) -> str:
+    """Encode a document in JSON, unless it is already encoded."""
+    return document if isinstance(document, str) else json.dumps(document)
@@ -14,17 +14,22 @@
 @Desc    :   Module containing the utilities needed for predictions.
 """
 from base64 import encodebytes
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
 import cv2
 import numpy as np
-from server import EPSILON_MULTIPLIER
+import shapely
+from server import (
+    CONTOUR_WORKERS,
+    EPSILON_MULTIPLIER,
+    PRE_NMS_TOP_K,
+    PREDICTION_BATCH_SIZE,
+)
 from server.services.global_store import Errors, PortalError
 
 # pylint: disable=E0401, E0611
 from server.utils.color_switch import color_switch
-from shapely.geometry import MultiPolygon, Polygon
-from shapely.ops import unary_union
 
 
 def corrected_predict_query(*args, request) -> dict:
@@ -74,6 +79,33 @@ def corrected_predict_query(*args, request) -> dict:
                 Errors.INVALIDQUERY, "Confidence Query is not a float."
             ) from e
 
+    # Batch size check
+    if "batch_size" not in args:
+        batch_size = None
+    else:
+        try:
+            batch_size = int(request.args.get("batchSize", PREDICTION_BATCH_SIZE))
+            if batch_size < 1:
+                raise ValueError
+        except ValueError as e:
+            raise PortalError(
+                Errors.INVALIDQUERY, "batchSize query not a positive integer."
+            ) from e
+
+    # Pre-NMS top-K check
+    if "top_k" not in args:
+        top_k = None
+    else:
+        top_k = request.args.get("topK", PRE_NMS_TOP_K)
+        try:
+            top_k = None if top_k is None else int(top_k)
+            if top_k is not None and top_k < 1:
+                raise ValueError
+        except ValueError as e:
+            raise PortalError(
+                Errors.INVALIDQUERY, "topK query not a positive integer."
+            ) from e
+
     reanalyse_string = request.args.get("reanalyse", "false")
     if reanalyse_string not in ["true", "false"]:
         raise PortalError(
@@ -86,33 +118,41 @@ def corrected_predict_query(*args, request) -> dict:
     corrected_dict["format"] = format_arg
     corrected_dict["iou"] = iou
     corrected_dict["confidence"] = confidence
+    corrected_dict["batch_size"] = batch_size
+    corrected_dict["top_k"] = top_k
     corrected_dict["reanalyse"] = reanalyse
     return corrected_dict
 
 
+# Number of boxes whose overlaps are computed together in the bbox suppression.
+NMS_BLOCK_SIZE = 256
+# Number of set bits of every byte value, to count the pixels of packed masks.
+_BIT_COUNTS = np.array([bin(value).count("1") for value in range(256)], np.uint8)
+# Shared by all predictions, its threads are only started when needed.
+_CONTOUR_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, CONTOUR_WORKERS), thread_name_prefix="contour"
+)
+
+
 def _filter_class_and_zero_scores(
     scores: np.array,
     classes: np.array,
     filter_class: Union[int, None],
     confidence: float = 0.001,
-) -> list:
-    """Create a list of indices representing the filtered elements.
+) -> np.array:
+    """Create an array of indices representing the filtered elements.
     :param scores: Numpy array containing scores of all detections.
     :param classes: Numpy array containing classes of all detections.
     :filter_class: The class to be kept. All others will be filtered out.
     :confidence: The confidence threshold to be kept, filtering out the rest.
-    :returns: List of indices of the filtered elements.
+    :returns: Array of indices of the filtered elements.
     """
+    # compared in float64 as python floats would be, so that a float32
+    # score is never checked against a rounded threshold
+    filter_mask = np.asarray(scores, dtype=np.float64) >= confidence
     if filter_class is not None:
-        filter_idx = [
-            idx
-            for idx, (score, class_id) in enumerate(zip(scores, classes))
-            if (score >= confidence and class_id == filter_class)
-        ]
-    else:
-        filter_idx = [idx for idx, score in enumerate(scores) if score >= confidence]
-
-    return filter_idx
+        filter_mask &= np.asarray(classes) == filter_class
+    return np.flatnonzero(filter_mask)
 
 
 def _non_max_suppress_bbox(
@@ -124,6 +164,11 @@ def _non_max_suppress_bbox(
     confidence: float = 0.001,
 ) -> tuple:
     """Perform non max suppression on the detection output if it is bbox.
+
+    Boxes are visited in descending score order, a box is kept unless a kept
+    box of the same class overlaps it by more than the iou threshold. The
+    overlaps are computed in blocks of NMS_BLOCK_SIZE boxes against every
+    box that is not yet suppressed.
     :param bbox: Bbox outputs.
     :param scores: Score outputs.
     :param classes: Class outputs.
@@ -141,39 +186,44 @@ def _non_max_suppress_bbox(
     scores_filter = np.array(np.array(scores)[filter_idx])
     bbox_filter = np.array(np.array(bbox)[filter_idx])
     classes_filter = np.array(np.array(classes)[filter_idx])
-    x_1 = np.expand_dims(bbox_filter[:, 1], axis=1)
-    y_1 = np.expand_dims(bbox_filter[:, 0], axis=1)
-    x_2 = np.expand_dims(bbox_filter[:, 3], axis=1)
-    y_2 = np.expand_dims(bbox_filter[:, 2], axis=1)
+    sorted_scores = scores_filter.argsort()[::-1]
+    y_1, x_1, y_2, x_2 = bbox_filter[sorted_scores].reshape(-1, 4).T
+    sorted_classes = classes_filter[sorted_scores]
     # element-wise multiplication to get areas
     areas = (x_2 - x_1) * (y_2 - y_1)
-    sorted_scores = scores_filter.argsort()[::-1]
+    suppressed = np.zeros(sorted_scores.size, dtype=bool)
     keep = []
-    while sorted_scores.size > 0:
-        score = sorted_scores[0]
-        # keep the largest sorted score
-        # (sorted_scores[0] represent the largest score)
-        keep.append(score)
-
-        # compare the intersection with all other scores
-        xx1 = np.maximum(x_1[score], x_1[sorted_scores[1:]])
-        yy1 = np.maximum(y_1[score], y_1[sorted_scores[1:]])
-        xx2 = np.minimum(x_2[score], x_2[sorted_scores[1:]])
-        yy2 = np.minimum(y_2[score], y_2[sorted_scores[1:]])
-
-        class_largest = classes_filter[score]
-        class_others = classes_filter[sorted_scores[1:]]
+    for block_start in range(0, sorted_scores.size, NMS_BLOCK_SIZE):
+        block_end = block_start + NMS_BLOCK_SIZE
+        rows = np.flatnonzero(~suppressed[block_start:block_end]) + block_start
+        if rows.size == 0:
+            continue
+        cols = np.flatnonzero(~suppressed[block_start:]) + block_start
+        row_x1, row_y1 = x_1[rows, None], y_1[rows, None]
+        row_x2, row_y2 = x_2[rows, None], y_2[rows, None]
+
+        # compare the intersection of the block with all remaining boxes
+        xx1 = np.maximum(row_x1, x_1[cols])
+        yy1 = np.maximum(row_y1, y_1[cols])
+        xx2 = np.minimum(row_x2, x_2[cols])
+        yy2 = np.minimum(row_y2, y_2[cols])
         # intersect = width * height
         intersect = np.maximum(0.0, xx2 - xx1) * np.maximum(0.0, yy2 - yy1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            overlap = intersect / (areas[rows, None] + areas[cols] - intersect)
 
-        overlap = intersect / (areas[score] + areas[sorted_scores[1:]] - intersect)
-        sorted_scores = sorted_scores[
-            np.union1d(
-                np.where(overlap <= 1 - iou)[0],
-                np.where(class_others != class_largest),
-            )
-            + 1
-        ]
+        # a box only suppresses the lower scored boxes of its own class,
+        # nan overlaps of empty boxes suppress as well
+        suppress = ~(
+            (overlap <= 1 - iou) | (sorted_classes[rows, None] != sorted_classes[cols])
+        )
+        suppress &= cols > rows[:, None]
+        for row_index, row in enumerate(rows):
+            if suppressed[row]:
+                continue
+            keep.append(row)
+            suppressed[cols[suppress[row_index]]] = True
+    keep = sorted_scores[keep]
     detection_boxes = list(map(tuple, bbox_filter[keep]))
     detection_scores = list(scores_filter[keep])
     detection_classes = list(classes_filter[keep])
@@ -192,6 +242,34 @@ def _non_max_suppress_bbox(
     )
 
 
+def _pack_masks(masks: np.array) -> tuple:
+    """Bit-pack the masks row by row.
+
+    Every mask is packed into ceil(width / 8) bytes per row, together with
+    its area and the bounds of its nonzero pixels, given as the first and
+    last row and the first and last packed byte column. Empty masks get
+    bounds that do not overlap anything.
+    :param masks: Numpy array of masks.
+    :returns: Tuple of the packed masks, their areas and their bounds.
+    """
+    count = len(masks)
+    height = masks.shape[1] if masks.ndim > 2 else 1
+    width = int(np.prod(masks.shape[2:] if masks.ndim > 2 else masks.shape[1:]))
+    masks = masks.reshape(count, height, width)
+    packed = np.empty((count, height, (width + 7) // 8), dtype=np.uint8)
+    areas = np.empty(count)
+    bounds = np.tile(np.array([height, -1, packed.shape[2], -1]), (count, 1))
+    for index, mask in enumerate(masks):
+        mask = mask != 0
+        packed[index] = np.packbits(mask, axis=1)
+        areas[index] = np.count_nonzero(mask)
+        rows = np.flatnonzero(packed[index].any(axis=1))
+        cols = np.flatnonzero(packed[index].any(axis=0))
+        if rows.size > 0:
+            bounds[index] = (rows[0], rows[-1], cols[0], cols[-1])
+    return packed, areas, bounds
+
+
 def _non_max_suppress_mask(
     bbox: np.array,
     scores: np.array,
@@ -202,6 +280,10 @@ def _non_max_suppress_mask(
     confidence: float = 0.001,
 ) -> tuple:
     """Perform non max suppression on the detection output if it is mask.
+
+    The intersections are counted on bit-packed masks, within the bounds of
+    the kept mask and only for the masks of the same class whose bounds
+    overlap it, all other intersections being zero.
     :param bbox: Bbox outputs.
     :param scores: Score outputs.
     :param classes: Class outputs.
@@ -221,11 +303,11 @@ def _non_max_suppress_mask(
     scores_filter = np.array(np.array(scores)[filter_idx])
     bbox_filter = np.array(np.array(bbox)[filter_idx])
     classes_filter = np.array(np.array(classes)[filter_idx])
-    masks_filter = np.array(np.array(masks)[filter_idx])
+    # fancy indexing already returns a copy of the (large) masks
+    masks_filter = np.asarray(masks)[filter_idx]
 
-    areas = np.empty(masks_filter.shape[0])
-    for index, mask in enumerate(masks_filter):
-        areas[index] = np.count_nonzero(mask)
+    packed, areas, bounds = _pack_masks(masks_filter)
+    row_min, row_max, col_min, col_max = bounds.T
     sorted_scores = scores_filter.argsort()[::-1]
     keep = []
     while sorted_scores.size > 0:
@@ -233,24 +315,31 @@ def _non_max_suppress_mask(
         # keep the largest sorted score
         # (sorted_scores[0] represent the largest score)
         keep.append(score)
-
+        others = sorted_scores[1:]
+        same_class = classes_filter[others] == classes_filter[score]
+
+        # only masks of the same class whose bounds overlap can intersect
+        candidates = (
+            same_class
+            & (row_min[others] <= row_max[score])
+            & (row_max[others] >= row_min[score])
+            & (col_min[others] <= col_max[score])
+            & (col_max[others] >= col_min[score])
+        )
         # with:
         # x = [0 0 1 1] and y = [0 1 1 0],
         # the intersect is x && y element-wise -> [0 0 1 0]
-        intersect = np.empty_like(sorted_scores[1:])
-        for index, others in enumerate(masks_filter[sorted_scores[1:]]):
-            intersect[index] = np.count_nonzero(
-                np.logical_and(masks_filter[score], others)
-            )
-
-        overlap = intersect / (areas[score] + areas[sorted_scores[1:]] - intersect)
-        sorted_scores = sorted_scores[
-            np.union1d(
-                np.where(overlap <= 1 - iou)[0],
-                np.where(classes_filter[sorted_scores[1:]] != classes_filter[score]),
-            )
-            + 1
-        ]
+        intersect = np.zeros_like(others)
+        if candidates.any():
+            rows = slice(row_min[score], row_max[score] + 1)
+            cols = slice(col_min[score], col_max[score] + 1)
+            intersect[candidates] = _BIT_COUNTS[
+                packed[others[candidates], rows, cols] & packed[score, rows, cols]
+            ].sum(axis=(1, 2))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            overlap = intersect / (areas[score] + areas[others] - intersect)
+        sorted_scores = others[(overlap <= 1 - iou) | ~same_class]
     detection_boxes = list(map(tuple, bbox_filter[keep]))
     detection_scores = list(scores_filter[keep])
     detection_classes = list(classes_filter[keep])
@@ -353,71 +442,91 @@ def back_to_array(suppressed_output: tuple) -> dict:
     return tensor_dict
 
 
+def _find_mask_polygons(single_mask: np.array) -> list:
+    """Find the simplified polygons of a single mask.
+    :param single_mask: Numpy array representing the instance mask.
+    :returns: List of the polygons as arrays of normalized points.
+    """
+    height, width = single_mask.shape
+    # 1. Get the contours using cv2.find contours.
+    # The contours may be fragmented,
+    # thereby the result may be a list of contours.
+    found_contours = cv2.findContours(
+        single_mask,
+        cv2.RETR_LIST,
+        cv2.CHAIN_APPROX_NONE,
+    )
+    polygons = []
+    for single_contour in found_contours[0]:
+        # 2. Simplfy the contour to get an approximation
+        epsilon = EPSILON_MULTIPLIER * cv2.arcLength(single_contour, True)
+        approx = cv2.approxPolyDP(single_contour, epsilon, True)
+        # Min 3 points is needed for polygon to be created
+        if len(approx) >= 3:
+            # 3. Normalize the approximation
+            polygons.append(approx[:, 0] / (width, height))
+    return polygons
+
+
 def _convert_mask_to_contours(reframed_masks: np.array) -> list:
     """Convert mask detections into contours.
+
+    The polygons of the masks are found by CONTOUR_WORKERS threads (OpenCV
+    releases the GIL), then the geometry operations run on all of them at
+    once with the shapely 2.0 array functions.
     :param reframed_masks: Numpy array representing the instance mask.
     :returns: The list of contours.
     """
-    _, height, width = reframed_masks.shape
-    contours = []
-    for single_mask in reframed_masks:
-        # 1. Get the contours using cv2.find contours.
-        # The contours may be fragmented,
-        # thereby the result may be a list of contours.
-        found_contours = cv2.findContours(
-            single_mask,
-            cv2.RETR_LIST,
-            cv2.CHAIN_APPROX_NONE,
+    if CONTOUR_WORKERS > 1 and len(reframed_masks) > 1:
+        mask_polygons = list(_CONTOUR_EXECUTOR.map(_find_mask_polygons, reframed_masks))
+    else:
+        mask_polygons = [_find_mask_polygons(mask) for mask in reframed_masks]
+    # If theres no contours at all, or all approx contours have less than
+    # 3 points and are filtered out, we just skip and keep an empty list.
+    contours = [[] for _ in mask_polygons]
+    masks = np.flatnonzero([bool(polygons) for polygons in mask_polygons])
+    if masks.size == 0:
+        return contours
+    polygons = [polygon for index in masks for polygon in mask_polygons[index]]
+    polygons = shapely.polygons(
+        shapely.linearrings(
+            np.concatenate(polygons),
+            indices=np.repeat(np.arange(len(polygons)), [len(x) for x in polygons]),
         )
-        # Output of cv2.findContours has tuple of single list format ([xxx]).
-        # The outer tuple and list are of the same dimensions
-        # We only need the list, so we take
-        # the inner (single) 0th element of the tuple.
-        inner_contour = found_contours[0]
-
-        # If theres no contours at all we just skip and append an empty list.
-        if not bool(inner_contour):
-            contours.append([])
-        else:
-            polygons = []
-            for single_contour in inner_contour:
-                # 2. Simplfy the contour to get an approximation
-                epsilon = EPSILON_MULTIPLIER * cv2.arcLength(single_contour, True)
-                approx = cv2.approxPolyDP(single_contour, epsilon, True)
-                # 3. Normalize the approximation
-                approx = [[item[0][0] / width, item[0][1] / height] for item in approx]
-
-                # Min 3 points is needed for polygon to be created
-                if len(approx) >= 3:
-                    polygon = Polygon(approx)
-                    polygons.append(polygon)
-
-            # For the case where approx contour has less than 3 points and
-            # is filtered out, we also just skip and append an empty list.
-            if not bool(polygons):
-                contours.append([])
-            else:
-                # 4. With all Polygons, create a Multipolygon Object
-                multipolygon = MultiPolygon(polygons)
-                # 5. Union all Polygons in Multipolygon Object
-                union_polygon = unary_union(multipolygon)
-                # Output of union may be either
-                # Polygon (All Polygons touching each other previously)
-                # or MultiPolygon (Previously some separated Polygons)
-
-                # 5. For MultiPolygon, get Polygon with the largest area
-                if isinstance(union_polygon, MultiPolygon):
-                    # pylint: disable=E1101
-                    polygon_list = list(union_polygon.geoms)
-                    largest_poly_idx = np.argmax([item.area for item in polygon_list])
-                    final_polygon = polygon_list[largest_poly_idx]
-
-                # 6. No change for single polygon
-                else:
-                    final_polygon = union_polygon
-
-                # 7. Extract the contour points and append
-                contours.append(list(final_polygon.exterior.coords))
+    )
+    # 4. With all Polygons of a mask, create a Multipolygon Object
+    multipolygons = shapely.multipolygons(
+        polygons,
+        indices=np.repeat(
+            np.arange(masks.size), [len(mask_polygons[index]) for index in masks]
+        ),
+    )
+    # 5. Union all Polygons in Multipolygon Object
+    union_polygons = shapely.union_all(multipolygons[:, np.newaxis], axis=1)
+    # Output of union may be either
+    # Polygon (All Polygons touching each other previously)
+    # or MultiPolygon (Previously some separated Polygons)
+
+    # 5. For MultiPolygon, get Polygon with the largest area
+    is_multi = (
+        shapely.get_type_id(union_polygons) == shapely.GeometryType.MULTIPOLYGON
+    ) & (shapely.get_num_geometries(union_polygons) > 0)
+    if is_multi.any():
+        parts, part_index = shapely.get_parts(
+            union_polygons[is_multi], return_index=True
+        )
+        splits = np.flatnonzero(np.diff(part_index)) + 1
+        union_polygons[is_multi] = [
+            group[np.argmax(shapely.area(group))] for group in np.split(parts, splits)
+        ]
+
+    # 6. Extract the contour points of the (largest) Polygons
+    coords, coords_index = shapely.get_coordinates(
+        shapely.get_exterior_ring(union_polygons), return_index=True
+    )
+    splits = np.searchsorted(coords_index, np.arange(1, masks.size))
+    for index, mask_coords in zip(masks, np.split(coords, splits)):
+        contours[index] = list(map(tuple, mask_coords.tolist()))
     return contours
 
 
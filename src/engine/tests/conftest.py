@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   conftest.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Environment of the engine server under test.
+"""
+import os
+import sys
+import tempfile
+
+# The server reads its cache locations from the environment on import.
+_CACHE_DIR = tempfile.mkdtemp(prefix="portal-test-")
+os.environ.setdefault("USE_CACHE", "0")
+os.environ.setdefault("CACHE_DIR", os.path.join(_CACHE_DIR, "store.portalCache"))
+os.environ.setdefault("USE_CACHE_DIR", os.path.join(_CACHE_DIR, "cache.var"))
+os.environ.setdefault("MODEL_DIR", _CACHE_DIR)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
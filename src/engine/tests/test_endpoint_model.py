@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   test_endpoint_model.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Tests of the Endpoint Model against a stand-in endpoint.
+"""
+import base64
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+from server.models.endpoint_model import EndpointModel
+
+
+class StandInEndpoint(BaseHTTPRequestHandler):
+    """Stand-in of the /predict and /classes routes of an endpoint.
+
+    The confidence of the single detection returned is the mean pixel value
+    of the uploaded image divided by 255, so that every response can be
+    matched to its image.
+    """
+
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def setup(self):
+        # answer without waiting for the delayed acknowledgements
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+        with self.state["lock"]:
+            self.state["connections"] += 1
+
+    def log_message(self, *_):
+        pass
+
+    def _send_(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the classes of the endpoint."""
+        if not self.path.endswith("/classes"):
+            self._send_(404, {})
+            return
+        self._send_(200, {"1": {"name": "object"}})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Serve a prediction, or a 503 while failures are requested."""
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        state = self.state
+        with state["lock"]:
+            state["posts"] += 1
+            failing = state["failures"] > 0
+            if failing:
+                state["failures"] -= 1
+            else:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        if failing:
+            self._send_(503, {})
+            return
+        jpeg = base64.b64decode(json.loads(body)["data"])
+        image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        mean = float(image.mean())
+        # brighter images are answered first, out of their sending order
+        time.sleep(state["delay"] * (1 - mean / 255))
+        with state["lock"]:
+            state["in_flight"] -= 1
+        self._send_(
+            200,
+            {
+                "predictions": [
+                    {
+                        "bound": [[0.1, 0.2], [0.1, 0.6], [0.5, 0.6], [0.5, 0.2]],
+                        "confidence": mean / 255,
+                        "tag": {"id": 1, "name": "object"},
+                        "boundType": "rectangle",
+                    }
+                ]
+            },
+        )
+
+
+@pytest.fixture(name="endpoint")
+def fixture_endpoint():
+    state = {
+        "lock": threading.Lock(),
+        "connections": 0,
+        "posts": 0,
+        "failures": 0,
+        "in_flight": 0,
+        "max_in_flight": 0,
+        "delay": 0.0,
+    }
+    handler = type("Handler", (StandInEndpoint,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/predict", state
+    server.shutdown()
+    server.server_close()
+
+
+def _endpoint_model(link, **options):
+    model = EndpointModel(
+        "endpoint", "", "endpoint", "", link=link, project_secret="secret", **options
+    )
+    model.register()
+    model.load()
+    return model
+
+
+def _image(value):
+    return np.full((48, 64, 3), value, dtype=np.uint8)
+
+
+def test_connections_are_reused(endpoint):
+    link, state = endpoint
+    model = _endpoint_model(link)
+    for value in (10, 20, 30, 40, 50):
+        model.predict(_image(value))
+    assert state["posts"] == 5
+    assert state["connections"] == 1
+    assert model.get_label_map() == {"1": {"name": "object", "id": 1}}
+
+
+def test_server_errors_are_retried(endpoint):
+    link, state = endpoint
+    model = _endpoint_model(link, retries=3, backoff=0.01)
+    state["failures"] = 2
+    detections = model.predict(_image(128))
+    assert state["posts"] == 3
+    assert detections["detection_scores"] == pytest.approx(128 / 255, abs=0.01)
+
+
+def test_batches_are_sent_concurrently_in_order(endpoint):
+    link, state = endpoint
+    state["delay"] = 0.4
+    model = _endpoint_model(link, concurrency=4)
+    values = [20, 80, 140, 200]
+    start = time.perf_counter()
+    detections = model.predict_batch([_image(value) for value in values])
+    elapsed = time.perf_counter() - start
+    assert state["max_in_flight"] == 4
+    # sequential requests would take the sum of the delays, about 0.85 s
+    assert elapsed < 0.6
+    assert [float(output["detection_scores"]) for output in detections] == (
+        pytest.approx([value / 255 for value in values], abs=0.01)
+    )
+
+
+def test_unload_closes_the_session(endpoint):
+    link, state = endpoint
+    model = _endpoint_model(link)
+    model.predict(_image(60))
+    session = model._http_  # pylint: disable=protected-access
+    model.unload()
+    assert model._http_ is None  # pylint: disable=protected-access
+    assert all(not adapter.poolmanager.pools for adapter in session.adapters.values())
+    model.predict(_image(60))
+    assert state["connections"] == 2
+
+
+class SlowBatch(list):
+    """Batch of images taking a while to iterate over."""
+
+    def __iter__(self):
+        for image in super().__iter__():
+            time.sleep(0.02)
+            yield image
+
+
+def test_unload_waits_for_the_predictions_in_progress(endpoint):
+    link, state = endpoint
+    model = _endpoint_model(link, concurrency=2)
+    images = SlowBatch(_image(value) for value in range(20, 240, 20))
+    outputs = {}
+
+    def predict():
+        try:
+            outputs["detections"] = model.predict_batch(images)
+        except Exception as e:  # pylint: disable=broad-except
+            outputs["error"] = e
+
+    thread = threading.Thread(target=predict)
+    thread.start()
+    # unload while the batch is being submitted
+    time.sleep(0.05)
+    model.unload()
+    thread.join()
+    assert "error" not in outputs
+    assert len(outputs["detections"]) == len(images)
+    assert state["posts"] == len(images)
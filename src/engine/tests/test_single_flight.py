@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   test_single_flight.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Tests of the coalescing of atomic function calls.
+"""
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+from server import app, global_store
+from server.models.abstract.BaseModel import BaseModel
+from server.routes import routes
+from server.services import encode
+from server.services.errors import Errors, PortalError
+from server.services.single_flight import SingleFlight, _conflicts
+
+DUPLICATES = 8
+
+
+class CountingModel(BaseModel):
+    """Model returning one detection after a delay, counting its calls."""
+
+    def __init__(self, delay):
+        super().__init__("counting", "", "counting", "")
+        self._label_map_ = {"1": {"id": 1, "name": "object"}}
+        self._model_ = self
+        self.delay = delay
+        self.calls = 0
+        self._calls_lock_ = threading.Lock()
+
+    def predict(self, image_array):
+        with self._calls_lock_:
+            self.calls += 1
+        time.sleep(self.delay)
+        return {
+            "detection_masks": None,
+            "detection_boxes": np.array([[0.1, 0.1, 0.5, 0.5]]),
+            "detection_scores": np.array([0.9]),
+            "detection_classes": np.array([1]),
+        }
+
+
+def _run_concurrently(function, count):
+    """Call function(index) from count threads released together."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        results[index] = function(index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_duplicate_calls_share_one_computation():
+    flight = SingleFlight(timeout=5, ttl=0)
+    computations = []
+
+    def call(index):
+        future = flight.acquire("predict", ["model"])
+        if future is not None:
+            return future.result()
+        computations.append(index)
+        time.sleep(0.1)
+        flight.release(f"result of {index}")
+        return f"result of {index}"
+
+    results = _run_concurrently(call, DUPLICATES)
+    assert len(computations) == 1
+    assert set(results) == {f"result of {computations[0]}"}
+    assert not flight.is_running()
+
+
+def test_calls_sharing_a_resource_wait_for_each_other():
+    flight = SingleFlight(timeout=0.1, ttl=0)
+    assert flight.acquire("load", ["model"]) is None
+    with pytest.raises(PortalError) as error:
+        flight.acquire("unload", ["model"])
+    assert error.value.get_error() == Errors.ATOMICERROR.name
+    assert flight.acquire("other", ["other model"]) is None
+    flight.release("other")
+
+
+def test_calls_without_resources_conflict_with_every_call():
+    assert _conflicts(frozenset(), frozenset({"model"}))
+    assert _conflicts(frozenset({"model"}), frozenset())
+    assert _conflicts(frozenset(), frozenset())
+    assert _conflicts(frozenset({"a", "b"}), frozenset({"b"}))
+    assert not _conflicts(frozenset({"a"}), frozenset({"b"}))
+
+    flight = SingleFlight(timeout=0.1, ttl=0)
+    assert flight.acquire("predict", ["model"]) is None
+    with pytest.raises(PortalError):
+        flight.acquire("register", [])
+    flight.release("predicted")
+    assert flight.acquire("register", []) is None
+    flight.release("registered")
+
+
+def test_results_are_kept_for_the_ttl():
+    flight = SingleFlight(timeout=1, ttl=0.2)
+    assert flight.acquire("predict", ["model"]) is None
+    flight.release("predicted")
+    future = flight.acquire("predict", ["model"])
+    assert future is not None and future.result() == "predicted"
+    time.sleep(0.25)
+    assert flight.acquire("predict", ["model"]) is None
+    flight.release("predicted again")
+
+
+def test_failed_and_invalidated_results_are_not_kept():
+    flight = SingleFlight(timeout=1, ttl=10)
+    assert flight.acquire("load", ["model"]) is None
+    flight.release("failed", retain=False)
+    assert flight.acquire("load", ["model"]) is None
+    flight.release("loaded")
+    assert flight.acquire("unload", ["model"]) is None
+    flight.release("unloaded")
+    assert flight.acquire("load", ["model"]) is None
+    flight.release("loaded")
+    # predictions do not change their model, so they keep other results
+    assert flight.acquire("predict", ["model"], invalidates=False) is None
+    flight.release("predicted")
+    assert flight.acquire("load", ["model"]).result() == "loaded"
+
+
+@pytest.fixture(name="image_path")
+def fixture_image_path(tmp_path):
+    path = tmp_path / "image.png"
+    image = np.random.default_rng(0).integers(0, 255, (32, 32, 3), dtype=np.uint8)
+    cv2.imwrite(str(path), image)
+    return str(path)
+
+
+def test_duplicate_predict_requests_are_coalesced(image_path):
+    model = CountingModel(delay=0.3)
+    global_store.load_model("counting", model)
+    try:
+        url = (
+            f"/api/model/counting/predict?filepath={encode(image_path)}"
+            "&format=json&iou=0.31&reanalyse=true"
+        )
+
+        def request(_):
+            response = app.test_client().get(url)
+            return response.status_code, response.get_data(as_text=True)
+
+        responses = _run_concurrently(request, DUPLICATES)
+    finally:
+        global_store.unload_model("counting")
+    assert model.calls == 1
+    assert {status for status, _ in responses} == {200}
+    assert len({body for _, body in responses}) == 1
+
+
+def test_reanalyse_requests_are_not_served_kept_responses(image_path):
+    model = CountingModel(delay=0)
+    global_store.load_model("counting", model)
+    try:
+        url = (
+            f"/api/model/counting/predict?filepath={encode(image_path)}"
+            "&format=json&iou=0.32"
+        )
+        client = app.test_client()
+        assert client.get(url).status_code == 200
+        assert client.get(url + "&reanalyse=true").status_code == 200
+    finally:
+        global_store.unload_model("counting")
+    assert model.calls == 2
+
+
+def test_different_registrations_are_not_coalesced(monkeypatch):
+    registered = []
+    monkeypatch.setattr(
+        routes,
+        "register_local",
+        lambda directory, *args, **kwargs: registered.append(directory),
+    )
+
+    def register(directory):
+        return app.test_client().post(
+            "/api/model/register",
+            json={
+                "type": "local",
+                "credentials": {
+                    "modelKey": "",
+                    "projectKey": "",
+                    "projectSecret": "",
+                    "modelURL": "",
+                },
+                "name": "model",
+                "description": "",
+                "modelType": "tensorflow",
+                "directory": directory,
+            },
+        )
+
+    assert register("/models/a").status_code == 200
+    assert register("/models/b").status_code == 200
+    assert registered == ["/models/a", "/models/b"]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+  ████
+██    ██   Datature
+  ██  ██   Powering Breakthrough AI
+    ██
+
+@File    :   test_video_sampling.py
+@Author  :   Marcus Neo
+@Version :   0.5.9
+@Contact :   hello@datature.io
+@License :   Apache License 2.0
+@Desc    :   Tests of the sampling of video frames.
+"""
+import cv2
+import numpy as np
+import pytest
+from server.services.predictions import sample_video_frames
+
+TOTAL_FRAMES = 100
+KEYFRAME_INTERVAL = 12
+
+
+class KeyframeCapture:
+    """Video capture whose seeks land on a keyframe instead of the frame.
+
+    Every frame is filled with its own index, and seeks land on the
+    preceding keyframe ("before") or on the following one ("after").
+    """
+
+    def __init__(self, snap):
+        self.snap = snap
+        self.position = 0
+
+    def set(self, prop, value):
+        assert prop == cv2.CAP_PROP_POS_FRAMES
+        keyframe = int(value) // KEYFRAME_INTERVAL * KEYFRAME_INTERVAL
+        if self.snap == "after" and keyframe < value:
+            keyframe += KEYFRAME_INTERVAL
+        self.position = keyframe
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if prop == cv2.CAP_PROP_FPS:
+            return 25.0
+        return 0.0
+
+    def grab(self):
+        if self.position >= TOTAL_FRAMES:
+            return False
+        self.position += 1
+        return True
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return True, np.full((2, 2, 3), self.position - 1, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("snap", ["before", "after"])
+@pytest.mark.parametrize("frame_interval", [1, 5, 30])
+@pytest.mark.parametrize("start_frame", [0, 7, 30])
+def test_sampled_frames_match_a_sequential_pass(snap, frame_interval, start_frame):
+    """Samples land on the requested frames however seeks are snapped."""
+    samples = list(
+        sample_video_frames(KeyframeCapture(snap), frame_interval, start_frame)
+    )
+    expected = list(range(start_frame, TOTAL_FRAMES, frame_interval))
+    assert [index for index, _ in samples] == expected
+    assert [int(frame[0, 0, 0]) for _, frame in samples] == expected
+
+
+def test_segment_end_is_exclusive():
+    """A segment stops before its end frame."""
+    samples = sample_video_frames(KeyframeCapture("before"), 5, 10, 40)
+    assert [index for index, _ in samples] == list(range(10, 40, 5))